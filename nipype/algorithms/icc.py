@@ -2,6 +2,7 @@ from numpy import ones, kron, mean, eye, hstack, dot, tile
 from scipy.linalg import pinv
 from ..interfaces.base import BaseInterfaceInputSpec, TraitedSpec, \
     BaseInterface, traits, File
+from multiprocessing.pool import ThreadPool
 import nibabel as nb
 import numpy as np
 import os
@@ -12,10 +13,15 @@ class ICCInputSpec(BaseInterfaceInputSpec):
                            desc="n subjects m sessions 3D stat files",
                            mandatory=True)
     mask = File(exists=True, mandatory=True)
+    chunk_size = traits.Int(10000, usedefault=True, nohash=True,
+                            desc="number of voxels processed at once")
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc="number of threads processing chunks")
 
 
 class ICCOutputSpec(TraitedSpec):
     icc_map = File(exists=True)
+    sessions_F_map = File(exists=True, desc="F statistics of the sessions")
     session_var_map = File(exists=True, desc="variance between sessions")
     subject_var_map = File(exists=True, desc="variance between subjects")
 
@@ -37,14 +43,9 @@ class ICC(BaseInterface):
         session_datas = [[nb.load(fname).get_data()[maskdata].reshape(-1, 1) for fname in sessions] for sessions in self.inputs.subjects_sessions]
         list_of_sessions = [np.dstack(session_data) for session_data in session_datas]
         all_data = np.hstack(list_of_sessions)
-        icc = np.zeros(session_datas[0][0].shape)
-        session_F = np.zeros(session_datas[0][0].shape)
-        session_var = np.zeros(session_datas[0][0].shape)
-        subject_var = np.zeros(session_datas[0][0].shape)
-
-        for x in range(icc.shape[0]):
-            Y = all_data[x, :, :]
-            icc[x], subject_var[x], session_var[x],  session_F[x], _, _ = ICC_rep_anova(Y)
+        icc, subject_var, session_var, session_F, _, _ = \
+            ICC_rep_anova_chunked(all_data, self.inputs.chunk_size,
+                                  self.inputs.num_threads)
 
         nim = nb.load(self.inputs.subjects_sessions[0][0])
         new_data = np.zeros(nim.get_shape())
@@ -52,6 +53,11 @@ class ICC(BaseInterface):
         new_img = nb.Nifti1Image(new_data, nim.get_affine(), nim.get_header())
         nb.save(new_img, 'icc_map.nii')
 
+        new_data = np.zeros(nim.get_shape())
+        new_data[maskdata] = session_F.reshape(-1,)
+        new_img = nb.Nifti1Image(new_data, nim.get_affine(), nim.get_header())
+        nb.save(new_img, 'sessions_F_map.nii')
+
         new_data = np.zeros(nim.get_shape())
         new_data[maskdata] = session_var.reshape(-1,)
         new_img = nb.Nifti1Image(new_data, nim.get_affine(), nim.get_header())
@@ -127,3 +133,89 @@ def ICC_rep_anova(Y):
     r_var = (MSR - MSE)/nb_conditions #variance between subjects
 
     return ICC, r_var, e_var, session_effect_F, dfc, dfe
+
+
+def ICC_rep_anova_batch(Y):
+    '''
+    ICC_rep_anova of many tables at once
+
+    the data Y are entered as an array of 'tables', of shape (nb_tables,
+    nb_subjects, nb_conditions). The design is balanced, so the residuals of
+    the model are the data minus the subject and session means plus the
+    grand mean and no design matrix is needed. Returns arrays of nb_tables
+    values (and the degrees of freedom) as ICC_rep_anova does.
+    '''
+
+    Y = np.asarray(Y, dtype=np.float64)
+    [_, nb_subjects, nb_conditions] = Y.shape
+    dfc = nb_conditions - 1
+    dfe = (nb_subjects - 1) * dfc
+    dfr = nb_subjects - 1
+
+    mean_Y = Y.mean(axis=2).mean(axis=1)
+    mean_subjects = Y.mean(axis=2)
+    mean_sessions = Y.mean(axis=1)
+
+    # Sum Square Total
+    centered = Y - mean_Y[:, None, None]
+    SST = (centered ** 2).sum(axis=2).sum(axis=1)
+
+    # Sum Square Error
+    centered -= mean_subjects[:, :, None] - mean_Y[:, None, None]
+    centered -= mean_sessions[:, None, :] - mean_Y[:, None, None]
+    SSE = (centered ** 2).sum(axis=2).sum(axis=1)
+    MSE = SSE / dfe
+
+    # Sum square session effect - between colums/sessions
+    SSC = ((mean_sessions - mean_Y[:, None]) ** 2).sum(axis=1) * nb_subjects
+    MSC = SSC / dfc / nb_subjects
+
+    session_effect_F = MSC / MSE
+
+    # Sum Square subject effect - between rows/subjects
+    SSR = SST - SSC - SSE
+    MSR = SSR / dfr
+
+    ICC = (MSR - MSE) / (MSR + dfc * MSE)
+
+    e_var = MSE
+    r_var = (MSR - MSE) / nb_conditions
+
+    return ICC, r_var, e_var, session_effect_F, dfc, dfe
+
+
+def ICC_rep_anova_chunked(Y, chunk_size=10000, num_threads=1):
+    '''
+    ICC_rep_anova_batch of the tables Y, chunk_size tables at a time
+
+    Bounds the memory used by the temporary arrays to a few times the size
+    of a chunk. The chunks are processed by num_threads threads (numpy
+    releases the GIL in the array operations).
+    '''
+
+    [nb_tables, nb_subjects, nb_conditions] = Y.shape
+    dfc = nb_conditions - 1
+    dfe = (nb_subjects - 1) * dfc
+    chunk_size = max(int(chunk_size), 1)
+    outputs = [np.zeros((nb_tables, 1)) for _ in range(4)]
+
+    def run_chunk(start):
+        stop = min(start + chunk_size, nb_tables)
+        values = ICC_rep_anova_batch(Y[start:stop])
+        for output, value in zip(outputs, values[:4]):
+            output[start:stop, 0] = value
+
+    starts = range(0, nb_tables, chunk_size)
+    nthreads = min(max(num_threads, 1), len(starts))
+    if nthreads > 1:
+        pool = ThreadPool(nthreads)
+        try:
+            pool.map(run_chunk, starts)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for start in starts:
+            run_chunk(start)
+
+    return tuple(outputs) + (dfc, dfe)
@@ -13,7 +13,6 @@ Miscellaneous algorithms for 2D contours and 3D triangularized meshes handling
 
 
 import numpy as np
-from scipy.spatial.distance import euclidean
 
 from .. import logging
 
@@ -56,45 +55,22 @@ class P2PDistance(BaseInterface):
     input_spec = P2PDistanceInputSpec
     output_spec = P2PDistanceOutputSpec
 
-    def _triangle_area(self, A, B, C):
-        ABxAC = euclidean(A,B) *  euclidean(A,C)
-        prod = np.dot(np.array(B)-np.array(A),np.array(C)-np.array(A))
-        angle = np.arccos( prod / ABxAC )
-        area = 0.5 * ABxAC * np.sin( angle )
-        return area
-
     def _run_interface(self, runtime):
-        from tvtk.api import tvtk
-        r1 = tvtk.PolyDataReader( file_name=self.inputs.surface1 )
-        r2 = tvtk.PolyDataReader( file_name=self.inputs.surface2 )
-        vtk1 = r1.output
-        vtk2 = r2.output
-        r1.update()
-        r2.update()
-        assert( len(vtk1.points) == len(vtk2.points) )
-        d = 0.0
-        totalWeight = 0.0
-
-        points = vtk1.points
-        faces = vtk1.polys.to_array().reshape(-1,4).astype(int)[:,1:]
-
-        for p1,p2 in zip( points, vtk2.points ):
-            weight = 1.0
-            if (self.inputs.weighting == 'surface'):
-                #compute surfaces, set in weight
-                weight = 0.0
-                point_faces = faces[ (faces[:,:]==0).any(axis=1) ]
-
-                for idset in point_faces:
-                    p1 = points[ int(idset[0]) ]
-                    p2 = points[ int(idset[1]) ]
-                    p3 = points[ int(idset[2]) ]
-                    weight = weight + self._triangle_area(p1, p2, p3)
-
-            d+= weight*euclidean( p1, p2 )
-            totalWeight = totalWeight + weight
-
-        self._distance = d / totalWeight
+        points1, faces1 = read_polydata(self.inputs.surface1)
+        points2, _ = read_polydata(self.inputs.surface2)
+        assert(len(points1) == len(points2))
+
+        distances = np.sqrt(((points1 - points2) ** 2).sum(axis=1))
+        if self.inputs.weighting == 'surface':
+            # each vertex is weighted by the area of the faces it belongs to
+            weights = np.bincount(faces1.ravel(),
+                                  weights=np.repeat(_triangle_areas(
+                                      points1, faces1), 3),
+                                  minlength=len(points1))
+        else:
+            weights = np.ones(len(points1))
+
+        self._distance = (weights * distances).sum() / weights.sum()
         return runtime
 
     def _list_outputs(self):
@@ -102,3 +78,105 @@ class P2PDistance(BaseInterface):
         outputs['distance'] = self._distance
         return outputs
 
+
+
+def _triangle_areas(points, faces):
+    """Return the areas of the triangles `faces` of the mesh `points`"""
+    A = points[faces[:, 0]]
+    normals = np.cross(points[faces[:, 1]] - A, points[faces[:, 2]] - A)
+    return 0.5 * np.sqrt((normals ** 2).sum(axis=1))
+
+
+_vtk_types = {'float': 'f4', 'double': 'f8', 'int': 'i4',
+              'unsigned_int': 'u4', 'long': 'i8', 'unsigned_long': 'u8',
+              'short': 'i2', 'unsigned_short': 'u2', 'vtkidtype': 'i4'}
+
+
+def _read_vtk_values(fp, binary, count, dtype):
+    if binary:
+        dtype = np.dtype('>' + dtype)
+        values = np.fromstring(fp.read(count * dtype.itemsize), dtype=dtype)
+        if len(values) != count:
+            raise ValueError('Truncated VTK file')
+        return values
+    values = []
+    while len(values) < count:
+        line = fp.readline()
+        if not line:
+            raise ValueError('Truncated VTK file')
+        values.extend(line.split())
+    if len(values) != count:
+        raise ValueError('Unexpected number of values in VTK file')
+    return np.array(values, dtype=np.float64).astype(dtype)
+
+
+def _read_vtk(filename):
+    """Read the points and triangles of a legacy VTK polydata file
+
+    Raises a ValueError for the files this reader does not handle, such as
+    meshes of polygons that are not all triangles.
+    """
+    fp = open(filename, 'rb')
+    try:
+        if not fp.readline().startswith('# vtk DataFile'):
+            raise ValueError('%s is not a legacy VTK file' % filename)
+        fp.readline()
+        binary = fp.readline().strip().upper() == 'BINARY'
+        points = None
+        faces = np.zeros((0, 3), dtype=int)
+        while True:
+            fields = fp.readline()
+            if not fields:
+                break
+            fields = fields.split()
+            if not fields:
+                continue
+            keyword = fields[0].upper()
+            if keyword == 'DATASET':
+                if fields[1].upper() != 'POLYDATA':
+                    raise ValueError('%s is not a polydata' % filename)
+            elif keyword == 'POINTS':
+                points = _read_vtk_values(fp, binary, 3 * int(fields[1]),
+                                          _vtk_types[fields[2].lower()])
+            elif keyword in ('VERTICES', 'LINES', 'POLYGONS',
+                             'TRIANGLE_STRIPS'):
+                cells = _read_vtk_values(fp, binary, int(fields[2]), 'i4')
+                if keyword == 'POLYGONS':
+                    if (len(cells) != 4 * int(fields[1]) or
+                            (cells[::4] != 3).any()):
+                        raise ValueError('%s has polygons that are not '
+                                         'triangles' % filename)
+                    faces = cells.reshape(-1, 4)[:, 1:].astype(int)
+                elif keyword == 'TRIANGLE_STRIPS':
+                    raise ValueError('%s has triangle strips' % filename)
+            elif keyword in ('POINT_DATA', 'CELL_DATA'):
+                break
+            else:
+                raise ValueError('Unsupported VTK section %s' % keyword)
+    finally:
+        fp.close()
+    if points is None:
+        raise ValueError('%s has no points' % filename)
+    return points.reshape(-1, 3).astype(np.float64), faces
+
+
+def read_polydata(filename):
+    """Read the points and triangles of a VTK polydata file
+
+    Legacy VTK files (ASCII or binary) of triangles are read directly, other
+    files with tvtk.
+
+    Returns the (npoints, 3) array of the coordinates of the points and the
+    (nfaces, 3) array of the indices of the vertices of the triangles.
+    """
+    try:
+        return _read_vtk(filename)
+    except (ValueError, KeyError), e:
+        iflogger.debug('Reading %s with tvtk: %s' % (filename, e))
+    from tvtk.api import tvtk
+    reader = tvtk.PolyDataReader(file_name=filename)
+    reader.update()
+    polydata = reader.output
+    points = np.array(polydata.points, dtype=np.float64)
+    faces = polydata.polys.to_array().reshape(-1, 4).astype(int)[:, 1:]
+    return points, faces
@@ -11,14 +11,18 @@ Miscellaneous algorithms
 
 '''
 
+import gzip
 import os
 import os.path as op
+import shutil
+from tempfile import mkstemp
 
 import nibabel as nb
 import numpy as np
 from math import floor, ceil
 from scipy.ndimage.morphology import grey_dilation
-from scipy.ndimage.morphology import binary_erosion
+from scipy.ndimage.morphology import binary_erosion, distance_transform_edt
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist, euclidean, dice, jaccard
 from scipy.ndimage.measurements import center_of_mass, label
 from scipy.special import legendre
@@ -233,6 +237,14 @@ class DistanceInputSpec(BaseInterfaceInputSpec):
     )
     mask_volume = File(
         exists=True, desc="calculate overlap only within this mask.")
+    algorithm = traits.Enum(
+        "auto", "kdtree", "edt", "brute", usedefault=True, nohash=True,
+        desc='search of the closest points: "kdtree": KD-tree of the points\
+        of volume1, "edt": Euclidean distance transform of volume1 (both\
+        volumes on the same grid, with orthogonal axes), "brute": matrix of\
+        the distances between all the points (validation only), "auto":\
+        "edt" when possible, "kdtree" otherwise'
+    )
 
 
 class DistanceOutputSpec(TraitedSpec):
@@ -264,6 +276,50 @@ class Distance(BaseInterface):
         coordinates = np.dot(affine, indices)
         return coordinates[:3, :]
 
+    def _same_grid(self, data1, nii1, data2, nii2):
+        affine = nii1.get_affine()
+        axes = np.dot(affine[:3, :3].T, affine[:3, :3])
+        return (len(data1.shape) == 3 and data1.shape == data2.shape and
+                np.allclose(affine, nii2.get_affine()) and
+                np.allclose(axes, np.diag(np.diag(axes))))
+
+    def _closest_points(self, data1, nii1, data2, nii2):
+        """Find the closest voxel of data1 of each voxel of data2
+
+        Returns the distances and the coordinates of the closest voxels of
+        data1 and of the voxels of data2, in the order of their indices.
+        """
+        algorithm = self.inputs.algorithm
+        if algorithm == "auto":
+            if self._same_grid(data1, nii1, data2, nii2):
+                algorithm = "edt"
+            else:
+                algorithm = "kdtree"
+
+        set2_coordinates = self._get_coordinates(data2, nii2.get_affine())
+        if algorithm == "edt":
+            if not self._same_grid(data1, nii1, data2, nii2):
+                raise ValueError('The "edt" algorithm requires both volumes '
+                                 'on the same grid, with orthogonal axes')
+            affine = nii1.get_affine()
+            sampling = np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+            distances, indices = distance_transform_edt(
+                np.logical_not(data1), sampling=sampling, return_indices=True)
+            indices = np.vstack([index[data2] for index in indices] +
+                                [np.ones(data2.sum())])
+            return (distances[data2], np.dot(affine, indices)[:3, :],
+                    set2_coordinates)
+
+        set1_coordinates = self._get_coordinates(data1, nii1.get_affine())
+        if algorithm == "kdtree":
+            distances, closest = cKDTree(set1_coordinates.T).query(
+                set2_coordinates.T)
+        else:
+            dist_matrix = cdist(set1_coordinates.T, set2_coordinates.T)
+            closest = np.argmin(dist_matrix, axis=0)
+            distances = dist_matrix[closest, np.arange(len(closest))]
+        return distances, set1_coordinates[:, closest], set2_coordinates
+
     def _eucl_min(self, nii1, nii2):
         origdata1 = nii1.get_data().astype(np.bool)
         border1 = self._find_border(origdata1)
@@ -271,14 +327,11 @@ class Distance(BaseInterface):
         origdata2 = nii2.get_data().astype(np.bool)
         border2 = self._find_border(origdata2)
 
-        set1_coordinates = self._get_coordinates(border1, nii1.get_affine())
-
-        set2_coordinates = self._get_coordinates(border2, nii2.get_affine())
-
-        dist_matrix = cdist(set1_coordinates.T, set2_coordinates.T)
-        (point1, point2) = np.unravel_index(
-            np.argmin(dist_matrix), dist_matrix.shape)
-        return (euclidean(set1_coordinates.T[point1, :], set2_coordinates.T[point2, :]), set1_coordinates.T[point1, :], set2_coordinates.T[point2, :])
+        distances, set1_closest, set2_coordinates = self._closest_points(
+            border1, nii1, border2, nii2)
+        point = np.argmin(distances)
+        return (distances[point], set1_closest[:, point],
+                set2_coordinates[:, point])
 
     def _eucl_cog(self, nii1, nii2):
         origdata1 = nii1.get_data().astype(np.bool)
@@ -307,11 +360,8 @@ class Distance(BaseInterface):
 
         origdata2 = nii2.get_data().astype(np.bool)
 
-        set1_coordinates = self._get_coordinates(border1, nii1.get_affine())
-        set2_coordinates = self._get_coordinates(origdata2, nii2.get_affine())
-
-        dist_matrix = cdist(set1_coordinates.T, set2_coordinates.T)
-        min_dist_matrix = np.amin(dist_matrix, axis=0)
+        min_dist_matrix = self._closest_points(border1, nii1,
+                                               origdata2, nii2)[0]
         import matplotlib.pyplot as plt
         plt.figure()
         plt.hist(min_dist_matrix, 50, normed=1, facecolor='green')
@@ -348,11 +398,9 @@ class Distance(BaseInterface):
         border1 = self._find_border(origdata1)
         border2 = self._find_border(origdata2)
 
-        set1_coordinates = self._get_coordinates(border1, nii1.get_affine())
-        set2_coordinates = self._get_coordinates(border2, nii2.get_affine())
-        distances = cdist(set1_coordinates.T, set2_coordinates.T)
         mins = np.concatenate(
-            (np.amin(distances, axis=0), np.amin(distances, axis=1)))
+            (self._closest_points(border1, nii1, border2, nii2)[0],
+             self._closest_points(border2, nii2, border1, nii1)[0]))
 
         return np.max(mins)
 
@@ -621,6 +669,12 @@ class TSNRInputSpec(BaseInterfaceInputSpec):
     in_file = InputMultiPath(File(exists=True), mandatory=True,
                              desc='realigned 4D file or a list of 3D files')
     regress_poly = traits.Range(low=1, desc='Remove polynomials')
+    slab_size = traits.Range(low=1, nohash=True,
+                             desc=('process the series by slabs of this '
+                                   'number of slices, reading the volumes '
+                                   'from memory-mapped files (.nii.gz files '
+                                   'are first decompressed to the working '
+                                   'directory)'))
 
 
 class TSNROutputSpec(TraitedSpec):
@@ -655,9 +709,30 @@ class TSNR(BaseInterface):
         else:
             return os.path.abspath(base + "_tsnr" + ext)
 
+    def _design(self, timepoints):
+        X = np.ones((timepoints, 1))
+        for i in range(self.inputs.regress_poly):
+            X = np.hstack((X, legendre(
+                i + 1)(np.linspace(-1, 1, timepoints))[:, None]))
+        return X
+
     def _run_interface(self, runtime):
         img = nb.load(self.inputs.in_file[0])
         header = img.get_header().copy()
+        if isdefined(self.inputs.slab_size):
+            meanimg, stddevimg = self._run_slabs(img, header)
+        else:
+            meanimg, stddevimg = self._run_in_memory(img, header)
+        tsnr = meanimg / stddevimg
+        img = nb.Nifti1Image(tsnr, img.get_affine(), header)
+        nb.save(img, self._gen_output_file_name())
+        img = nb.Nifti1Image(meanimg, img.get_affine(), header)
+        nb.save(img, self._gen_output_file_name('mean'))
+        img = nb.Nifti1Image(stddevimg, img.get_affine(), header)
+        nb.save(img, self._gen_output_file_name('stddev'))
+        return runtime
+
+    def _run_in_memory(self, img, header):
         vollist = [nb.load(filename) for filename in self.inputs.in_file]
         data = np.concatenate([vol.get_data().reshape(
             vol.get_shape()[:3] + (-1,)) for vol in vollist], axis=3)
@@ -666,10 +741,7 @@ class TSNR(BaseInterface):
             data = data.astype(np.float32)
         if isdefined(self.inputs.regress_poly):
             timepoints = img.get_shape()[-1]
-            X = np.ones((timepoints, 1))
-            for i in range(self.inputs.regress_poly):
-                X = np.hstack((X, legendre(
-                    i + 1)(np.linspace(-1, 1, timepoints))[:, None]))
+            X = self._design(timepoints)
             betas = np.dot(np.linalg.pinv(X), np.rollaxis(data, 3, 2))
             datahat = np.rollaxis(np.dot(X[:, 1:],
                                          np.rollaxis(
@@ -680,14 +752,113 @@ class TSNR(BaseInterface):
             nb.save(img, self._gen_output_file_name('detrended'))
         meanimg = np.mean(data, axis=3)
         stddevimg = np.std(data, axis=3)
-        tsnr = meanimg / stddevimg
-        img = nb.Nifti1Image(tsnr, img.get_affine(), header)
-        nb.save(img, self._gen_output_file_name())
-        img = nb.Nifti1Image(meanimg, img.get_affine(), header)
-        nb.save(img, self._gen_output_file_name('mean'))
-        img = nb.Nifti1Image(stddevimg, img.get_affine(), header)
-        nb.save(img, self._gen_output_file_name('stddev'))
-        return runtime
+        return meanimg, stddevimg
+
+    def _volumes(self, tempfiles):
+        """Return the (data, index) of the volumes of the series
+
+        data are the image data of a file, as a proxy when nibabel supports
+        it (slices of a proxy are read and scaled on demand), and index is
+        the index of the volume in a 4D file, None for a 3D file.
+
+        Reading a slice of a compressed file decompresses the file up to
+        it, so .nii.gz files are decompressed once to the working directory
+        and the names of the decompressed files are appended to
+        `tempfiles`.
+        """
+        volumes = []
+        for filename in self.inputs.in_file:
+            if filename.lower().endswith('.nii.gz'):
+                fd, tmpfile = mkstemp(suffix='.nii', dir=os.getcwd())
+                tempfiles.append(tmpfile)
+                out_file = os.fdopen(fd, 'wb')
+                in_file = gzip.open(filename, 'rb')
+                shutil.copyfileobj(in_file, out_file, 1024 * 1024)
+                in_file.close()
+                out_file.close()
+                filename = tmpfile
+            elif filename.lower().endswith('gz'):
+                iflogger.warn('%s is compressed and is decompressed again '
+                              'for each slab' % filename)
+            vol = nb.load(filename)
+            data = getattr(vol, 'dataobj', None)
+            if data is None:
+                data = vol.get_data()  # a memmap for uncompressed files
+            shape = vol.get_shape()
+            if len(shape) == 3:
+                volumes.append((data, None))
+            else:
+                volumes.extend([(data, t) for t in range(shape[3])])
+        return volumes
+
+    def _run_slabs(self, img, header):
+        """Compute the mean and standard deviation slab by slab
+
+        The slices of a slab are read one volume at a time and the mean and
+        variance are accumulated in one pass (Welford). With regress_poly,
+        a first pass over the volumes accumulates the betas of the slab and
+        the detrended volumes are written to a memory-mapped array, which is
+        saved at the end. The memory used is proportional to the size of a
+        slab, whatever the number of volumes.
+        """
+        if header.get_data_dtype().kind in 'iu':
+            header.set_data_dtype(np.float32)
+        shape = img.get_shape()[:3]
+        meanimg = np.zeros(shape)
+        stddevimg = np.zeros(shape)
+        regress = isdefined(self.inputs.regress_poly)
+        tempfiles = []
+        # the temporary files are removed even if the run fails
+        try:
+            volumes = self._volumes(tempfiles)
+            timepoints = len(volumes)
+            if regress:
+                X = self._design(timepoints)
+                pinvX = np.linalg.pinv(X)
+                fd, mmapfile = mkstemp(suffix='.dat', dir=os.getcwd())
+                os.close(fd)
+                tempfiles.append(mmapfile)
+                detrended = np.memmap(mmapfile, dtype=header.get_data_dtype(),
+                                      mode='w+', shape=shape + (timepoints,),
+                                      order='F')
+
+            for start in range(0, shape[2], self.inputs.slab_size):
+                stop = min(start + self.inputs.slab_size, shape[2])
+                slab_shape = (shape[0], shape[1], stop - start)
+
+                def read_slab(t):
+                    data, index = volumes[t]
+                    if index is None:
+                        return np.asarray(data[:, :, start:stop], np.float64)
+                    return np.asarray(data[:, :, start:stop, index],
+                                      np.float64)
+
+                if regress:
+                    betas = np.zeros((X.shape[1],) + slab_shape)
+                    for t in range(timepoints):
+                        betas += pinvX[:, t, None, None, None] * read_slab(t)
+                mean = np.zeros(slab_shape)
+                m2 = np.zeros(slab_shape)
+                for t in range(timepoints):
+                    slab = read_slab(t)
+                    if regress:
+                        slab -= np.tensordot(X[t, 1:], betas[1:], axes=1)
+                        detrended[:, :, start:stop, t] = slab
+                    delta = slab - mean
+                    mean += delta / (t + 1)
+                    m2 += delta * (slab - mean)
+                meanimg[:, :, start:stop] = mean
+                stddevimg[:, :, start:stop] = np.sqrt(m2 / timepoints)
+
+            if regress:
+                detrended.flush()
+                nb.save(nb.Nifti1Image(detrended, img.get_affine(), header),
+                        self._gen_output_file_name('detrended'))
+                del detrended
+        finally:
+            for tmpfile in tempfiles:
+                os.remove(tmpfile)
+        return meanimg, stddevimg
 
     def _list_outputs(self):
         outputs = self._outputs().get()
@@ -20,6 +20,7 @@ These functions include:
 
 import os
 from copy import deepcopy
+from multiprocessing import Pool, current_process
 from warnings import warn
 
 from nibabel import load, funcs, Nifti1Image
@@ -151,6 +152,45 @@ def _nanmean(a, axis=None):
         return np.nansum(a) / np.sum(1 - np.isnan(a))
 
 
+def _column_nanmeans(a):
+    """Return the _nanmean of each column of the 2D array a
+
+    As _nanmean, integer data are averaged with an integer division.
+
+    >>> _column_nanmeans(np.array([[1, 2.], [2, np.nan]])).tolist()
+    [1.5, 2.0]
+
+    """
+    if a.dtype.kind in 'iub':
+        return np.sum(a, axis=0) / a.shape[0]
+    # sum the contiguous columns as _nanmean sums a volume
+    a = np.asfortranarray(a)
+    return np.nansum(a, axis=0) / np.sum(np.logical_not(np.isnan(a)), axis=0)
+
+
+def _c_order_index(mask):
+    """Return the indices of the voxels of the 3D mask in the volumes
+    yielded by _volume_chunks, in the (C) order of mask indexing
+    """
+    return np.ravel_multi_index(np.nonzero(mask), mask.shape, order='F')
+
+
+def _volume_chunks(data, size=2 ** 24):
+    """Iterate over the volumes of the 4D data by chunks
+
+    Yields (start, stop, volumes) where volumes is the (voxels, stop - start)
+    array of the volumes start to stop, in Fortran order: with data mapped
+    from a file, the volumes of a chunk are read when needed and the chunks
+    hold up to `size` values.
+    """
+    timepoints = data.shape[3]
+    step = max(1, size / int(np.prod(data.shape[:3])))
+    for start in range(0, timepoints, step):
+        stop = min(start + step, timepoints)
+        vols = np.asarray(data[:, :, :, start:stop])
+        yield start, stop, vols.reshape((-1, stop - start), order='F')
+
+
 class ArtifactDetectInputSpec(BaseInterfaceInputSpec):
     realigned_files = InputMultiPath(File(exists=True),
                                 desc="Names of realigned functional data files",
@@ -213,6 +253,10 @@ class ArtifactDetectInputSpec(BaseInterfaceInputSpec):
     global_threshold = traits.Float(8.0, desc=("use this threshold when mask "
                                                "type equal's spm_global"),
                                     usedefault=True)
+    n_procs = traits.Int(1, usedefault=True, nohash=True,
+                         desc=("number of processes analysing the runs; the "
+                               "plots are saved once all the runs are "
+                               "analysed"))
 
 
 class ArtifactDetectOutputSpec(TraitedSpec):
@@ -239,6 +283,10 @@ class ArtifactDetectOutputSpec(TraitedSpec):
     displacement_files = OutputMultiPath(File,
             desc=("One image file for each functional run containing the voxel"
                   "displacement timeseries"))
+    outlier_table = File(exists=True,
+            desc=("Table of the outliers of all the runs: run and volume "
+                  "(0-based) and whether it is an intensity and a motion "
+                  "outlier"))
 
 
 class ArtifactDetect(BaseInterface):
@@ -248,6 +296,10 @@ class ArtifactDetect(BaseInterface):
     True, it computes the movement of the center of each face a cuboid centered
     around the head and returns the maximal movement across the centers.
 
+    Many runs (e.g., of several subjects) can be analysed by a single
+    interface, in a pool of `n_procs` processes. The outliers of all the runs
+    are listed in `outlier_table`.
+
 
     Examples
     --------
@@ -328,6 +380,8 @@ class ArtifactDetect(BaseInterface):
                     outputs['displacement_files'].insert(i, displacementfile)
             if isdefined(self.inputs.save_plot) and self.inputs.save_plot:
                 outputs['plot_files'].insert(i, plotfile)
+        outputs['outlier_table'] = os.path.join(os.getcwd(),
+                                                'art_outlier_table.txt')
         return outputs
 
     def _plot_outliers_with_wave(self, wave, outliers, name):
@@ -370,41 +424,45 @@ class ArtifactDetect(BaseInterface):
             iflogger.debug('art: using spm global')
             intersect_mask = self.inputs.intersect_mask
             if intersect_mask:
-                mask = np.ones((x, y, z), dtype=bool)
-                for t0 in range(timepoints):
-                    vol = data[:, :, :, t0]
+                mask = np.ones(x * y * z, dtype=bool)
+                for _, _, vols in _volume_chunks(data):
                     # Use an SPM like approach
-                    mask_tmp = vol > \
-                               (_nanmean(vol) / self.inputs.global_threshold)
-                    mask = mask * mask_tmp
-                for t0 in range(timepoints):
-                    vol = data[:, :, :, t0]
-                    g[t0] = _nanmean(vol[mask])
+                    mask &= (vols > (_column_nanmeans(vols) /
+                                     self.inputs.global_threshold)).all(axis=1)
+                mask = mask.reshape((x, y, z), order='F')
+                maskidx = _c_order_index(mask)
+                for start, stop, vols in _volume_chunks(data):
+                    g[start:stop, 0] = _column_nanmeans(vols[maskidx])
                 if len(find_indices(mask)) < (np.prod((x, y, z)) / 10):
                     intersect_mask = False
                     g = np.zeros((timepoints, 1))
             if not intersect_mask:
                 iflogger.info('not intersect_mask is True')
-                mask = np.zeros((x, y, z, timepoints))
-                for t0 in range(timepoints):
-                    vol = data[:, :, :, t0]
-                    mask_tmp = vol > \
-                                 (_nanmean(vol) / self.inputs.global_threshold)
-                    mask[:, :, :, t0] = mask_tmp
-                    g[t0] = np.nansum(vol * mask_tmp)/np.nansum(mask_tmp)
+                mask = np.zeros((x * y * z, timepoints), dtype=np.uint8)
+                for start, stop, vols in _volume_chunks(data):
+                    mask_tmp = vols > (_column_nanmeans(vols) /
+                                       self.inputs.global_threshold)
+                    mask[:, start:stop] = mask_tmp
+                    g[start:stop, 0] = (
+                        np.nansum(np.where(mask_tmp, vols, 0), axis=0) /
+                        np.sum(mask_tmp, axis=0))
+                mask = mask.reshape((x, y, z, timepoints), order='F')
         elif masktype == 'file':  # uses a mask image to determine intensity
             maskimg = load(self.inputs.mask_file)
             mask = maskimg.get_data()
             affine = maskimg.get_affine()
             mask = mask > 0.5
-            for t0 in range(timepoints):
-                vol = data[:, :, :, t0]
-                g[t0] = _nanmean(vol[mask])
+            maskidx = _c_order_index(mask)
+            for start, stop, vols in _volume_chunks(data):
+                g[start:stop, 0] = _column_nanmeans(vols[maskidx])
         elif masktype == 'thresh':  # uses a fixed signal threshold
-            for t0 in range(timepoints):
-                vol = data[:, :, :, t0]
-                mask = vol > self.inputs.mask_threshold
-                g[t0] = _nanmean(vol[mask])
+            voxelidx = _c_order_index(np.ones((x, y, z), dtype=bool))
+            for start, stop, vols in _volume_chunks(data):
+                vols = vols[voxelidx].T
+                mask = vols > self.inputs.mask_threshold
+                g[start:stop, 0] = [_nanmean(vol[volmask]) for vol, volmask
+                                    in zip(vols, mask)]
+            mask = mask[-1].reshape((x, y, z))
         else:
             mask = np.ones((x, y, z))
             g = _nanmean(data[mask > 0, :], 1)
@@ -444,11 +502,10 @@ class ArtifactDetect(BaseInterface):
             tidx = find_indices(normval > self.inputs.norm_threshold)
             ridx = find_indices(normval < 0)
             if displacement is not None:
-                dmap = np.zeros((x, y, z, timepoints), dtype=np.float)
-                for i in range(timepoints):
-                    dmap[voxel_coords[0],
-                         voxel_coords[1],
-                         voxel_coords[2], i] = displacement[i, :]
+                dmap = np.zeros((x, y, z, timepoints), dtype=np.float32)
+                dmap[voxel_coords[0],
+                     voxel_coords[1],
+                     voxel_coords[2], :] = displacement.T
                 dimg = Nifti1Image(dmap, affine)
                 dimg.to_filename(displacementfile)
         else:
@@ -472,32 +529,11 @@ class ArtifactDetect(BaseInterface):
         if self.inputs.use_norm:
             np.savetxt(normfile, normval, fmt='%.4f', delimiter=' ')
 
-        if isdefined(self.inputs.save_plot) and self.inputs.save_plot:
-            import matplotlib
-            matplotlib.use(config.get("execution", "matplotlib_backend"))
-            import matplotlib.pyplot as plt
-            fig = plt.figure()
-            if isdefined(self.inputs.use_norm) and self.inputs.use_norm:
-                plt.subplot(211)
-            else:
-                plt.subplot(311)
-            self._plot_outliers_with_wave(gz, iidx, 'Intensity')
-            if isdefined(self.inputs.use_norm) and self.inputs.use_norm:
-                plt.subplot(212)
-                self._plot_outliers_with_wave(normval, np.union1d(tidx, ridx),
-                                              'Norm (mm)')
-            else:
-                diff = ''
-                if self.inputs.use_differences[0]:
-                    diff = 'diff'
-                plt.subplot(312)
-                self._plot_outliers_with_wave(traval, tidx,
-                                              'Translation (mm)' + diff)
-                plt.subplot(313)
-                self._plot_outliers_with_wave(rotval, ridx,
-                                              'Rotation (rad)' + diff)
-            plt.savefig(plotfile)
-            plt.close(fig)
+        if not self.inputs.use_norm:
+            normval = None
+        else:
+            traval = rotval = None
+        plot = (plotfile, gz, iidx, normval, traval, rotval, tidx, ridx)
 
         motion_outliers = np.union1d(tidx, ridx)
         stats = [{'motion_file': motionfile,
@@ -528,18 +564,82 @@ class ArtifactDetect(BaseInterface):
                                   'std': np.std(normval, axis=0).tolist(),
                                   }})
         save_json(statsfile, stats)
+        return iidx, motion_outliers, plot
+
+    def _plot_outliers(self, plotfile, gz, iidx, normval, traval, rotval,
+                       tidx, ridx):
+        import matplotlib
+        matplotlib.use(config.get("execution", "matplotlib_backend"))
+        import matplotlib.pyplot as plt
+        fig = plt.figure()
+        if isdefined(self.inputs.use_norm) and self.inputs.use_norm:
+            plt.subplot(211)
+        else:
+            plt.subplot(311)
+        self._plot_outliers_with_wave(gz, iidx, 'Intensity')
+        if isdefined(self.inputs.use_norm) and self.inputs.use_norm:
+            plt.subplot(212)
+            self._plot_outliers_with_wave(normval, np.union1d(tidx, ridx),
+                                          'Norm (mm)')
+        else:
+            diff = ''
+            if self.inputs.use_differences[0]:
+                diff = 'diff'
+            plt.subplot(312)
+            self._plot_outliers_with_wave(traval, tidx,
+                                          'Translation (mm)' + diff)
+            plt.subplot(313)
+            self._plot_outliers_with_wave(rotval, ridx,
+                                          'Rotation (rad)' + diff)
+        plt.savefig(plotfile)
+        plt.close(fig)
+
+    def _write_outlier_table(self, filename, runs):
+        """Write the outliers of all the runs to a single table"""
+        fp = open(filename, 'wt')
+        fp.write('run\tvolume\tintensity\tmotion\n')
+        for i, (iidx, motion_outliers, _) in enumerate(runs):
+            for volume in np.union1d(iidx, motion_outliers):
+                fp.write('%d\t%d\t%d\t%d\n' % (i, volume,
+                                                volume in iidx,
+                                                volume in motion_outliers))
+        fp.close()
 
     def _run_interface(self, runtime):
         """Execute this module.
+
+        With n_procs > 1, the runs are analysed by a pool of processes. The
+        plots are saved by this process once all the runs are analysed.
         """
         funcfilelist = filename_to_list(self.inputs.realigned_files)
         motparamlist = filename_to_list(self.inputs.realignment_parameters)
-        for i, imgf in enumerate(funcfilelist):
-            self._detect_outliers_core(imgf, motparamlist[i], i,
-                                       cwd=os.getcwd())
+        args = [(self, imgf, motparamlist[i], i, os.getcwd())
+                for i, imgf in enumerate(funcfilelist)]
+        n_procs = min(self.inputs.n_procs, len(args))
+        if n_procs > 1 and not current_process().daemon:
+            pool = Pool(processes=n_procs)
+            try:
+                runs = pool.map(_detect_outliers_run, args)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            runs = map(_detect_outliers_run, args)
+        if isdefined(self.inputs.save_plot) and self.inputs.save_plot:
+            for _, _, plot in runs:
+                self._plot_outliers(*plot)
+        self._write_outlier_table(os.path.join(os.getcwd(),
+                                               'art_outlier_table.txt'), runs)
         return runtime
 
 
+def _detect_outliers_run(args):
+    """Detect the outliers of a run (in a process of a pool)"""
+    interface, imgfile, motionfile, runidx, cwd = args
+    return interface._detect_outliers_core(imgfile, motionfile, runidx,
+                                           cwd=cwd)
+
+
 class StimCorrInputSpec(BaseInterfaceInputSpec):
     realignment_parameters = InputMultiPath(File(exists=True), mandatory=True,
         desc=('Names of realignment parameters corresponding to the functional '
@@ -40,6 +40,9 @@ def test_ArtifactDetect_inputs():
     ),
     mask_file=dict(),
     intersect_mask=dict(),
+    n_procs=dict(nohash=True,
+    usedefault=True,
+    ),
     realignment_parameters=dict(mandatory=True,
     ),
     )
@@ -56,6 +59,7 @@ def test_ArtifactDetect_outputs():
     norm_files=dict(),
     statistic_files=dict(),
     plot_files=dict(),
+    outlier_table=dict(),
     )
     outputs = ArtifactDetect.output_spec()
 
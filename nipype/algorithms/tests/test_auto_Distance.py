@@ -2,7 +2,10 @@
 from nipype.testing import assert_equal
 from nipype.algorithms.misc import Distance
 def test_Distance_inputs():
-    input_map = dict(ignore_exception=dict(nohash=True,
+    input_map = dict(algorithm=dict(nohash=True,
+    usedefault=True,
+    ),
+    ignore_exception=dict(nohash=True,
     usedefault=True,
     ),
     volume1=dict(mandatory=True,
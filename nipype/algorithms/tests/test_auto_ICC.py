@@ -2,11 +2,17 @@
 from nipype.testing import assert_equal
 from nipype.algorithms.icc import ICC
 def test_ICC_inputs():
-    input_map = dict(ignore_exception=dict(nohash=True,
+    input_map = dict(chunk_size=dict(nohash=True,
+    usedefault=True,
+    ),
+    ignore_exception=dict(nohash=True,
     usedefault=True,
     ),
     mask=dict(mandatory=True,
     ),
+    num_threads=dict(nohash=True,
+    usedefault=True,
+    ),
     subjects_sessions=dict(mandatory=True,
     ),
     )
@@ -18,6 +24,7 @@ def test_ICC_inputs():
 def test_ICC_outputs():
     output_map = dict(session_var_map=dict(),
     icc_map=dict(),
+    sessions_F_map=dict(),
     subject_var_map=dict(),
     )
     outputs = ICC.output_spec()
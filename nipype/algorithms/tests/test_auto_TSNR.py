@@ -8,6 +8,8 @@ def test_TSNR_inputs():
     regress_poly=dict(),
     in_file=dict(mandatory=True,
     ),
+    slab_size=dict(nohash=True,
+    ),
     )
     inputs = TSNR.input_spec()
 
@@ -0,0 +1,70 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from nibabel import Nifti1Image
+import numpy as np
+
+from nipype.testing import assert_equal, assert_raises, assert_almost_equal
+from nipype.algorithms.misc import Distance
+
+
+def _volumes(tempdir, affine2):
+    # orthogonal axes with anisotropic voxels and a flip
+    affine = np.array([[0., -2., 0., 10.],
+                       [1.5, 0., 0., -4.],
+                       [0., 0., 3., 1.],
+                       [0., 0., 0., 1.]])
+    grid = np.indices((16, 14, 12))
+    sphere = ((grid - np.array([7, 6, 5])[:, None, None, None]) ** 2
+              ).sum(axis=0) < 16
+    box = np.zeros(grid.shape[1:])
+    box[9:14, 2:9, 3:10] = np.random.rand(5, 7, 7) + 0.5
+    filename1 = os.path.join(tempdir, 'sphere.nii')
+    filename2 = os.path.join(tempdir, 'box.nii')
+    Nifti1Image(sphere.astype(np.uint8), affine).to_filename(filename1)
+    Nifti1Image(box, affine2 if affine2 is not None else affine
+                ).to_filename(filename2)
+    return filename1, filename2
+
+
+def test_distance_algorithms():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    np.random.seed(0)
+    rotated = np.eye(4)
+    rotated[:2, :2] = [[0.8, -0.6], [0.6, 0.8]]
+    for affine2 in [None, rotated]:
+        volume1, volume2 = _volumes(tempdir, affine2)
+        for method in ['eucl_min', 'eucl_max']:
+            expected = Distance(volume1=volume1, volume2=volume2,
+                                method=method, algorithm='brute').run()
+            for algorithm in ['auto', 'kdtree']:
+                res = Distance(volume1=volume1, volume2=volume2,
+                               method=method, algorithm=algorithm).run()
+                yield (assert_almost_equal, res.outputs.distance,
+                       expected.outputs.distance)
+        distance = Distance(volume1=volume1, volume2=volume2)
+        closest = {}
+        for algorithm in ['brute', 'kdtree', 'edt']:
+            distance.inputs.algorithm = algorithm
+            nii1 = Nifti1Image.load(volume1)
+            nii2 = Nifti1Image.load(volume2)
+            data1 = distance._find_border(nii1.get_data().astype(np.bool))
+            data2 = nii2.get_data().astype(np.bool)
+            if affine2 is not None and algorithm == 'edt':
+                yield (assert_raises, ValueError, distance._closest_points,
+                       data1, nii1, data2, nii2)
+                continue
+            closest[algorithm] = distance._closest_points(data1, nii1,
+                                                          data2, nii2)
+        for algorithm, (dists, points1, points2) in closest.items():
+            yield assert_almost_equal, dists, closest['brute'][0]
+            yield (assert_almost_equal,
+                   np.sqrt(((points1 - points2) ** 2).sum(axis=0)), dists)
+            yield assert_equal, points2.shape, (3, data2.sum())
+    os.chdir(cwd)
+    rmtree(tempdir)
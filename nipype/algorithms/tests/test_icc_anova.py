@@ -1,6 +1,7 @@
 import numpy as np
-from nipype.testing import assert_equal
-from nipype.algorithms.icc import ICC_rep_anova
+from nipype.testing import assert_equal, assert_almost_equal
+from nipype.algorithms.icc import (ICC_rep_anova, ICC_rep_anova_batch,
+                                   ICC_rep_anova_chunked)
 
 
 def test_ICC_rep_anova():
@@ -19,3 +20,15 @@ def test_ICC_rep_anova():
     yield assert_equal, dfc, 3
     yield assert_equal, dfe, 15
     yield assert_equal, r_var/(r_var + e_var), icc
+
+
+def test_ICC_rep_anova_batch():
+    np.random.seed(0)
+    Y = np.random.randn(50, 8, 3) + np.random.randn(50, 8, 1)
+    expected = np.array([ICC_rep_anova(y)[:4] for y in Y])
+    for chunk_size, num_threads in [(50, 1), (7, 1), (7, 3)]:
+        values = ICC_rep_anova_chunked(Y, chunk_size, num_threads)
+        yield assert_almost_equal, np.hstack(values[:4]), expected
+        yield assert_equal, values[4:], (2, 14)
+    icc, r_var, e_var, session_F, dfc, dfe = ICC_rep_anova_batch(Y[:1])
+    yield assert_almost_equal, icc[0], expected[0, 0]
@@ -0,0 +1,58 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+
+from nipype.testing import assert_equal, assert_almost_equal
+from nipype.algorithms.mesh import P2PDistance, read_polydata
+
+
+def _write_vtk(filename, points, faces, binary=False):
+    fp = open(filename, 'wb')
+    fp.write('# vtk DataFile Version 3.0\ntest\n%s\nDATASET POLYDATA\n' %
+             ('BINARY' if binary else 'ASCII'))
+    fp.write('POINTS %d float\n' % len(points))
+    cells = np.hstack((3 * np.ones((len(faces), 1)), faces))
+    if binary:
+        fp.write(points.astype('>f4').tostring() + '\n')
+        fp.write('POLYGONS %d %d\n' % (len(faces), cells.size))
+        fp.write(cells.astype('>i4').tostring() + '\n')
+    else:
+        for point in points:
+            fp.write('%f %f %f\n' % tuple(point))
+        fp.write('POLYGONS %d %d\n' % (len(faces), cells.size))
+        for cell in cells:
+            fp.write('%d %d %d %d\n' % tuple(cell))
+    fp.write('POINT_DATA %d\n' % len(points))
+    fp.close()
+
+
+def test_p2p_distance():
+    tempdir = mkdtemp()
+    # a unit square and a large triangle sharing the edge (1, 2)
+    points = np.array([[0., 0., 0.], [1., 0., 0.], [0., 1., 0.],
+                       [1., 1., 0.], [3., 3., 0.]])
+    faces = np.array([[0, 1, 2], [1, 3, 2], [1, 4, 2]])
+    moved = points.copy()
+    moved[:, 2] = [1., 2., 3., 4., 5.]
+    for binary in [False, True]:
+        surface1 = os.path.join(tempdir, 'surf1_%d.vtk' % binary)
+        surface2 = os.path.join(tempdir, 'surf2_%d.vtk' % binary)
+        _write_vtk(surface1, points, faces, binary)
+        _write_vtk(surface2, moved, faces, binary)
+        read_points, read_faces = read_polydata(surface1)
+        yield assert_almost_equal, read_points, points
+        yield assert_equal, read_faces.tolist(), faces.tolist()
+
+        res = P2PDistance(surface1=surface1, surface2=surface2).run()
+        yield assert_almost_equal, res.outputs.distance, 3.
+        res = P2PDistance(surface1=surface1, surface2=surface2,
+                          weighting='surface').run()
+        # areas of the faces: 0.5, 0.5, 2.5; each vertex gets its faces' areas
+        weights = np.array([0.5, 3.5, 3.5, 0.5, 2.5])
+        yield (assert_almost_equal, res.outputs.distance,
+               (weights * moved[:, 2]).sum() / weights.sum())
+    rmtree(tempdir)
@@ -110,3 +110,17 @@ def test_modelgen_sparse():
     yield assert_almost_equal, res.outputs.session_info[0]['regress'][0]['val'][0], 0.016675298129743384
     yield assert_almost_equal, res.outputs.session_info[1]['regress'][1]['val'][5], 0.007671459162258378
     rmtree(tempdir)
+
+
+def test_modelgen_sparse_events():
+    s = SpecifySparseModel(time_repetition=6, time_acquisition=2,
+                           stimuli_as_impulses=False, scale_regressors=False)
+    # scans are acquired 0-2 s, 6-8 s, ...; a duration of 0 lasts one TA and
+    # the last event is truncated at the end of the run (56 s)
+    reg = s._gen_regress([18, 19, 42, 42, 55], [2, 0, 2, 2, 2], None, 10)
+    yield assert_almost_equal, reg, [0, 0, 0, 1.5, 0, 0, 0, 2, 0, 0.5]
+    reg = s._gen_regress([18, 42], [2], [3, 0.5], 10)
+    yield assert_almost_equal, reg, [0, 0, 0, 3, 0, 0, 0, 0.5, 0, 0]
+    s.inputs.stimuli_as_impulses = True
+    reg = s._gen_regress([18, 18, 43], [2], None, 10)
+    yield assert_almost_equal, reg, [0, 0, 0, 0.2, 0, 0, 0, 0.1, 0, 0]
@@ -1,5 +1,10 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from nibabel import Nifti1Image
 from nipype.testing import (assert_equal, assert_false, assert_true,
                             assert_almost_equal)
 import nipype.algorithms.rapidart as ra
@@ -84,3 +89,60 @@ def test_sc_output_filenames():
     f = 'motion.nii'
     corrfile = sc._get_output_filenames(f, outputdir)
     yield assert_equal, corrfile, '/tmp/qa.motion_stimcorr.txt'
+
+
+def test_ad_volume_chunks():
+    np.random.seed(0)
+    data = np.asfortranarray(np.random.rand(5, 4, 3, 7).astype(np.float32))
+    data[1, 2, 0, 3] = np.nan
+    mask = data[:, :, :, 0] > 0.5
+    maskidx = ra._c_order_index(mask)
+    for size in [60, 200, 2 ** 24]:
+        chunks = list(ra._volume_chunks(data, size))
+        yield assert_equal, chunks[-1][1], 7
+        for start, stop, vols in chunks:
+            yield assert_equal, vols.shape, (60, stop - start)
+            means = ra._column_nanmeans(vols[maskidx])
+            for t in range(start, stop):
+                yield (assert_equal, means[t - start],
+                       ra._nanmean(data[:, :, :, t][mask]))
+    intdata = (data * 100).astype(np.int16)
+    vols = list(ra._volume_chunks(intdata))[0][2]
+    yield (assert_equal, ra._column_nanmeans(vols).tolist(),
+           [ra._nanmean(intdata[:, :, :, t]) for t in range(7)])
+
+
+def test_ad_batch():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    np.random.seed(0)
+    funcfiles = []
+    parfiles = []
+    for run in range(3):
+        data = (100 + 20 * np.random.rand(10, 9, 8, 30)).astype(np.float32)
+        data[..., 7 + run] *= 1.5
+        funcfiles.append(os.path.join(tempdir, 'run%d.nii' % run))
+        Nifti1Image(data, np.eye(4)).to_filename(funcfiles[-1])
+        parfiles.append(os.path.join(tempdir, 'run%d.par' % run))
+        np.savetxt(parfiles[-1], 0.0005 * np.random.randn(30, 6))
+    outputs = {}
+    for n_procs in [1, 2]:
+        os.mkdir(os.path.join(tempdir, str(n_procs)))
+        os.chdir(os.path.join(tempdir, str(n_procs)))
+        ad = ra.ArtifactDetect(realigned_files=funcfiles,
+                               realignment_parameters=parfiles,
+                               parameter_source='FSL', mask_type='spm_global',
+                               norm_threshold=1, zintensity_threshold=3,
+                               save_plot=False, n_procs=n_procs)
+        res = ad.run()
+        outputs[n_procs] = [open(filename).read() for filename in
+                            res.outputs.outlier_files +
+                            res.outputs.intensity_files +
+                            [res.outputs.outlier_table]]
+    yield assert_equal, outputs[1], outputs[2]
+    yield assert_equal, outputs[1][0].split(), ['7']
+    yield (assert_equal, outputs[1][-1].splitlines(),
+           ['run\tvolume\tintensity\tmotion', '0\t7\t1\t0',
+            '1\t8\t1\t0', '2\t9\t1\t0'])
+    os.chdir(cwd)
+    rmtree(tempdir)
@@ -0,0 +1,75 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import nibabel as nb
+import numpy as np
+
+from nipype.testing import assert_equal, assert_almost_equal, assert_raises
+from nipype.algorithms.misc import TSNR
+
+
+def _outputs(res):
+    files = [res.outputs.tsnr_file, res.outputs.mean_file,
+             res.outputs.stddev_file]
+    if os.path.exists(str(res.outputs.detrended_file)):
+        files.append(res.outputs.detrended_file)
+    return [nb.load(filename).get_data() for filename in files]
+
+
+def test_tsnr_slabs():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    np.random.seed(0)
+    timeseries = (1000 + 50 * np.random.randn(6, 5, 7, 30) +
+                  np.linspace(0, 100, 30)).astype(np.int16)
+    nb.Nifti1Image(timeseries, np.eye(4)).to_filename('func.nii')
+    for regress_poly in [None, 2]:
+        tsnr = TSNR(in_file='func.nii')
+        if regress_poly:
+            tsnr.inputs.regress_poly = regress_poly
+        expected = _outputs(tsnr.run())
+        for filename in os.listdir(tempdir):
+            if filename != 'func.nii':
+                os.remove(filename)
+        tsnr.inputs.slab_size = 3
+        outputs = _outputs(tsnr.run())
+        yield assert_equal, len(outputs), len(expected)
+        for output, value in zip(outputs, expected):
+            yield assert_almost_equal, output / value, 1, 4
+        yield assert_equal, [filename for filename in os.listdir(tempdir)
+                             if filename.endswith('.dat')], []
+
+    # a compressed series is decompressed once to the working directory
+    expected = _outputs(TSNR(in_file='func.nii', regress_poly=2).run())
+    nb.Nifti1Image(timeseries, np.eye(4)).to_filename('func.nii.gz')
+    before = sorted(os.listdir(tempdir))
+    outputs = _outputs(TSNR(in_file='func.nii.gz', regress_poly=2,
+                            slab_size=3).run())
+    for output, value in zip(outputs, expected):
+        yield assert_almost_equal, output / value, 1, 4
+    yield assert_equal, sorted(filename for filename in os.listdir(tempdir)
+                               if not filename.startswith('func_')), \
+        sorted(filename for filename in before
+               if not filename.startswith('func_'))
+
+    # a series of 3D files
+    files = []
+    for t in range(timeseries.shape[3]):
+        files.append('vol%02d.nii' % t)
+        nb.Nifti1Image(timeseries[..., t], np.eye(4)).to_filename(files[-1])
+    outputs = _outputs(TSNR(in_file=files, slab_size=4).run())
+    yield assert_almost_equal, outputs[1] / timeseries.mean(axis=3), 1, 4
+    yield assert_almost_equal, outputs[2] / timeseries.std(axis=3), 1, 4
+
+    # the memory-mapped file is removed when the run fails
+    nb.Nifti1Image(timeseries[:, :4, :, 0], np.eye(4)).to_filename(files[-1])
+    yield assert_raises, ValueError, TSNR(in_file=files, slab_size=4,
+                                          regress_poly=1).run
+    yield assert_equal, [filename for filename in os.listdir(tempdir)
+                         if filename.endswith('.dat')], []
+    os.chdir(cwd)
+    rmtree(tempdir)
@@ -9,4 +9,10 @@ __docformat__ = 'restructuredtext'
 
 from io import DataGrabber, DataSink, SelectFiles
 from utility import IdentityInterface, Rename, Function, Select, Merge
-import fsl, spm, freesurfer, afni, ants, slicer, dipy, nipy, mrtrix, camino
+from ..utils.lazy import lazy_modules
+
+# the interface packages are imported when first used, see nipype.utils.lazy
+(fsl, spm, freesurfer, afni, ants, slicer, dipy, nipy, mrtrix,
+ camino) = lazy_modules(__name__, ['fsl', 'spm', 'freesurfer', 'afni', 'ants',
+                                   'slicer', 'dipy', 'nipy', 'mrtrix',
+                                   'camino'])
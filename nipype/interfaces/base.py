@@ -8,10 +8,12 @@ Exaples  FSL, matlab/SPM , afni
 Requires Packages to be installed
 """
 
+from collections import deque
 from ConfigParser import NoOptionError
 from copy import deepcopy
 import datetime
 import errno
+from multiprocessing.pool import ThreadPool
 import os
 import re
 import platform
@@ -501,8 +503,12 @@ class BaseTraitedSpec(traits.HasTraits):
 
         """
 
+        if hash_method is None:
+            hash_method = config.get('execution', 'hash_method')
         dict_withhash = {}
         dict_nofilename = {}
+        items = []
+        files = []
         for name, val in sorted(self.get().items()):
             if isdefined(val):
                 trait = self.trait(name)
@@ -512,16 +518,63 @@ class BaseTraitedSpec(traits.HasTraits):
                                                False)
                               and not has_metadata(trait.trait_type,
                                                    "name_source"))
-                dict_nofilename[name] = \
-                    self._get_sorteddict(val, hash_method=hash_method,
-                                         hash_files=hash_files)
-                dict_withhash[name] = \
-                    self._get_sorteddict(val, True, hash_method=hash_method,
-                                         hash_files=hash_files)
+                items.append((name, val, hash_files))
+                if hash_files:
+                    self._list_files(val, files)
+        # each file is hashed once, for both dictionaries
+        hashes = self._hash_files(files, hash_method)
+        for name, val, hash_files in items:
+            dict_nofilename[name] = \
+                self._get_sorteddict(val, hash_method=hash_method,
+                                     hash_files=hash_files, hashes=hashes)
+            dict_withhash[name] = \
+                self._get_sorteddict(val, True, hash_method=hash_method,
+                                     hash_files=hash_files, hashes=hashes)
         return (dict_withhash, md5(str(dict_nofilename)).hexdigest())
 
+    def _list_files(self, object, files):
+        """Append the existing files found in `object` to `files`"""
+        if isinstance(object, dict):
+            for val in object.values():
+                self._list_files(val, files)
+        elif isinstance(object, (list, tuple)):
+            for val in object:
+                self._list_files(val, files)
+        elif isinstance(object, str) and os.path.isfile(object):
+            files.append(object)
+
+    def _hash_file(self, afile, hash_method):
+        if hash_method.lower() == 'timestamp':
+            return hash_timestamp(afile)
+        elif hash_method.lower() == 'content':
+            return hash_infile(afile)
+        else:
+            raise Exception("Unknown hash method: %s" % hash_method)
+
+    def _hash_files(self, files, hash_method):
+        """Return a dictionary of the hashes of `files`
+
+        The contents of files are hashed by a pool of `hash_threads` threads
+        (execution option), as hashing releases the GIL.
+        """
+        files = sorted(set(files))
+        nthreads = min(int(config.get('execution', 'hash_threads')),
+                       len(files))
+        if nthreads > 1 and hash_method.lower() == 'content':
+            pool = ThreadPool(nthreads)
+            try:
+                hashes = pool.map(lambda afile: self._hash_file(afile,
+                                                                hash_method),
+                                  files)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            hashes = [self._hash_file(afile, hash_method) for afile in files]
+        return dict(zip(files, hashes))
+
     def _get_sorteddict(self, object, dictwithhash=False, hash_method=None,
-                        hash_files=True):
+                        hash_files=True, hashes=None):
         if isinstance(object, dict):
             out = {}
             for key, val in sorted(object.items()):
@@ -529,14 +582,16 @@ class BaseTraitedSpec(traits.HasTraits):
                     out[key] = \
                         self._get_sorteddict(val, dictwithhash,
                                              hash_method=hash_method,
-                                             hash_files=hash_files)
+                                             hash_files=hash_files,
+                                             hashes=hashes)
         elif isinstance(object, (list, tuple)):
             out = []
             for val in object:
                 if isdefined(val):
                     out.append(self._get_sorteddict(val, dictwithhash,
                                                     hash_method=hash_method,
-                                                    hash_files=hash_files))
+                                                    hash_files=hash_files,
+                                                    hashes=hashes))
             if isinstance(object, tuple):
                 out = tuple(out)
         else:
@@ -546,12 +601,10 @@ class BaseTraitedSpec(traits.HasTraits):
                     if hash_method is None:
                         hash_method = config.get('execution', 'hash_method')
 
-                    if hash_method.lower() == 'timestamp':
-                        hash = hash_timestamp(object)
-                    elif hash_method.lower() == 'content':
-                        hash = hash_infile(object)
+                    if hashes is not None and object in hashes:
+                        hash = hashes[object]
                     else:
-                        raise Exception("Unknown hash method: %s" % hash_method)
+                        hash = self._hash_file(object, hash_method)
                     if dictwithhash:
                         out = (object, hash)
                     else:
@@ -1103,21 +1156,155 @@ class Stream(object):
         self._lastidx = len(self._rows)
 
 
+class RotatingFile(object):
+    """A file that is rotated when it grows larger than `max_bytes`
+
+    Files are rotated like with logging.handlers.RotatingFileHandler:
+    `filename` is renamed `filename`.1, `filename`.1 is renamed
+    `filename`.2 and so on, up to `backup_count` old files. A `max_bytes` of
+    0 never rotates the file.
+    """
+
+    def __init__(self, filename, max_bytes=0, backup_count=0):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        # old files of a previous run
+        for idx in range(1, backup_count + 1):
+            if os.path.exists('%s.%d' % (filename, idx)):
+                os.remove('%s.%d' % (filename, idx))
+        self._fp = open(filename, 'wb')
+        self._size = 0
+
+    def write(self, data):
+        while self.max_bytes and self._size + len(data) > self.max_bytes:
+            room = self.max_bytes - self._size
+            self._fp.write(data[:room])
+            data = data[room:]
+            self._rotate()
+        self._fp.write(data)
+        self._size += len(data)
+
+    def _rotate(self):
+        self._fp.close()
+        if self.backup_count:
+            for idx in range(self.backup_count - 1, 0, -1):
+                src = '%s.%d' % (self.filename, idx)
+                if os.path.exists(src):
+                    os.rename(src, '%s.%d' % (self.filename, idx + 1))
+            os.rename(self.filename, self.filename + '.1')
+        self._fp = open(self.filename, 'wb')
+        self._size = 0
+
+    def close(self):
+        self._fp.close()
+
+
+class TailStream(object):
+    """Writes a stream to a rotating file and keeps its last lines
+
+    The last lines are kept in `tail` and, prefixed with the name of the
+    stream and a timestamp, in the `merged` deque shared by the streams of
+    a process.
+    """
+
+    def __init__(self, name, impl, logfile, merged, max_bytes=0,
+                 backup_count=0, chunk_size=65536):
+        self._name = name
+        self._impl = impl
+        self._log = RotatingFile(logfile, max_bytes, backup_count)
+        self._buf = ''
+        self._chunk_size = chunk_size
+        self.merged = merged
+        self.tail = deque(maxlen=merged.maxlen)
+
+    def fileno(self):
+        "Pass-through for file descriptor."
+        return self._impl.fileno()
+
+    def _add_lines(self, lines):
+        now = datetime.datetime.now().isoformat()
+        self.tail.extend(lines)
+        self.merged.extend(['%s %s:%s' % (self._name, now, line)
+                            for line in lines[-self.tail.maxlen:]])
+
+    def read(self):
+        """Read the available data, return False at the end of the stream"""
+        data = os.read(self.fileno(), self._chunk_size)
+        if not data:
+            if self._buf:
+                self._add_lines([self._buf])
+                self._buf = ''
+            return False
+        self._log.write(data)
+        lines = (self._buf + data).split('\n')
+        self._buf = lines.pop()
+        # do not let a line without newline grow without bounds
+        if len(self._buf) > self._chunk_size:
+            lines.append(self._buf)
+            self._buf = ''
+        if lines:
+            self._add_lines(lines)
+        return True
+
+    def close(self):
+        self._log.close()
+
+
+def _read_streams(streams):
+    """Read streams until they are all closed, waiting with poll or select
+    """
+    open_streams = dict([(stream.fileno(), stream) for stream in streams])
+    poller = None
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        for fd in open_streams:
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+    while open_streams:
+        try:
+            if poller is not None:
+                ready = [fd for fd, _ in poller.poll()]
+            else:
+                ready = [stream.fileno() for stream in
+                         select.select(open_streams.values(), [], [])[0]]
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                continue
+            raise
+        for fd in ready:
+            if not open_streams[fd].read():
+                if poller is not None:
+                    poller.unregister(fd)
+                del open_streams[fd]
+
+
 def run_command(runtime, output=None, timeout=0.01):
     """Run a command, read stdout and stderr, prefix with timestamp.
 
     The returned runtime contains a merged stdout+stderr log with timestamps
+
+    With `output` 'file_tail', stdout and stderr are written to rotating
+    files in the working directory and only their last lines (execution
+    options ``terminal_log_size``, ``terminal_log_rotate`` and
+    ``terminal_tail_lines``) are kept in the runtime.
     """
     PIPE = subprocess.PIPE
-    proc = subprocess.Popen(runtime.cmdline,
-                             stdout=PIPE,
-                             stderr=PIPE,
-                             shell=True,
-                             cwd=runtime.cwd,
-                             env=runtime.environ)
-    result = {}
     errfile = os.path.join(runtime.cwd, 'stderr.nipype')
     outfile = os.path.join(runtime.cwd, 'stdout.nipype')
+    if output == 'file':
+        stderr = open(errfile, 'wt')
+        stdout = open(outfile, 'wt')
+    elif output == 'none':
+        stdout = stderr = open(os.devnull, 'wb')
+    else:
+        stdout = stderr = PIPE
+    proc = subprocess.Popen(runtime.cmdline,
+                            stdout=stdout,
+                            stderr=stderr,
+                            shell=True,
+                            cwd=runtime.cwd,
+                            env=runtime.environ)
+    result = {}
     if output == 'stream':
         streams = [Stream('stdout', proc.stdout), Stream('stderr', proc.stderr)]
 
@@ -1153,23 +1340,34 @@ def run_command(runtime, output=None, timeout=0.01):
         result['stdout'] = stdout.split('\n')
         result['stderr'] = stderr.split('\n')
         result['merged'] = ''
+    if output == 'file_tail':
+        merged = deque(maxlen=int(config.get('execution',
+                                             'terminal_tail_lines')))
+        max_bytes = int(config.get('execution', 'terminal_log_size'))
+        backup_count = int(config.get('execution', 'terminal_log_rotate'))
+        streams = [TailStream('stdout', proc.stdout, outfile, merged,
+                              max_bytes, backup_count),
+                   TailStream('stderr', proc.stderr, errfile, merged,
+                              max_bytes, backup_count)]
+        try:
+            _read_streams(streams)
+        finally:
+            for stream in streams:
+                stream.close()
+        proc.wait()
+        for stream in streams:
+            result[stream._name] = list(stream.tail)
+        result['merged'] = list(merged)
     if output == 'file':
-        stderr = open(errfile, 'wt')
-        stdout = open(outfile, 'wt')
-        proc = subprocess.Popen(runtime.cmdline,
-                                stdout=stdout,
-                                stderr=stderr,
-                                shell=True,
-                                cwd=runtime.cwd,
-                                env=runtime.environ)
         ret_code = proc.wait()
-        stderr.flush()
-        stdout.flush()
+        stderr.close()
+        stdout.close()
         result['stdout'] = [line.strip() for line in open(outfile).readlines()]
         result['stderr'] = [line.strip() for line in open(errfile).readlines()]
         result['merged'] = ''
     if output == 'none':
-        proc.communicate()
+        proc.wait()
+        stdout.close()
         result['stdout'] = []
         result['stderr'] = []
         result['merged'] = ''
@@ -1209,12 +1407,15 @@ class CommandLineInputSpec(BaseInterfaceInputSpec):
     args = traits.Str(argstr='%s', desc='Additional parameters to the command')
     environ = traits.DictStrStr(desc='Environment variables', usedefault=True,
                                 nohash=True)
-    terminal_output = traits.Enum('stream', 'allatonce', 'file', 'none',
+    terminal_output = traits.Enum('stream', 'allatonce', 'file', 'file_tail',
+                                  'none',
                                   desc=('Control terminal output: `stream` - '
                                         'displays to terminal immediately, '
                                         '`allatonce` - waits till command is '
                                         'finished to display output, `file` - '
-                                        'writes output to file, `none` - output'
+                                        'writes output to file, `file_tail` - '
+                                        'writes output to rotating files and '
+                                        'keeps its last lines, `none` - output'
                                         ' is ignored'),
                                   nohash=True, mandatory=True)
 
@@ -1285,7 +1486,8 @@ class CommandLine(BaseInterface):
         <instance>.inputs.output_type.
         """
 
-        if output_type in ['stream', 'allatonce', 'file', 'none']:
+        if output_type in ['stream', 'allatonce', 'file', 'file_tail',
+                           'none']:
             cls._terminal_output = output_type
         else:
             raise AttributeError('Invalid terminal output_type: %s' %
@@ -16,7 +16,10 @@ from nipype.utils.filemanip import split_filename
 import pickle
 import scipy.io as sio
 import os, os.path as op
+import itertools
+import shutil
 import numpy as np
+from scipy import sparse
 import nibabel as nb
 import networkx as nx
 import sys
@@ -68,54 +71,92 @@ def length(xyz, along=False):
         return np.cumsum(dists)
     return np.sum(dists)
 
+def _fiber_points(fibers):
+    """Concatenate the points of `fibers`
+
+    Returns the (npoints, 3) array of the points and the index of the fiber
+    of each point.
+    """
+    counts = np.array([len(fiber[0]) for fiber in fibers], dtype=int)
+    if counts.sum() == 0:
+        return np.zeros((0, 3)), np.zeros(0, dtype=int)
+    points = np.concatenate([fiber[0] for fiber in fibers if len(fiber[0])])
+    return points, np.repeat(np.arange(len(fibers)), counts)
+
+def _voxel_indices(pointsmm, voxelSize):
+    """Voxel indices of points in milimeter coordinates (truncated)"""
+    pointsmm = np.asarray(pointsmm, dtype=np.float64)
+    return (pointsmm / np.asarray(voxelSize[:3], dtype=np.float64)).astype(int)
+
+def _crossing_matrix(fiber_ids, labels, n_fibers, n_rois):
+    """Count the fibers crossing each pair of distinct ROIs
+
+    `fiber_ids` and `labels` give the fiber and the ROI label of points;
+    unlabeled points (0) are ignored. Returns the (n_rois, n_rois)
+    connectivity matrix and the sorted indices of the fibers crossing at
+    least one ROI.
+    """
+    fiber_ids = np.asarray(fiber_ids, dtype=int)
+    labels = np.asarray(labels, dtype=int)
+    labeled = labels != 0
+    fiber_ids, labels = fiber_ids[labeled], labels[labeled]
+    connectivity_matrix = np.zeros((n_rois, n_rois), dtype=np.uint)
+    if not len(labels):
+        return connectivity_matrix, np.zeros(0, dtype=int)
+    if labels.max() > n_rois or labels.min() < 0:
+        raise IndexError('ROI labels must be between 1 and %d' % n_rois)
+    # one entry per (fiber, ROI crossed)
+    keys = np.unique(fiber_ids * (n_rois + 1) + labels)
+    fibers, rois = keys // (n_rois + 1), keys % (n_rois + 1) - 1
+    crossed = sparse.csr_matrix((np.ones(len(keys)), (fibers, rois)),
+                                shape=(n_fibers, n_rois))
+    connectivity_matrix += (crossed.T * crossed).toarray().astype(np.uint)
+    connectivity_matrix[np.diag_indices(n_rois)] = 0
+    return connectivity_matrix, np.unique(fibers)
+
 def get_rois_crossed(pointsmm, roiData, voxelSize):
-	n_points = len(pointsmm)
-	rois_crossed = []
-	for j in xrange(0, n_points):
-		# store point
-		x = int(pointsmm[j, 0] / float(voxelSize[0]))
-		y = int(pointsmm[j, 1] / float(voxelSize[1]))
-		z = int(pointsmm[j, 2] / float(voxelSize[2]))
-		if not roiData[x, y, z] == 0:
-			rois_crossed.append(roiData[x, y, z])
-	rois_crossed = dict.fromkeys(rois_crossed).keys() #Removed duplicates from the list
-	return rois_crossed
+    voxels = _voxel_indices(pointsmm, voxelSize).reshape(-1, 3)
+    labels = roiData[voxels[:, 0], voxels[:, 1], voxels[:, 2]]
+    return list(np.unique(labels[labels != 0]))
 
 def get_connectivity_matrix(n_rois, list_of_roi_crossed_lists):
-	connectivity_matrix = np.zeros((n_rois, n_rois), dtype=np.uint)
-	for rois_crossed in list_of_roi_crossed_lists:
-		for idx_i, roi_i in enumerate(rois_crossed):
-			for idx_j, roi_j in enumerate(rois_crossed):
-				if idx_i > idx_j:
-					if not roi_i == roi_j:
-						connectivity_matrix[roi_i - 1, roi_j - 1] += 1
-	connectivity_matrix = connectivity_matrix + connectivity_matrix.T
-	return connectivity_matrix
-
-def create_allpoints_cmat(streamlines, roiData, voxelSize, n_rois):
-	""" Create the intersection arrays for each fiber
-	"""
-	n_fib = len(streamlines)
-	pc = -1
-	# Computation for each fiber
-	final_fiber_ids = []
-	list_of_roi_crossed_lists = []
-	for i, fiber in enumerate(streamlines):
-		pcN = int(round(float(100 * i) / n_fib))
-		if pcN > pc and pcN % 1 == 0:
-			pc = pcN
-			print '%4.0f%%' % (pc)
-		rois_crossed = get_rois_crossed(fiber[0], roiData, voxelSize)
-		if len(rois_crossed) > 0:
-			list_of_roi_crossed_lists.append(list(rois_crossed))
-			final_fiber_ids.append(i)
-
-	connectivity_matrix = get_connectivity_matrix(n_rois, list_of_roi_crossed_lists)
-	dis = n_fib - len(final_fiber_ids)
-	iflogger.info("Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (dis, dis * 100.0 / n_fib, n_fib))
-	iflogger.info("Valid fibers: %i (%f percent)" % (n_fib - dis, 100 - dis * 100.0 / n_fib))
-	iflogger.info('Returning the intersecting point connectivity matrix')
-	return connectivity_matrix, final_fiber_ids
+    counts = [len(rois_crossed) for rois_crossed in list_of_roi_crossed_lists]
+    fiber_ids = np.repeat(np.arange(len(counts)), counts)
+    labels = np.zeros(0, dtype=int)
+    if sum(counts):
+        labels = np.concatenate([np.asarray(rois_crossed, dtype=int)
+                                 for rois_crossed in list_of_roi_crossed_lists])
+    return _crossing_matrix(fiber_ids, labels, len(counts), n_rois)[0]
+
+def _crossing_fibers(fibers, roiData, voxelSize, n_rois):
+    """ Connectivity matrix of the ROIs crossed by `fibers` and indices of
+    the fibers crossing at least one ROI """
+    points, fiber_ids = _fiber_points(fibers)
+    voxels = _voxel_indices(points, voxelSize)
+    labels = roiData[voxels[:, 0], voxels[:, 1], voxels[:, 2]]
+    return _crossing_matrix(fiber_ids, labels, len(fibers), n_rois)
+
+def create_allpoints_cmat(streamlines, roiData, voxelSize, n_rois,
+                          chunk_size=100000):
+    """ Create the intersection arrays for each fiber
+
+    Fibers are processed by chunks of `chunk_size` fibers.
+    """
+    n_fib = len(streamlines)
+    connectivity_matrix = np.zeros((n_rois, n_rois), dtype=np.uint)
+    final_fiber_ids = []
+    for start in xrange(0, n_fib, chunk_size):
+        fibers = streamlines[start:start + chunk_size]
+        matrix, crossing = _crossing_fibers(fibers, roiData, voxelSize, n_rois)
+        connectivity_matrix += matrix
+        final_fiber_ids.extend((crossing + start).tolist())
+        iflogger.info('%4.0f%%' % (100.0 * (start + len(fibers)) / n_fib))
+
+    dis = n_fib - len(final_fiber_ids)
+    iflogger.info("Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (dis, dis * 100.0 / n_fib, n_fib))
+    iflogger.info("Valid fibers: %i (%f percent)" % (n_fib - dis, 100 - dis * 100.0 / n_fib))
+    iflogger.info('Returning the intersecting point connectivity matrix')
+    return connectivity_matrix, final_fiber_ids
 
 def create_endpoints_array(fib, voxelSize):
     """ Create the endpoints arrays for each fiber
@@ -129,41 +170,192 @@ def create_endpoints_array(fib, voxelSize):
     index of its first and last point in the voxelSize volume
     endpointsmm) : endpoints in milimeter coordinates
     """
-
-    # Init
     n = len(fib)
-    endpoints = np.zeros((n, 2, 3))
     endpointsmm = np.zeros((n, 2, 3))
-    pc = -1
-
-    # Computation for each fiber
-    for i, fi in enumerate(fib):
-        f = fi[0]
-
-        # store startpoint
-        endpoints[i, 0, :] = f[0, :]
-        # store endpoint
-        endpoints[i, 1, :] = f[-1, :]
-
-        # store startpoint
-        endpointsmm[i, 0, :] = f[0, :]
-        # store endpoint
-        endpointsmm[i, 1, :] = f[-1, :]
-
-        # Translate from mm to index
-        endpoints[i, 0, 0] = int(endpoints[i, 0, 0] / float(voxelSize[0]))
-        endpoints[i, 0, 1] = int(endpoints[i, 0, 1] / float(voxelSize[1]))
-        endpoints[i, 0, 2] = int(endpoints[i, 0, 2] / float(voxelSize[2]))
-        endpoints[i, 1, 0] = int(endpoints[i, 1, 0] / float(voxelSize[0]))
-        endpoints[i, 1, 1] = int(endpoints[i, 1, 1] / float(voxelSize[1]))
-        endpoints[i, 1, 2] = int(endpoints[i, 1, 2] / float(voxelSize[2]))
+    if n:
+        endpointsmm[:, 0, :] = [fi[0][0] for fi in fib]
+        endpointsmm[:, 1, :] = [fi[0][-1] for fi in fib]
+    # Translate from mm to index
+    endpoints = _voxel_indices(endpointsmm.reshape(-1, 3), voxelSize)
+    endpoints = endpoints.reshape(n, 2, 3).astype(np.float64)
 
     # Return the matrices
     iflogger.info('Returning the endpoint matrix')
     return (endpoints, endpointsmm)
 
-def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_name, endpoint_name, intersections=False):
-    """ Create the connection matrix for each resolution using fibers and ROIs. """
+def fiber_lengths(fibers, chunk_size=100000):
+    """ Euclidean length of each fiber (see `length`), computed by chunks of
+    `chunk_size` fibers """
+    dtype = np.float64
+    if len(fibers):
+        dtype = np.asarray(fibers[0][0]).dtype
+    lengths = np.zeros(len(fibers), dtype=dtype)
+    for start in xrange(0, len(fibers), chunk_size):
+        chunk = fibers[start:start + chunk_size]
+        points, fiber_ids = _fiber_points(chunk)
+        dists = np.sqrt((np.diff(points, axis=0) ** 2).sum(axis=1))
+        same = fiber_ids[1:] == fiber_ids[:-1]
+        lengths[start:start + len(chunk)] = np.bincount(
+            fiber_ids[1:][same], weights=dists[same], minlength=len(chunk))
+    return lengths
+
+def _update_length_stats(keys, lengths, counts, means, m2):
+    """ Add the `lengths` of fibers of the edges `keys` to the running
+    number (`counts`), mean (`means`) and sum of squared deviations from
+    the mean (`m2`) of the fiber lengths of each edge (updated in place)
+    """
+    if not len(keys):
+        return
+    batch_counts = np.bincount(keys, minlength=len(counts))
+    edges = np.flatnonzero(batch_counts)
+    batch_counts = batch_counts[edges]
+    batch_means = np.zeros(len(counts))
+    batch_means[edges] = (np.bincount(keys, weights=lengths,
+                                      minlength=len(counts))[edges] /
+                          batch_counts)
+    batch_m2 = np.bincount(keys, weights=(lengths - batch_means[keys]) ** 2,
+                           minlength=len(counts))[edges]
+    # combine the statistics of the batch with the previous ones
+    total = counts[edges] + batch_counts
+    delta = batch_means[edges] - means[edges]
+    m2[edges] += batch_m2 + delta ** 2 * counts[edges] * batch_counts / total
+    means[edges] += delta * batch_counts / total
+    counts[edges] = total
+
+def _length_medians(keys, lengths):
+    """ Median of the `lengths` of the fibers of each edge of `keys`
+
+    Returns the sorted edges and their median.
+    """
+    edges, edge_ids = np.unique(keys, return_inverse=True)
+    counts = np.bincount(edge_ids)
+    # lengths sorted by edge then length
+    sorted_lengths = lengths[np.lexsort((lengths, edge_ids))]
+    starts = np.cumsum(counts) - counts
+    medians = (sorted_lengths[starts + (counts - 1) // 2] +
+               sorted_lengths[starts + counts // 2]) / 2.0
+    return edges, medians
+
+def _endpoint_labels(endpoints, roiData):
+    """ ROI labels of the (start, end) `endpoints` of fibers
+
+    The fibers are labeled up to the first one with an endpoint outside of
+    the ROI volume.
+    """
+    voxels = endpoints.astype(int).reshape(-1, 3)
+    shape = np.array(roiData.shape[:3])
+    outside = ((voxels >= shape) | (voxels < -shape)).any(axis=1)
+    if outside.any():
+        voxels = voxels[:np.flatnonzero(outside)[0] // 2 * 2]
+    labels = roiData[voxels[:, 0], voxels[:, 1], voxels[:, 2]]
+    return labels.astype(int).reshape(-1, 2)
+
+def _batches(iterable, size):
+    """ Split `iterable` in lists of `size` items """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+class _ArrayWriter(object):
+    """ Write an array to a .npy file by blocks of rows
+
+    The rows are appended to a temporary file and the .npy file is written
+    on close, once the number of rows is known. `abort` removes the
+    temporary file instead.
+    """
+
+    def __init__(self, filename, dtype, shape=()):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.rows = 0
+        self._tmpfile = None
+
+    def _file(self):
+        if self._tmpfile is None:
+            self._tmpfile = open(self.filename + '.tmp', 'w+b')
+        return self._tmpfile
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        self._file().write(rows.tostring())
+        self.rows += len(rows)
+
+    def close(self):
+        header = {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                  'fortran_order': False,
+                  'shape': (self.rows,) + self.shape}
+        tmpfile = self._file()
+        fp = open(self.filename, 'wb')
+        np.lib.format.write_array_header_1_0(fp, header)
+        tmpfile.seek(0)
+        shutil.copyfileobj(tmpfile, fp, 2 ** 24)
+        fp.close()
+        self.abort()
+
+    def abort(self):
+        if self._tmpfile is not None and not self._tmpfile.closed:
+            self._tmpfile.close()
+            os.remove(self.filename + '.tmp')
+
+class _TrackWriter(object):
+    """ Write fibers to a TrackVis file as they come
+
+    `hdr` is the header of the file the fibers are read from. The fibers
+    are written to a temporary file, renamed on close once the number of
+    fibers is set in the header. `abort` removes the temporary file instead.
+    """
+
+    def __init__(self, filename, hdr):
+        self.filename = filename
+        self.hdr = hdr.copy()
+        self.n_fib = 0
+        byteorder = self.hdr.dtype['hdr_size'].byteorder
+        self._i4 = np.dtype(byteorder + 'i4')
+        self._f4 = np.dtype(byteorder + 'f4')
+        self._fp = None
+
+    def _file(self):
+        if self._fp is None:
+            self._fp = open(self.filename + '.tmp', 'wb')
+            self._fp.write(self.hdr.tostring())
+        return self._fp
+
+    def write(self, fibers):
+        fp = self._file()
+        for pts, scalars, props in fibers:
+            if scalars is not None and len(scalars):
+                pts = np.c_[pts, scalars]
+            fp.write(np.array(len(pts), self._i4).tostring())
+            fp.write(np.asarray(pts, self._f4).tostring())
+            if props is not None and len(props):
+                fp.write(np.asarray(props, self._f4).tostring())
+        self.n_fib += len(fibers)
+
+    def close(self):
+        fp = self._file()
+        self.hdr['n_count'] = self.n_fib
+        fp.seek(0)
+        fp.write(self.hdr.tostring())
+        fp.close()
+        os.rename(self.filename + '.tmp', self.filename)
+
+    def abort(self):
+        if self._fp is not None and not self._fp.closed:
+            self._fp.close()
+            os.remove(self.filename + '.tmp')
+
+def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_name, endpoint_name, intersections=False, chunk_size=100000):
+    """ Create the connection matrix for each resolution using fibers and ROIs.
+
+    The fibers are read, labeled and written by batches of `chunk_size`
+    fibers: apart from an edge and a length per labeled fiber, kept for the
+    fiber length medians, the memory used does not depend on the number of
+    fibers.
+    """
 
     stats = {}
     iflogger.info('Running cmat function')
@@ -171,28 +363,9 @@ def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_
     en_fname = op.abspath(endpoint_name + '_endpoints.npy')
     en_fnamemm = op.abspath(endpoint_name + '_endpointsmm.npy')
 
-    iflogger.info('Reading Trackvis file {trk}'.format(trk=track_file))
-    fib, hdr = nb.trackvis.read(track_file, False)
-    stats['orig_n_fib'] = len(fib)
-    
     roi = nb.load(roi_file)
     roiData = roi.get_data()
     roiVoxelSize = roi.get_header().get_zooms()
-    (endpoints, endpointsmm) = create_endpoints_array(fib, roiVoxelSize)
-
-    # Output endpoint arrays
-    iflogger.info('Saving endpoint array: {array}'.format(array=en_fname))
-    np.save(en_fname, endpoints)
-    iflogger.info('Saving endpoint array in mm: {array}'.format(array=en_fnamemm))
-    np.save(en_fnamemm, endpointsmm)
-
-    n = len(fib)
-    iflogger.info('Number of fibers {num}'.format(num=n))
-
-    # Create empty fiber label array
-    fiberlabels = np.zeros((n, 2))
-    final_fiberlabels = []
-    final_fibers_idx = []
 
     # Add node information from specified parcellation scheme
     path, name, ext = split_filename(resolution_network_file)
@@ -215,80 +388,140 @@ def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_
             xyz = tuple(np.mean(np.where(np.flipud(roiData) == int(d["dn_correspondence_id"])) , axis=1))
             G.node[int(u)]['dn_position'] = tuple([xyz[0], xyz[2], -xyz[1]])
 
+    iflogger.info('Reading Trackvis file {trk}'.format(trk=track_file))
+    fibers, hdr = nb.trackvis.read(track_file, as_generator=True)
+
+    fiberlengths_fname = op.abspath(endpoint_name + '_final_fiberslength.npy')
+    fiberlabels_fname = op.abspath(endpoint_name + '_filtered_fiberslabel.npy')
+    fiberlabels_noorphans_fname = op.abspath(endpoint_name + '_final_fiberslabels.npy')
+    finalfibers_fname = op.abspath(endpoint_name + '_streamline_final.trk')
+    endpoints_file = _ArrayWriter(en_fname, np.float64, (2, 3))
+    endpointsmm_file = _ArrayWriter(en_fnamemm, np.float64, (2, 3))
+    fiberlengths_file = _ArrayWriter(fiberlengths_fname, np.float32)
+    fiberlabels_file = _ArrayWriter(fiberlabels_fname, np.int32, (2,))
+    fiberlabels_noorphans_file = _ArrayWriter(fiberlabels_noorphans_fname, int, (2,))
+    finalfibers_file = _TrackWriter(finalfibers_fname, hdr)
     if intersections:
         iflogger.info("Filtering tractography from intersections")
-        intersection_matrix, final_fiber_ids = create_allpoints_cmat(fib, roiData, roiVoxelSize, nROIs)
-        finalfibers_fname = op.abspath(endpoint_name + '_intersections_streamline_final.trk')
-        stats['intersections_n_fib'] = save_fibers(hdr, fib, finalfibers_fname, final_fiber_ids)
-        intersection_matrix = np.matrix(intersection_matrix)
-        I = G.copy()
-        H = nx.from_numpy_matrix(np.matrix(intersection_matrix))
-        H = nx.relabel_nodes(H, lambda x: x + 1) #relabel nodes so they start at 1		
-        I.add_weighted_edges_from(((u, v, d['weight']) for u, v, d in H.edges(data=True)))
-
+        intersection_matrix = np.zeros((nROIs, nROIs), dtype=np.uint)
+        intersectionfibers_fname = op.abspath(endpoint_name + '_intersections_streamline_final.trk')
+        intersectionfibers_file = _TrackWriter(intersectionfibers_fname, hdr)
+
+    # running number of fibers, mean length and sum of squared length
+    # deviations of the edges, indexed by start * (nROIs + 1) + end
+    edge_counts = np.zeros((nROIs + 1) ** 2, dtype=int)
+    edge_means = np.zeros((nROIs + 1) ** 2)
+    edge_m2 = np.zeros((nROIs + 1) ** 2)
+    edge_keys = []
+    edge_lengths = []
+
+    n = 0
     dis = 0
-    for i in xrange(endpoints.shape[0]):
-
-        # ROI start => ROI end
-        try:
-            startROI = int(roiData[endpoints[i, 0, 0], endpoints[i, 0, 1], endpoints[i, 0, 2]])
-            endROI = int(roiData[endpoints[i, 1, 0], endpoints[i, 1, 1], endpoints[i, 1, 2]])
-        except IndexError:
-            iflogger.error(("AN INDEXERROR EXCEPTION OCCURED FOR FIBER %s. PLEASE CHECK ENDPOINT GENERATION" % i))
-            break
-
-        # Filter
-        if startROI == 0 or endROI == 0:
-            dis += 1
-            fiberlabels[i, 0] = -1
-            continue
-
-        if startROI > nROIs or endROI > nROIs:
-            iflogger.error("Start or endpoint of fiber terminate in a voxel which is labeled higher")
-            iflogger.error("than is expected by the parcellation node information.")
-            iflogger.error("Start ROI: %i, End ROI: %i" % (startROI, endROI))
-            iflogger.error("This needs bugfixing!")
-            continue
-
-        # Update fiber label
-        # switch the rois in order to enforce startROI < endROI
-        if endROI < startROI:
-            tmp = startROI
-            startROI = endROI
-            endROI = tmp
-
-        fiberlabels[i, 0] = startROI
-        fiberlabels[i, 1] = endROI
-
-        final_fiberlabels.append([ startROI, endROI ])
-        final_fibers_idx.append(i)
-
-        # Add edge to graph
-        if G.has_edge(startROI, endROI) and G.edge[startROI][endROI].has_key('fiblist'):
-            G.edge[startROI][endROI]['fiblist'].append(i)
-        else:
-            G.add_edge(startROI, endROI, fiblist=[i])
-
-    # create a final fiber length array
-    finalfiberlength = []
+    labeling = True
+    # remove the temporary files of the outputs if anything fails
+    writers = [endpoints_file, endpointsmm_file, fiberlengths_file,
+               fiberlabels_file, fiberlabels_noorphans_file, finalfibers_file]
     if intersections:
-        final_fibers_indices = final_fiber_ids
-    else:
-        final_fibers_indices = final_fibers_idx
-
-    for idx in final_fibers_indices:
-        # compute length of fiber
-        finalfiberlength.append(length(fib[idx][0]))
+        writers.append(intersectionfibers_file)
+    try:
+        for fib in _batches(fibers, chunk_size):
+            (endpoints, endpointsmm) = create_endpoints_array(fib, roiVoxelSize)
+            endpoints_file.append(endpoints)
+            endpointsmm_file.append(endpointsmm)
+            lengths = fiber_lengths(fib, chunk_size)
+
+            if intersections:
+                matrix, crossing = _crossing_fibers(fib, roiData, roiVoxelSize, nROIs)
+                intersection_matrix += matrix
+                intersectionfibers_file.write([fib[i] for i in crossing])
+                fiberlengths_file.append(lengths[crossing])
+
+            # ROI start => ROI end
+            fiberlabels = np.zeros((len(fib), 2))
+            if labeling:
+                endpoint_rois = _endpoint_labels(endpoints, roiData)
+                if len(endpoint_rois) < len(fib):
+                    iflogger.error(("AN INDEXERROR EXCEPTION OCCURED FOR FIBER %s. PLEASE CHECK ENDPOINT GENERATION" % (n + len(endpoint_rois))))
+                    labeling = False
+
+                # Filter
+                orphans = (endpoint_rois == 0).any(axis=1)
+                dis += int(orphans.sum())
+                fiberlabels[np.flatnonzero(orphans), 0] = -1
+
+                higher = ~orphans & (endpoint_rois > nROIs).any(axis=1)
+                for startROI, endROI in endpoint_rois[higher]:
+                    iflogger.error("Start or endpoint of fiber terminate in a voxel which is labeled higher")
+                    iflogger.error("than is expected by the parcellation node information.")
+                    iflogger.error("Start ROI: %i, End ROI: %i" % (startROI, endROI))
+                    iflogger.error("This needs bugfixing!")
+
+                # Update fiber labels
+                # sort the rois in order to enforce startROI < endROI
+                final_fibers_idx = np.flatnonzero(~orphans & ~higher)
+                final_fiberlabels = np.sort(endpoint_rois[final_fibers_idx], axis=1)
+                fiberlabels[final_fibers_idx] = final_fiberlabels
+                fiberlabels_noorphans_file.append(final_fiberlabels)
+                finalfibers_file.write([fib[i] for i in final_fibers_idx])
+                if not intersections:
+                    fiberlengths_file.append(lengths[final_fibers_idx])
+
+                keys = final_fiberlabels[:, 0] * (nROIs + 1) + final_fiberlabels[:, 1]
+                _update_length_stats(keys, lengths[final_fibers_idx], edge_counts, edge_means, edge_m2)
+                edge_keys.append(keys.astype(np.int32))
+                edge_lengths.append(lengths[final_fibers_idx])
+            fiberlabels_file.append(fiberlabels)
+            n += len(fib)
+            iflogger.info('Processed {num} fibers'.format(num=n))
+
+        iflogger.info('Saving endpoint array: {array}'.format(array=en_fname))
+        endpoints_file.close()
+        iflogger.info('Saving endpoint array in mm: {array}'.format(array=en_fnamemm))
+        endpointsmm_file.close()
+        iflogger.info("Storing final fiber length array as %s" % fiberlengths_fname)
+        fiberlengths_file.close()
+        iflogger.info("Storing all fiber labels (with orphans) as %s" % fiberlabels_fname)
+        fiberlabels_file.close()
+        iflogger.info("Storing final fiber labels (no orphans) as %s" % fiberlabels_noorphans_fname)
+        fiberlabels_noorphans_file.close()
+        iflogger.info("Filtering tractography - keeping only no orphan fibers")
+        iflogger.info("Writing final non-orphan fibers as %s" % finalfibers_fname)
+        finalfibers_file.close()
+        if intersections:
+            iflogger.info("Writing intersection fibers as %s" % intersectionfibers_fname)
+            intersectionfibers_file.close()
+    except:
+        for writer in writers:
+            writer.abort()
+        raise
 
-    # convert to array
-    final_fiberlength_array = np.array(finalfiberlength)
+    iflogger.info('Number of fibers {num}'.format(num=n))
+    stats['orig_n_fib'] = n
 
-    # make final fiber labels as array
-    final_fiberlabels_array = np.array(final_fiberlabels, dtype=int)
+    if intersections:
+        stats['intersections_n_fib'] = intersectionfibers_file.n_fib
+        intersection_matrix = np.matrix(intersection_matrix)
+        I = G.copy()
+        H = nx.from_numpy_matrix(np.matrix(intersection_matrix))
+        H = nx.relabel_nodes(H, lambda x: x + 1) #relabel nodes so they start at 1
+        I.add_weighted_edges_from(((u, v, d['weight']) for u, v, d in H.edges(data=True)))
 
     iflogger.info("Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (dis, dis * 100.0 / n, n))
     iflogger.info("Valid fibers: %i (%f percent)" % (n - dis, 100 - dis * 100.0 / n))
 
+    # Add edges to graph
+    edges, medians = _length_medians(np.concatenate(edge_keys),
+                                     np.concatenate(edge_lengths))
+    edge_stats = {}
+    for key, median in zip(edges, medians):
+        startROI, endROI = divmod(int(key), nROIs + 1)
+        edge_stats[(startROI, endROI)] = {
+            'number_of_fibers': int(edge_counts[key]),
+            'fiber_length_mean': float(edge_means[key]),
+            'fiber_length_median': float(median),
+            'fiber_length_std': float(np.sqrt(edge_m2[key] / edge_counts[key]))}
+        G.add_edge(startROI, endROI)
+
     numfib = nx.Graph()
     numfib.add_nodes_from(G)
     fibmean = numfib.copy()
@@ -296,21 +529,18 @@ def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_
     fibdev = numfib.copy()
     for u, v, d in G.edges_iter(data=True):
         G.remove_edge(u, v)
-        di = {}
-        if d.has_key('fiblist'):
-            di['number_of_fibers'] = len(d['fiblist'])
-            idx = np.where((final_fiberlabels_array[:, 0] == int(u)) & (final_fiberlabels_array[:, 1] == int(v)))[0]
-            di['fiber_length_mean'] = float(np.mean(final_fiberlength_array[idx]))
-            di['fiber_length_median'] = float(np.median(final_fiberlength_array[idx]))
-            di['fiber_length_std'] = float(np.std(final_fiberlength_array[idx]))
+        edge = (u, v) if u <= v else (v, u)
+        if edge in edge_stats:
+            di = edge_stats[edge]
         else:
+            di = {}
             di['number_of_fibers'] = 0
             di['fiber_length_mean'] = 0
             di['fiber_length_median'] = 0
             di['fiber_length_std'] = 0
         if not u == v: #Fix for self loop problem
             G.add_edge(u, v, di)
-            if d.has_key('fiblist'):
+            if edge in edge_stats:
                 numfib.add_edge(u, v, weight=di['number_of_fibers'])
                 fibmean.add_edge(u, v, weight=di['fiber_length_mean'])
                 fibmedian.add_edge(u, v, weight=di['fiber_length_median'])
@@ -360,45 +590,21 @@ def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_
     iflogger.info('Writing matlab fiber length deviation matrix as {mat}'.format(mat=fiber_length_std_matrix_name))
     sio.savemat(fiber_length_std_matrix_name, fibdev_dict)
 
-    fiberlengths_fname = op.abspath(endpoint_name + '_final_fiberslength.npy')
-    iflogger.info("Storing final fiber length array as %s" % fiberlengths_fname)
-    np.save(fiberlengths_fname, final_fiberlength_array)
-
-    fiberlabels_fname = op.abspath(endpoint_name + '_filtered_fiberslabel.npy')
-    iflogger.info("Storing all fiber labels (with orphans) as %s" % fiberlabels_fname)
-    np.save(fiberlabels_fname, np.array(fiberlabels, dtype=np.int32),)
-
-    fiberlabels_noorphans_fname = op.abspath(endpoint_name + '_final_fiberslabels.npy')
-    iflogger.info("Storing final fiber labels (no orphans) as %s" % fiberlabels_noorphans_fname)
-    np.save(fiberlabels_noorphans_fname, final_fiberlabels_array)
-
-    iflogger.info("Filtering tractography - keeping only no orphan fibers")
-    finalfibers_fname = op.abspath(endpoint_name + '_streamline_final.trk')
-    stats['endpoint_n_fib'] = save_fibers(hdr, fib, finalfibers_fname, final_fibers_idx)
+    stats['endpoint_n_fib'] = finalfibers_file.n_fib
     stats['endpoints_percent'] = float(stats['endpoint_n_fib'])/float(stats['orig_n_fib'])*100
-    stats['intersections_percent'] = float(stats['intersections_n_fib'])/float(stats['orig_n_fib'])*100
+    if intersections:
+        stats['intersections_percent'] = float(stats['intersections_n_fib'])/float(stats['orig_n_fib'])*100
     
     out_stats_file = op.abspath(endpoint_name + '_statistics.mat')
     iflogger.info("Saving matrix creation statistics as %s" % out_stats_file)
     sio.savemat(out_stats_file, stats)
 
-def save_fibers(oldhdr, oldfib, fname, indices):
-    """ Stores a new trackvis file fname using only given indices """
-    hdrnew = oldhdr.copy()
-    outstreams = []
-    for i in indices:
-        outstreams.append(oldfib[i])
-    n_fib_out = len(outstreams)
-    hdrnew['n_count'] = n_fib_out
-    iflogger.info("Writing final non-orphan fibers as %s" % fname)
-    nb.trackvis.write(fname, outstreams, hdrnew)
-    return n_fib_out
-
 class CreateMatrixInputSpec(TraitedSpec):
     roi_file = File(exists=True, mandatory=True, desc='Freesurfer aparc+aseg file')
     tract_file = File(exists=True, mandatory=True, desc='Trackvis tract file')
     resolution_network_file = File(exists=True, mandatory=True, desc='Parcellation files from Connectome Mapping Toolkit')
     count_region_intersections = traits.Bool(False, usedefault=True, desc='Counts all of the fiber-region traversals in the connectivity matrix (requires significantly more computational time)')
+    chunk_size = traits.Int(100000, usedefault=True, nohash=True, desc='Number of fibers read and processed at once (bounds the memory used)')
     out_matrix_file = File(genfile=True, desc='NetworkX graph describing the connectivity')
     out_matrix_mat_file = File('cmatrix.mat', usedefault=True, desc='Matlab matrix describing the connectivity')
     out_mean_fiber_length_matrix_mat_file = File(genfile=True, desc='Matlab matrix describing the mean fiber lengths between each node.')
@@ -479,7 +685,8 @@ class CreateMatrix(BaseInterface):
             endpoint_name = op.abspath(self.inputs.out_endpoint_array_name)
 
         cmat(self.inputs.tract_file, self.inputs.roi_file, self.inputs.resolution_network_file,
-        matrix_file, matrix_mat_file, endpoint_name, self.inputs.count_region_intersections)
+        matrix_file, matrix_mat_file, endpoint_name, self.inputs.count_region_intersections,
+        self.inputs.chunk_size)
         return runtime
 
     def _list_outputs(self):
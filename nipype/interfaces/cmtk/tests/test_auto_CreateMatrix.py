@@ -16,6 +16,9 @@ def test_CreateMatrix_inputs():
     ),
     count_region_intersections=dict(usedefault=True,
     ),
+    chunk_size=dict(nohash=True,
+    usedefault=True,
+    ),
     out_endpoint_array_name=dict(genfile=True,
     ),
     roi_file=dict(mandatory=True,
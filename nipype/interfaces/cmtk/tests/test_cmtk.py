@@ -0,0 +1,126 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+from glob import glob
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import nibabel as nb
+import networkx as nx
+import numpy as np
+import scipy.io as sio
+
+from nipype.testing import (assert_equal, assert_almost_equal,
+                            assert_raises)
+from nipype.interfaces.cmtk.cmtk import (cmat, create_allpoints_cmat,
+                                         create_endpoints_array,
+                                         get_connectivity_matrix,
+                                         get_rois_crossed)
+
+
+def _rois():
+    roi = np.zeros((4, 4, 4), dtype=np.int16)
+    roi[0] = 1
+    roi[3] = 2
+    roi[1:3, 0] = 3
+    return roi
+
+
+def _fibers():
+    points = [[[1, 3, 3], [7, 3, 3]],
+              [[7, 5, 5], [5, 5, 5], [1, 5, 5]],
+              [[3, 1, 1], [3, 3, 1], [3, 5, 1]],
+              [[1, 1, 1], [3, 1, 3], [7, 1, 7]],
+              [[3, 1, 1], [1, 7, 1]]]
+    return [(np.array(p, dtype=np.float32), None, None) for p in points]
+
+
+def test_connectivity_matrix():
+    matrix = get_connectivity_matrix(4, [[1, 2, 3], [3, 2], [4], []])
+    yield assert_equal, matrix.dtype, np.uint
+    yield assert_equal, matrix, np.array([[0, 1, 1, 0],
+                                          [1, 0, 2, 0],
+                                          [1, 2, 0, 0],
+                                          [0, 0, 0, 0]])
+    yield assert_raises, IndexError, get_connectivity_matrix, 2, [[1, 3]]
+
+
+def test_allpoints_cmat():
+    roi = _rois()
+    fibers = _fibers()
+    yield assert_equal, sorted(get_rois_crossed(fibers[3][0], roi,
+                                                (2., 2., 2.))), [1, 2, 3]
+    for chunk_size in [1, 2, 100]:
+        matrix, fiber_ids = create_allpoints_cmat(fibers, roi, (2., 2., 2.),
+                                                  3, chunk_size)
+        yield assert_equal, matrix, np.array([[0, 3, 2],
+                                              [3, 0, 1],
+                                              [2, 1, 0]])
+        yield assert_equal, fiber_ids, [0, 1, 2, 3, 4]
+
+    endpoints, endpointsmm = create_endpoints_array(fibers, (2., 2., 2.))
+    yield assert_equal, endpointsmm[1], [[7, 5, 5], [1, 5, 5]]
+    yield assert_equal, endpoints[1], [[3, 2, 2], [0, 2, 2]]
+
+
+def test_cmat():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    nb.Nifti1Image(_rois(), np.diag([2, 2, 2, 1])).to_filename('roi.nii')
+    network = nx.Graph()
+    for label in [1, 2, 3]:
+        network.add_node(label, dn_correspondence_id=label)
+    nx.write_gpickle(network, 'network.pck')
+    # the endpoints of the labeled fibers are read up to the first fiber
+    # leaving the volume
+    fibers = _fibers() + [(np.array([[1, 1, 1], [9, 1, 1]], np.float32),
+                           None, None), _fibers()[0]]
+    nb.trackvis.write('fibers.trk', fibers,
+                      {'voxel_size': (2, 2, 2), 'dim': (4, 4, 4)})
+
+    cmat('fibers.trk', 'roi.nii', 'network.pck', 'cmatrix.pck',
+         'cmatrix.mat', 'fibers', chunk_size=2)
+    yield assert_equal, glob('*.tmp'), []
+    yield assert_equal, np.load('fibers_filtered_fiberslabel.npy'), \
+        [[1, 2], [1, 2], [-1, 0], [1, 2], [1, 3], [0, 0], [0, 0]]
+    graph = nx.read_gpickle('cmatrix.pck')
+    yield assert_equal, sorted(graph.edges()), [(1, 2), (1, 3)]
+    edge = graph.edge[1][2]
+    yield assert_equal, edge['number_of_fibers'], 3
+    longest = np.sqrt(8) + np.sqrt(32)
+    yield assert_almost_equal, edge['fiber_length_mean'], \
+        (12 + longest) / 3, 5
+    yield assert_almost_equal, edge['fiber_length_median'], 6, 5
+    yield assert_almost_equal, edge['fiber_length_std'], \
+        np.std([6, 6, longest]), 5
+    yield assert_almost_equal, graph.edge[1][3]['fiber_length_mean'], \
+        np.sqrt(40), 5
+    yield assert_almost_equal, np.load('fibers_final_fiberslength.npy'), \
+        [6, 6, longest, np.sqrt(40)], 5
+    final, hdr = nb.trackvis.read('fibers_streamline_final.trk')
+    yield assert_equal, hdr['n_count'], 4
+    for fiber, i in zip(final, [0, 1, 3, 4]):
+        yield assert_equal, fiber[0], fibers[i][0]
+
+    nb.trackvis.write('fibers.trk', _fibers(),
+                      {'voxel_size': (2, 2, 2), 'dim': (4, 4, 4)})
+    cmat('fibers.trk', 'roi.nii', 'network.pck', 'cmatrix.pck',
+         'cmatrix.mat', 'fibers', intersections=True, chunk_size=2)
+    yield assert_equal, sio.loadmat('cmatrix_intersections.mat')[
+        'intersections'], [[0, 3, 2], [3, 0, 1], [2, 1, 0]]
+    final, hdr = nb.trackvis.read('fibers_intersections_streamline_final.trk')
+    yield assert_equal, len(final), 5
+    yield assert_equal, sio.loadmat('fibers_statistics.mat')[
+        'intersections_n_fib'], 5
+
+    # the intersections of fibers leaving the volume cannot be counted, no
+    # temporary output is left behind
+    nb.trackvis.write('out.trk', fibers,
+                      {'voxel_size': (2, 2, 2), 'dim': (4, 4, 4)})
+    yield assert_raises, IndexError, cmat, 'out.trk', 'roi.nii', \
+        'network.pck', 'out.pck', 'out.mat', 'out', True, 2
+    yield assert_equal, glob('*.tmp'), []
+
+    os.chdir(cwd)
+    rmtree(tempdir)
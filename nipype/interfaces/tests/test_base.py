@@ -243,6 +243,26 @@ def test_TraitedSpec_withNoFileHashing():
     os.chdir(pwd)
     teardown_file(tmpd)
 
+def test_TraitedSpec_parallel_hashing():
+    tmpd = tempfile.mkdtemp()
+    files = []
+    for idx in range(10):
+        files.append(os.path.join(tmpd, 'file%d.txt' % idx))
+        open(files[-1], 'wt').write('data %d' % idx)
+    class spec2(nib.TraitedSpec):
+        moo = nib.File(exists=True)
+        doo = nib.traits.List(nib.File(exists=True))
+    infields = spec2(moo=files[0], doo=files + [files[3]])
+    hash_threads = config.get('execution', 'hash_threads')
+    config.set('execution', 'hash_threads', '1')
+    serial = infields.get_hashval(hash_method='content')
+    config.set('execution', 'hash_threads', '4')
+    parallel = infields.get_hashval(hash_method='content')
+    config.set('execution', 'hash_threads', hash_threads)
+    yield assert_equal, parallel, serial
+    yield assert_equal, serial[0]['doo'][3], (files[3], serial[0]['doo'][10][1])
+    shutil.rmtree(tmpd)
+
 def test_Interface():
     yield assert_equal, nib.Interface.input_spec, None
     yield assert_equal, nib.Interface.output_spec, None
@@ -509,6 +529,31 @@ def test_CommandLine_output():
     os.chdir(pwd)
     teardown_file(tmpd)
 
+def test_CommandLine_output_file_tail():
+    tmpd = tempfile.mkdtemp()
+    pwd = os.getcwd()
+    os.chdir(tmpd)
+    config.set('execution', 'terminal_tail_lines', '10')
+    config.set('execution', 'terminal_log_size', '1000')
+    config.set('execution', 'terminal_log_rotate', '2')
+    ci = nib.CommandLine(command='seq 1 1000; echo err >&2; printf last',
+                         terminal_output='file_tail')
+    res = ci.run()
+    config.set_default_config()
+    stdout = res.runtime.stdout.split('\n')
+    yield assert_equal, len(stdout), 10
+    yield assert_equal, stdout[-2:], ['1000', 'last']
+    yield assert_equal, res.runtime.stderr, 'err'
+    yield assert_equal, len(res.runtime.merged), 10
+    yield assert_true, [line for line in res.runtime.merged
+                        if line.startswith('stderr ')]
+    yield assert_true, os.path.exists(os.path.join(tmpd, 'stdout.nipype.2'))
+    yield assert_false, os.path.exists(os.path.join(tmpd, 'stdout.nipype.3'))
+    yield assert_true, os.path.getsize(os.path.join(tmpd,
+                                                    'stdout.nipype')) <= 1000
+    os.chdir(pwd)
+    shutil.rmtree(tmpd)
+
 def test_global_CommandLine_output():
     tmp_infile = setup_file()
     tmpd, name = os.path.split(tmp_infile)
@@ -22,6 +22,7 @@ import cPickle
 from glob import glob
 import gzip
 import inspect
+from multiprocessing import current_process
 import os
 import os.path as op
 import re
@@ -54,10 +55,13 @@ from ..utils.filemanip import (save_json, FileNotFoundError,
                                write_rst_header, write_rst_dict,
                                write_rst_list)
 
+from .hashindex import get_hash_index
+from .records import record_file, save_record, load_output
 from .utils import (generate_expanded_graph, modify_paths,
                     export_graph, make_output_dir, write_workflow_prov,
                     clean_working_directory, format_dot, topological_sort,
-                    get_print_name, merge_dict, evaluate_connect_function)
+                    get_print_name, merge_dict, evaluate_connect_function,
+                    copy_config, shared_memo, get_peak_memory)
 
 
 def _write_inputs(node):
@@ -539,7 +543,7 @@ connected.
             if graph2use in ['flat', 'exec']:
                 graph = self._create_flat_graph()
             if graph2use == 'exec':
-                graph = generate_expanded_graph(deepcopy(graph))
+                graph = generate_expanded_graph(graph)
             export_graph(graph, base_dir, dotfilename=dotfilename,
                          format=format, simple_form=simple_form)
 
@@ -666,6 +670,7 @@ connected.
             else:
                 plugin_mod = getattr(sys.modules[name], '%sPlugin' % plugin)
                 runner = plugin_mod(plugin_args=plugin_args)
+        peak_memory = get_peak_memory()
         flatgraph = self._create_flat_graph()
         self.config = merge_dict(deepcopy(config._sections), self.config)
         if 'crashdump_dir' in self.config:
@@ -676,14 +681,20 @@ connected.
             del self.config['crashdump_dir']
         logger.info(str(sorted(self.config)))
         self._set_needed_outputs(flatgraph)
-        execgraph = generate_expanded_graph(deepcopy(flatgraph))
+        # the flat graph is a copy that is not used anymore: expand it in place
+        execgraph = generate_expanded_graph(flatgraph)
         for index, node in enumerate(execgraph.nodes()):
-            node.config = merge_dict(deepcopy(self.config), node.config)
+            node.config = merge_dict(copy_config(self.config), node.config)
             node.base_dir = self.base_dir
             node.index = index
             if isinstance(node, MapNode):
                 node.use_plugin = (plugin, plugin_args)
         self._configure_exec_nodes(execgraph)
+        expanded_peak_memory = get_peak_memory()
+        logger.info('Expanded graph: %d nodes, peak memory %.2f GB '
+                    '(%.2f GB more than before flattening)' %
+                    (execgraph.number_of_nodes(), expanded_peak_memory,
+                     expanded_peak_memory - peak_memory))
         if str2bool(self.config['execution']['create_report']):
             self._write_report_info(self.base_dir, self.name, execgraph)
         runner.run(execgraph, updatehash=updatehash, config=self.config)
@@ -922,7 +933,7 @@ connected.
     def _create_flat_graph(self):
         """Make a simple DAG where no node is a workflow."""
         logger.debug('Creating flat graph for workflow: %s', self.name)
-        workflowcopy = deepcopy(self)
+        workflowcopy = deepcopy(self, shared_memo(self._get_all_nodes()))
         workflowcopy._generate_flatgraph()
         return workflowcopy._graph
 
@@ -1105,7 +1116,8 @@ class Node(WorkflowBase):
 
     def __init__(self, interface, name, iterables=None, itersource=None,
                  synchronize=False, overwrite=None, needed_outputs=None,
-                 run_without_submitting=False, **kwargs):
+                 run_without_submitting=False, estimated_memory_gb=0.25,
+                 num_threads=1, **kwargs):
         """
         Parameters
         ----------
@@ -1170,6 +1182,14 @@ class Node(WorkflowBase):
             Run the node without submitting to a job engine or to a
             multiprocessing pool
 
+        estimated_memory_gb : float
+            Peak memory (in GB) the node is expected to use. Resource aware
+            plugins (e.g., MultiProc) use it to decide how many nodes can run
+            at the same time.
+
+        num_threads : int
+            Number of threads (cores) the node is expected to use.
+
         """
         base_dir = None
         if 'base_dir' in kwargs:
@@ -1188,6 +1208,8 @@ class Node(WorkflowBase):
         self.overwrite = overwrite
         self.parameterization = None
         self.run_without_submitting = run_without_submitting
+        self.estimated_memory_gb = estimated_memory_gb
+        self.num_threads = num_threads
         self.input_source = {}
         self.needed_outputs = []
         self.plugin_args = {}
@@ -1264,7 +1286,17 @@ class Node(WorkflowBase):
         # of the dictionary itself.
         hashed_inputs, hashvalue = self._get_hashval()
         outdir = self.output_dir()
-        if os.path.exists(outdir):
+        hashfile = os.path.join(outdir, '_0x%s.json' % hashvalue)
+        hash_index = self._hash_index()
+        if hash_index and not updatehash:
+            # the index is confirmed by a single stat of the hash file
+            entry = hash_index.lookup(outdir)
+            if (entry and entry[:2] == (hashvalue, 'done')
+                    and os.path.exists(hashfile)):
+                logger.debug('%s: hash found in index' % self.name)
+                return True, hashvalue, hashfile, hashed_inputs
+        log_debug = config.get('logging', 'workflow_level') == 'DEBUG'
+        if log_debug and os.path.exists(outdir):
             logger.debug(os.listdir(outdir))
         hashfiles = glob(os.path.join(outdir, '_0x*.json'))
         logger.debug(hashfiles)
@@ -1280,7 +1312,12 @@ class Node(WorkflowBase):
             for file in glob(os.path.join(outdir, '_0x*.json')):
                 os.remove(file)
             self._save_hashfile(hashfile, hashed_inputs)
-        return os.path.exists(hashfile), hashvalue, hashfile, hashed_inputs
+        hash_exists = os.path.exists(hashfile)
+        if hash_exists and hash_index:
+            hash_index.record(outdir, hashvalue, 'done',
+                              os.path.join(outdir, 'result_%s.pklz' %
+                                           self.name))
+        return hash_exists, hashvalue, hashfile, hashed_inputs
 
     def run(self, updatehash=False):
         """Execute the node in its directory.
@@ -1301,7 +1338,8 @@ class Node(WorkflowBase):
             self._got_inputs = True
         outdir = self.output_dir()
         logger.info("Executing node %s in dir: %s" % (self._id, outdir))
-        if os.path.exists(outdir):
+        log_debug = config.get('logging', 'workflow_level') == 'DEBUG'
+        if log_debug and os.path.exists(outdir):
             logger.debug(os.listdir(outdir))
         hash_info = self.hash_exists(updatehash=updatehash)
         hash_exists, hashvalue, hashfile, hashed_inputs = hash_info
@@ -1378,6 +1416,10 @@ class Node(WorkflowBase):
                         os.unlink(filename)
             outdir = make_output_dir(outdir)
             self._save_hashfile(hashfile_unfinished, hashed_inputs)
+            hash_index = self._hash_index()
+            resultfile = os.path.join(outdir, 'result_%s.pklz' % self.name)
+            if hash_index:
+                hash_index.record(outdir, hashvalue, 'running', resultfile)
             self.write_report(report_type='preexec', cwd=outdir)
             savepkl(os.path.join(outdir, '_node.pklz'), self)
             savepkl(os.path.join(outdir, '_inputs.pklz'),
@@ -1388,6 +1430,8 @@ class Node(WorkflowBase):
                 os.remove(hashfile_unfinished)
                 raise
             shutil.move(hashfile_unfinished, hashfile)
+            if hash_index:
+                hash_index.record(outdir, hashvalue, 'done', resultfile)
             self.write_report(report_type='postexec', cwd=outdir)
         else:
             if not os.path.exists(os.path.join(outdir, '_inputs.pklz')):
@@ -1415,6 +1459,20 @@ class Node(WorkflowBase):
         else:
             return param
 
+    def _hash_index(self):
+        """Return the hash index of the workflow directory of the node"""
+        execution = (self.config or {}).get('execution', {})
+        use_index = execution.get('use_hash_index',
+                                  config.get('execution', 'use_hash_index'))
+        if not str2bool(use_index):
+            return None
+        root = getattr(self, '_hash_index_root', None)
+        if root is None:
+            root = self.base_dir
+            if self._hierarchy:
+                root = os.path.join(root, self._hierarchy.split('.')[0])
+        return get_hash_index(root)
+
     def _get_hashval(self):
         """Return a hash of the input state"""
         if not self._got_inputs:
@@ -1461,21 +1519,16 @@ class Node(WorkflowBase):
             logger.debug('input: %s' % key)
             results_file = info[0]
             logger.debug('results file: %s' % results_file)
-            results = loadpkl(results_file)
-            output_value = Undefined
             if isinstance(info[1], tuple):
                 output_name = info[1][0]
-                value = getattr(results.outputs, output_name)
-                if isdefined(value):
-                    output_value = evaluate_connect_function(info[1][1],
-                                                             info[1][2],
-                                                             value)
             else:
                 output_name = info[1]
-                try:
-                    output_value = results.outputs.get()[output_name]
-                except TypeError:
-                    output_value = results.outputs.dictcopy()[output_name]
+            # the value may be shared by the result cache: do not modify it
+            output_value = load_output(results_file, output_name)
+            if isinstance(info[1], tuple) and isdefined(output_value):
+                output_value = evaluate_connect_function(info[1][1],
+                                                         info[1][2],
+                                                         deepcopy(output_value))
             logger.debug('output: %s' % output_name)
             try:
                 self.set_input(key, deepcopy(output_value))
@@ -1498,6 +1551,9 @@ class Node(WorkflowBase):
 
     def _save_results(self, result, cwd):
         resultsfile = os.path.join(cwd, 'result_%s.pklz' % self.name)
+        recordfile = record_file(resultsfile)
+        if os.path.exists(recordfile):
+            os.remove(recordfile)
         if result.outputs:
             try:
                 outputs = result.outputs.get()
@@ -1505,6 +1561,11 @@ class Node(WorkflowBase):
                 outputs = result.outputs.dictcopy()  # outputs was a bunch
             result.outputs.set(**modify_paths(outputs, relative=True,
                                               basedir=cwd))
+            if str2bool(self.config['execution']['use_output_records']):
+                try:
+                    save_record(recordfile, result.outputs.get())
+                except TypeError:
+                    save_record(recordfile, result.outputs.dictcopy())
 
         savepkl(resultsfile, result)
         logger.debug('saved results in %s' % resultsfile)
@@ -1987,9 +2048,15 @@ class MapNode(Node):
     ...                           'functional3.nii']
     >>> realign.run() # doctest: +SKIP
 
+    When the MapNode runs in the current process (e.g., with the Linear
+    plugin or `run_without_submitting`), its subnodes are run by a pool of
+    `n_procs` processes (default: the ``mapnode_n_procs`` execution option).
+
+    >>> realign = MapNode(fsl.MCFLIRT(), 'in_file', 'realign', n_procs=4)
+
     """
 
-    def __init__(self, interface, iterfield, name, **kwargs):
+    def __init__(self, interface, iterfield, name, n_procs=None, **kwargs):
         """
 
         Parameters
@@ -2003,6 +2070,9 @@ class MapNode(Node):
             paired (i.e. it does not compute a combinatorial product).
         name : alphanumeric string
             node specific name
+        n_procs : integer
+            number of processes running the subnodes when the MapNode runs
+            in the current process. 1 runs them serially.
 
         See Node docstring for additional keyword arguments.
         """
@@ -2010,6 +2080,7 @@ class MapNode(Node):
         if isinstance(iterfield, str):
             iterfield = [iterfield]
         self.iterfield = iterfield
+        self.n_procs = n_procs
         self._inputs = self._create_dynamic_traits(self._interface.inputs,
                                                    fields=self.iterfield)
         self._inputs.on_trait_change(self._set_mapnode_input)
@@ -2096,22 +2167,39 @@ class MapNode(Node):
         if cwd is None:
             cwd = self.output_dir()
         nitems = len(filename_to_list(getattr(self.inputs, self.iterfield[0])))
+        fieldvals = dict([(field, filename_to_list(getattr(self.inputs,
+                                                           field)))
+                          for field in self.iterfield])
+        # the subnodes are built from a single copy of the interface
+        template = Node(deepcopy(self._interface), name='_' + self.name)
+        template.overwrite = self.overwrite
+        template.run_without_submitting = self.run_without_submitting
+        template.estimated_memory_gb = self.estimated_memory_gb
+        template.num_threads = self.num_threads
+        template.plugin_args = self.plugin_args
+        template.config = self.config
+        template.base_dir = os.path.join(cwd, 'mapflow')
+        hash_index = self._hash_index()
+        if hash_index:
+            # subnodes share the index of the workflow
+            template._hash_index_root = hash_index.root
+        from .plugins.worker import node_spec, node_from_spec
+        spec = node_spec(template)
         for i in range(nitems):
             nodename = '_' + self.name + str(i)
-            node = Node(deepcopy(self._interface), name=nodename)
-            node.overwrite = self.overwrite
-            node.run_without_submitting = self.run_without_submitting
-            node.plugin_args = self.plugin_args
-            node._interface.inputs.set(
-                **deepcopy(self._interface.inputs.get()))
+            if isinstance(spec['interface'], basestring):
+                # the class rebuilds the interface from its inputs
+                node = node_from_spec(spec)
+            else:
+                # other interfaces (e.g., Function, whose inputs are created
+                # at runtime, or CommandLine) are copied
+                node = node_from_spec(dict(spec, interface=deepcopy(
+                    spec['interface'])))
+            node.name = node._id = nodename
             for field in self.iterfield:
-                fieldvals = filename_to_list(getattr(self.inputs, field))
                 logger.debug('setting input %d %s %s' % (i, field,
-                                                         fieldvals[i]))
-                setattr(node.inputs, field,
-                        fieldvals[i])
-            node.config = self.config
-            node.base_dir = os.path.join(cwd, 'mapflow')
+                                                         fieldvals[field][i]))
+                setattr(node.inputs, field, fieldvals[field][i])
             yield i, node
 
     def _node_runner(self, nodes, updatehash=False):
@@ -2125,38 +2213,67 @@ class MapNode(Node):
                     raise
             yield i, node, err
 
+    def _parallel_node_runner(self, nodes, n_procs, updatehash=False):
+        """Run the subnodes in a pool of processes, yielding them in order
+        """
+        from .plugins.multiproc import NonDaemonPool, run_node
+        from .plugins.worker import node_spec
+        pool = NonDaemonPool(processes=n_procs)
+        try:
+            tasks = [(i, node, pool.apply_async(run_node,
+                                                (node_spec(node), updatehash)))
+                     for i, node in nodes]
+            for i, node, task in tasks:
+                result = task.get()
+                node._result = result['result']
+                err = None
+                if result['traceback']:
+                    err = ''.join(result['traceback'])
+                    if str2bool(self.config['execution']
+                                ['stop_on_first_crash']):
+                        self._result = node.result
+                        raise RuntimeError('Subnode %d of node %s failed:\n%s'
+                                           % (i, self.name, err))
+                yield i, node, err
+        finally:
+            pool.terminate()
+            pool.join()
+
     def _collate_results(self, nodes):
         self._result = InterfaceResult(interface=[], runtime=[],
                                        provenance=[], inputs=[],
                                        outputs=self.outputs)
+        keys = []
+        if self.outputs:
+            keys = [key for key, _ in self.outputs.items()]
+            rm_extra = self.config['execution']['remove_unnecessary_outputs']
+            if str2bool(rm_extra) and self.needed_outputs:
+                keys = [key for key in keys if key in self.needed_outputs]
+        values = dict([(key, []) for key in keys])
+        defined = set()
         returncode = []
         for i, node, err in nodes:
-            self._result.runtime.insert(i, None)
-            if node.result:
-                if hasattr(node.result, 'runtime'):
-                    self._result.interface.insert(i, node.result.interface)
-                    self._result.inputs.insert(i, node.result.inputs)
-                    self._result.runtime[i] = node.result.runtime
-                if hasattr(node.result, 'provenance'):
-                    self._result.provenance.insert(i, node.result.provenance)
-            returncode.insert(i, err)
-            if self.outputs:
-                for key, _ in self.outputs.items():
-                    rm_extra = (self.config['execution']
-                                ['remove_unnecessary_outputs'])
-                    if str2bool(rm_extra) and self.needed_outputs:
-                        if key not in self.needed_outputs:
-                            continue
-                    values = getattr(self._result.outputs, key)
-                    if not isdefined(values):
-                        values = []
-                    if node.result.outputs:
-                        values.insert(i, node.result.outputs.get()[key])
-                    else:
-                        values.insert(i, None)
-                    defined_vals = [isdefined(val) for val in values]
-                    if any(defined_vals) and self._result.outputs:
-                        setattr(self._result.outputs, key, values)
+            self._result.runtime.append(None)
+            result = node.result
+            if result:
+                if hasattr(result, 'runtime'):
+                    self._result.interface.append(result.interface)
+                    self._result.inputs.append(result.inputs)
+                    self._result.runtime[i] = result.runtime
+                if hasattr(result, 'provenance'):
+                    self._result.provenance.append(result.provenance)
+            returncode.append(err)
+            outputs = {}
+            if keys and result and result.outputs:
+                outputs = result.outputs.get()
+            for key in keys:
+                value = outputs.get(key)
+                values[key].append(value)
+                if key not in defined and isdefined(value):
+                    defined.add(key)
+        if self._result.outputs:
+            for key in defined:
+                setattr(self._result.outputs, key, values[key])
         if returncode and any([code is not None for code in returncode]):
             msg = []
             for i, code in enumerate(returncode):
@@ -2247,9 +2364,23 @@ class MapNode(Node):
             nitems = len(filename_to_list(getattr(self.inputs,
                                                   self.iterfield[0])))
             nodenames = ['_' + self.name + str(i) for i in range(nitems)]
+            n_procs = self.n_procs
+            if n_procs is None:
+                n_procs = int(self.config['execution']['mapnode_n_procs'])
+            n_procs = min(n_procs, nitems)
+            if n_procs > 1 and current_process().daemon:
+                logger.debug('%s runs in a daemon process: running its '
+                             'subnodes serially' % self.name)
+                n_procs = 1
             # map-reduce formulation
-            self._collate_results(self._node_runner(self._make_nodes(cwd),
-                                                    updatehash=updatehash))
+            if n_procs > 1:
+                nodes = self._parallel_node_runner(self._make_nodes(cwd),
+                                                   n_procs,
+                                                   updatehash=updatehash)
+            else:
+                nodes = self._node_runner(self._make_nodes(cwd),
+                                          updatehash=updatehash)
+            self._collate_results(nodes)
             self._save_results(self._result, cwd)
             # remove any node directories no longer required
             dirs2remove = []
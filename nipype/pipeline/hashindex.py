@@ -0,0 +1,142 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Index of the node hashes of a workflow directory
+
+Checking whether a node is cached requires listing its output directory,
+which is slow on network file systems when workflows have many nodes.
+The index records, for each node output directory, the hash of the inputs
+it was last run with, its state and its result file. A cached node is then
+confirmed with a lookup and a single stat of its hash file, which remains
+the source of truth: entries that do not match the files on disk are
+ignored.
+
+The index is stored in the ``_hashindex`` directory of the workflow as
+append-only logs, one per process (shard), so that concurrent writers
+never share a file. Shards are merged when there are too many of them.
+"""
+
+from glob import glob
+import json
+from operator import itemgetter
+import os
+from socket import gethostname
+from time import time
+
+from .. import logging
+logger = logging.getLogger('workflow')
+
+_indexes = {}
+
+
+def get_hash_index(root):
+    """Return the index of the workflow directory `root`
+
+    Indexes are loaded once per process.
+    """
+    root = os.path.abspath(root)
+    if root not in _indexes:
+        _indexes[root] = HashIndex(root)
+    return _indexes[root]
+
+
+class HashIndex(object):
+    """Hash index of the nodes below `root`
+    """
+
+    # number of shards above which they are merged
+    max_shards = 100
+
+    def __init__(self, root):
+        self.root = root
+        self.index_dir = os.path.join(root, '_hashindex')
+        self._entries = None
+        self._shard = None
+        self._shard_pid = None
+
+    def _read_shards(self, shards):
+        records = []
+        for shard in shards:
+            try:
+                lines = open(shard, 'rt').readlines()
+            except IOError:
+                continue
+            for line in lines:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # partially written by a process that was killed
+                    continue
+        return sorted(records, key=itemgetter(0))
+
+    def _load(self):
+        shards = glob(os.path.join(self.index_dir, '*.log'))
+        records = self._read_shards(shards)
+        self._entries = dict([(key, (hashvalue, state, resultfile))
+                              for _, key, hashvalue, state, resultfile
+                              in records])
+        if len(shards) > self.max_shards:
+            self._merge(shards)
+
+    def _merge(self, shards):
+        """Replace the shards by a single one holding the current entries
+        """
+        stamp = time()
+        merged = os.path.join(self.index_dir, 'merged_%s_%d.log' %
+                              (gethostname(), os.getpid()))
+        fp = open(merged + '.tmp', 'wt')
+        for key, (hashvalue, state, resultfile) in self._entries.items():
+            fp.write(json.dumps([stamp, key, hashvalue, state, resultfile]) +
+                     '\n')
+        fp.close()
+        os.rename(merged + '.tmp', merged)
+        for shard in shards:
+            if shard != merged and shard != self._shard:
+                try:
+                    os.remove(shard)
+                except OSError:
+                    pass
+        logger.debug('merged %d hash index shards' % len(shards))
+
+    def _relpath(self, outdir):
+        return os.path.relpath(outdir, self.root)
+
+    def lookup(self, outdir):
+        """Return the (hashvalue, state, resultfile) recorded for `outdir`
+        """
+        if self._entries is None:
+            self._load()
+        entry = self._entries.get(self._relpath(outdir))
+        if entry and entry[2]:
+            entry = entry[:2] + (os.path.join(self.root, entry[2]),)
+        return entry
+
+    def record(self, outdir, hashvalue, state, resultfile=None):
+        """Record the hash and state ('running' or 'done') of a node
+        """
+        if self._entries is None:
+            self._load()
+        key = self._relpath(outdir)
+        if resultfile:
+            resultfile = self._relpath(resultfile)
+        entry = (hashvalue, state, resultfile)
+        if self._entries.get(key) == entry:
+            return
+        self._entries[key] = entry
+        if self._shard_pid != os.getpid():
+            # a new process (e.g., a forked worker) gets its own shard
+            if not os.path.exists(self.index_dir):
+                try:
+                    os.makedirs(self.index_dir)
+                except OSError:
+                    # created by another process
+                    pass
+            self._shard = os.path.join(self.index_dir, '%s_%d.log' %
+                                       (gethostname(), os.getpid()))
+            self._shard_pid = os.getpid()
+        try:
+            fp = open(self._shard, 'at')
+            fp.write(json.dumps([time(), key, hashvalue, state, resultfile]) +
+                     '\n')
+            fp.close()
+        except IOError, e:
+            logger.debug('Could not update the hash index: %s' % e)
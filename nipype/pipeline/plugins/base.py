@@ -3,19 +3,21 @@
 """Common graph operations for execution
 """
 
+from collections import deque
 from copy import deepcopy
 from glob import glob
 import os
 import pwd
 import shutil
 from socket import gethostname
+import subprocess
 import sys
+import threading
 from time import strftime, sleep, time
 from traceback import format_exception, format_exc
 from warnings import warn
 
 import numpy as np
-import scipy.sparse as ssp
 
 
 from ..utils import (nx, dfs_preorder, topological_sort)
@@ -23,6 +25,7 @@ from ..engine import (MapNode, str2bool)
 
 from nipype.utils.filemanip import savepkl, loadpkl
 from nipype.interfaces.utility import Function
+from .worker import create_queue, node_spec
 
 
 from ... import logging
@@ -91,17 +94,23 @@ def report_nodes_not_run(notrun):
                             'Check log for details'))
 
 
+def get_batch_dir(node):
+    """Directory holding the batch scripts of the workflow of a node
+    """
+    if node._hierarchy:
+        return os.path.join(node.base_dir, node._hierarchy.split('.')[0],
+                            'batch')
+    return os.path.join(node.base_dir, 'batch')
+
+
 def create_pyscript(node, updatehash=False, store_exception=True):
     # pickle node
     timestamp = strftime('%Y%m%d_%H%M%S')
     if node._hierarchy:
         suffix = '%s_%s_%s' % (timestamp, node._hierarchy, node._id)
-        batch_dir = os.path.join(node.base_dir,
-                                 node._hierarchy.split('.')[0],
-                                 'batch')
     else:
         suffix = '%s_%s' % (timestamp, node._id)
-        batch_dir = os.path.join(node.base_dir, 'batch')
+    batch_dir = get_batch_dir(node)
     if not os.path.exists(batch_dir):
         os.makedirs(batch_dir)
     pkl_file = os.path.join(batch_dir, 'node_%s.pklz' % suffix)
@@ -168,6 +177,31 @@ except Exception, e:
     return pyscript
 
 
+bundle_script = """import subprocess
+import sys
+pyscripts = %s
+nprocs = %d
+def run(pyscript):
+    return subprocess.call([sys.executable, pyscript])
+if nprocs > 1:
+    from multiprocessing.pool import ThreadPool
+    returncodes = ThreadPool(nprocs).map(run, pyscripts)
+else:
+    returncodes = map(run, pyscripts)
+sys.exit(max(returncodes))
+"""
+
+
+worker_script = """try:
+    import matplotlib
+    matplotlib.use('%s')
+except ImportError:
+    pass
+from nipype.pipeline.plugins.worker import serve
+serve('%s', '%s', idle_timeout=%f)
+"""
+
+
 class PluginBase(object):
     """Base class for plugins"""
 
@@ -190,26 +224,51 @@ class DistributedPluginBase(PluginBase):
         """Initialize runtime attributes to none
 
         procs: list (N) of underlying interface elements to be processed
-        proc_done: a boolean vector (N) signifying whether a process has been
+        proc_done: a boolean list (N) signifying whether a process has been
             executed
-        proc_pending: a boolean vector (N) signifying whether a
+        proc_pending: a boolean list (N) signifying whether a
             process is currently running. Note: A process is finished only when
             both proc_done==True and
         proc_pending==False
-        depidx: a boolean matrix (NxN) storing the dependency structure accross
-            processes. Process dependencies are derived from each column.
+        depidx: a list (N) of lists holding, for each process, the indices of
+            the processes that depend on it
+        depcount: a list (N) with the number of unfinished dependencies of
+            each process
+        refidx: a list (N) of lists holding, for each process, the indices of
+            the processes it takes inputs from
+        refcount: a list (N) with the number of unfinished processes that
+            still need the outputs of each process
+        readytorun: a deque of processes whose dependencies have finished
+        tosubmit: a list of processes that passed the local checks and are
+            waiting for a worker
         """
         super(DistributedPluginBase, self).__init__(plugin_args=plugin_args)
         self.procs = None
+        self.procidx = None
         self.depidx = None
+        self.depcount = None
         self.refidx = None
+        self.refcount = None
+        self.readytorun = None
+        self.tosubmit = None
         self.mapnodes = None
         self.mapnodesubids = None
         self.proc_done = None
         self.proc_pending = None
         self.max_jobs = np.inf
-        if plugin_args and 'max_jobs' in plugin_args:
-            self.max_jobs = plugin_args['max_jobs']
+        self._poll_sleep_duration = 2.
+        if plugin_args:
+            if 'max_jobs' in plugin_args:
+                self.max_jobs = plugin_args['max_jobs']
+            if 'poll_sleep_duration' in plugin_args:
+                self._poll_sleep_duration = \
+                    float(plugin_args['poll_sleep_duration'])
+        # submit each job as soon as it is ready rather than once all ready
+        # jobs have been checked
+        self._eager_submission = True
+        self._min_poll_duration = min(0.05, self._poll_sleep_duration)
+        self._poll_interval = self._min_poll_duration
+        self._task_done = threading.Event()
 
     def run(self, graph, config, updatehash=False):
         """Executes a pre-defined pipeline using distributed approaches
@@ -219,13 +278,16 @@ class DistributedPluginBase(PluginBase):
         # Generate appropriate structures for worker-manager model
         self._generate_dependency_list(graph)
         self.pending_tasks = []
-        self.readytorun = []
-        self.mapnodes = []
+        self.tosubmit = []
+        self.mapnodes = set()
         self.mapnodesubids = {}
-        # setup polling - TODO: change to threaded model
+        self._poll_interval = self._min_poll_duration
         notrun = []
-        while np.any(self.proc_done == False) | \
-                    np.any(self.proc_pending == True):
+        while self.readytorun or self.tosubmit or self.pending_tasks:
+            # clear before collecting results so that a completion signalled
+            # while we are busy below wakes the next wait immediately
+            self._task_done.clear()
+            num_finished = 0
             toappend = []
             # trigger callbacks for any pending results
             while self.pending_tasks:
@@ -233,6 +295,7 @@ class DistributedPluginBase(PluginBase):
                 try:
                     result = self._get_result(taskid)
                     if result:
+                        num_finished += 1
                         if result['traceback']:
                             notrun.append(self._clean_queue(jobid, graph,
                                                             result=result))
@@ -243,6 +306,7 @@ class DistributedPluginBase(PluginBase):
                     else:
                         toappend.insert(0, (taskid, jobid))
                 except Exception:
+                    num_finished += 1
                     result = {'result': None,
                               'traceback': format_exc()}
                     notrun.append(self._clean_queue(jobid, graph,
@@ -257,10 +321,33 @@ class DistributedPluginBase(PluginBase):
                     slots = self.max_jobs - num_jobs
                 self._send_procs_to_workers(updatehash=updatehash,
                                             slots=slots, graph=graph)
-            sleep(2)
+            if self.pending_tasks or self.readytorun or self.tosubmit:
+                self._wait(num_finished)
         self._remove_node_dirs()
         report_nodes_not_run(notrun)
 
+    def _notify_task_completed(self, *args):
+        """Wake up the scheduler loop
+
+        Plugins whose workers report completion asynchronously (e.g., through
+        a result callback) should call this from the callback. It is safe to
+        call from any thread.
+        """
+        self._task_done.set()
+
+    def _wait(self, num_finished=0):
+        """Block until a task completes or the poll interval expires
+
+        Polling is only a fallback: the wait returns as soon as
+        `_notify_task_completed` is called. While no task finishes the poll
+        interval is doubled, up to `poll_sleep_duration` seconds.
+        """
+        if num_finished:
+            self._poll_interval = self._min_poll_duration
+        if not self._task_done.wait(self._poll_interval):
+            self._poll_interval = min(2 * self._poll_interval,
+                                      self._poll_sleep_duration)
+
     def _get_result(self, taskid):
         raise NotImplementedError
 
@@ -294,100 +381,145 @@ class DistributedPluginBase(PluginBase):
     def _submit_mapnode(self, jobid):
         if jobid in self.mapnodes:
             return True
-        self.mapnodes.append(jobid)
+        self.mapnodes.add(jobid)
         mapnodesubids = self.procs[jobid].get_subnodes()
         numnodes = len(mapnodesubids)
         logger.info('Adding %d jobs for mapnode %s' % (numnodes,
                                                        self.procs[jobid]._id))
-        for i in range(numnodes):
-            self.mapnodesubids[self.depidx.shape[0] + i] = jobid
-        self.procs.extend(mapnodesubids)
-        self.depidx = ssp.vstack((self.depidx,
-                                  ssp.lil_matrix(np.zeros((numnodes,
-                                                           self.depidx.shape[1])))),
-                                 'lil')
-        self.depidx = ssp.hstack((self.depidx,
-                                  ssp.lil_matrix(
-                                      np.zeros((self.depidx.shape[0],
-                                                numnodes)))),
-                                 'lil')
-        self.depidx[-numnodes:, jobid] = 1
-        self.proc_done = np.concatenate((self.proc_done,
-                                         np.zeros(numnodes, dtype=bool)))
-        self.proc_pending = np.concatenate((self.proc_pending,
-                                            np.zeros(numnodes, dtype=bool)))
+        # the mapnode becomes runnable again once all subnodes have finished
+        self.depcount[jobid] += numnodes
+        for subnode in mapnodesubids:
+            subid = len(self.procs)
+            self.mapnodesubids[subid] = jobid
+            self.procs.append(subnode)
+            self.procidx[subnode] = subid
+            self.proc_done.append(False)
+            self.proc_pending.append(False)
+            self.depidx.append([jobid])
+            self.depcount.append(0)
+            self.refidx.append([])
+            self.refcount.append(0)
+            self.readytorun.append(subid)
         return False
 
     def _send_procs_to_workers(self, updatehash=False, slots=None, graph=None):
-        """ Sends jobs to workers using ipython's taskclient interface
+        """ Sends jobs that are ready to run to the workers
+
+        Jobs are first checked on the master: MapNodes are expanded, cached
+        jobs and jobs marked run_without_submitting finish right away. The
+        remaining jobs are queued in `tosubmit` and handed to the workers
+        as chosen by `_select_jobs`, each as soon as it is ready or, without
+        eager submission, all together at the end of the pass. At most
+        `slots` jobs are submitted.
         """
-        while np.any(self.proc_done == False):
-            # Check to see if a job is available
-            jobids = np.flatnonzero((self.proc_done == False) &
-                                    (self.depidx.sum(axis=0) == 0).__array__())
-            if len(jobids) > 0:
-                # send all available jobs
-                logger.info('Submitting %d jobs' % len(jobids))
-                for jobid in jobids[:slots]:
-                    if isinstance(self.procs[jobid], MapNode):
-                        try:
-                            num_subnodes = self.procs[jobid].num_subnodes()
-                        except Exception:
-                            self._clean_queue(jobid, graph)
-                            self.proc_pending[jobid] = False
-                            continue
-                        if num_subnodes > 1:
-                            submit = self._submit_mapnode(jobid)
-                            if not submit:
-                                continue
-                    # change job status in appropriate queues
-                    self.proc_done[jobid] = True
-                    self.proc_pending[jobid] = True
-                    # Send job to task manager and add to pending tasks
-                    logger.info('Executing: %s ID: %d' %
-                               (self.procs[jobid]._id, jobid))
-                    if self._status_callback:
-                        self._status_callback(self.procs[jobid], 'start')
-                    continue_with_submission = True
-                    if str2bool(self.procs[jobid].config['execution']['local_hash_check']):
-                        logger.debug('checking hash locally')
-                        try:
-                            hash_exists, _, _, _ = self.procs[
-                                jobid].hash_exists()
-                            logger.debug('Hash exists %s' % str(hash_exists))
-                            if (hash_exists and
-                               (self.procs[jobid].overwrite == False or
-                               (self.procs[jobid].overwrite == None and
-                                    not self.procs[jobid]._interface.always_run))):
-                                continue_with_submission = False
-                                self._task_finished_cb(jobid)
-                                self._remove_node_dirs()
-                        except Exception:
-                            self._clean_queue(jobid, graph)
-                            self.proc_pending[jobid] = False
-                            continue_with_submission = False
-                    logger.debug('Finished checking hash %s' %
-                                 str(continue_with_submission))
-                    if continue_with_submission:
-                        if self.procs[jobid].run_without_submitting:
-                            logger.debug('Running node %s on master thread' %
-                                         self.procs[jobid])
-                            try:
-                                self.procs[jobid].run()
-                            except Exception:
-                                self._clean_queue(jobid, graph)
-                            self._task_finished_cb(jobid)
-                            self._remove_node_dirs()
-                        else:
-                            tid = self._submit_job(deepcopy(self.procs[jobid]),
-                                                   updatehash=updatehash)
-                            if tid is None:
-                                self.proc_done[jobid] = False
-                                self.proc_pending[jobid] = False
-                            else:
-                                self.pending_tasks.insert(0, (tid, jobid))
-            else:
-                break
+        if self._eager_submission:
+            # jobs held back on a previous pass go first
+            slots = self._submit_queued(self.tosubmit, slots, updatehash)
+        if self.readytorun:
+            logger.info('Submitting %d jobs' % len(self.readytorun))
+        while self.readytorun:
+            jobid = self.readytorun.popleft()
+            if self.proc_done[jobid]:
+                # a dependency crashed after this job became ready
+                continue
+            if isinstance(self.procs[jobid], MapNode):
+                try:
+                    num_subnodes = self.procs[jobid].num_subnodes()
+                except Exception:
+                    self._clean_queue(jobid, graph)
+                    self.proc_pending[jobid] = False
+                    continue
+                if num_subnodes > 1:
+                    submit = self._submit_mapnode(jobid)
+                    if not submit:
+                        continue
+            # change job status in appropriate queues
+            self.proc_done[jobid] = True
+            self.proc_pending[jobid] = True
+            # Send job to task manager and add to pending tasks
+            logger.info('Executing: %s ID: %d' %
+                        (self.procs[jobid]._id, jobid))
+            if self._status_callback:
+                self._status_callback(self.procs[jobid], 'start')
+            continue_with_submission = True
+            if str2bool(self.procs[jobid].config['execution']['local_hash_check']):
+                logger.debug('checking hash locally')
+                try:
+                    hash_exists, _, _, _ = self.procs[
+                        jobid].hash_exists()
+                    logger.debug('Hash exists %s' % str(hash_exists))
+                    if (hash_exists and
+                       (self.procs[jobid].overwrite == False or
+                       (self.procs[jobid].overwrite == None and
+                            not self.procs[jobid]._interface.always_run))):
+                        continue_with_submission = False
+                        self._task_finished_cb(jobid)
+                        self._remove_node_dirs()
+                except Exception:
+                    self._clean_queue(jobid, graph)
+                    self.proc_pending[jobid] = False
+                    continue_with_submission = False
+            logger.debug('Finished checking hash %s' %
+                         str(continue_with_submission))
+            if continue_with_submission:
+                if self.procs[jobid].run_without_submitting:
+                    logger.debug('Running node %s on master thread' %
+                                 self.procs[jobid])
+                    try:
+                        self.procs[jobid].run()
+                    except Exception:
+                        self._clean_queue(jobid, graph)
+                    self._task_finished_cb(jobid)
+                    self._remove_node_dirs()
+                else:
+                    self.tosubmit.append(jobid)
+                    if self._eager_submission and (slots is None or
+                                                   slots > 0):
+                        slots = self._submit_queued([jobid], slots,
+                                                    updatehash)
+        if not self._eager_submission:
+            self._submit_queued(self.tosubmit, slots, updatehash)
+
+    def _select_jobs(self, jobids, slots):
+        """ Returns the queued jobs that should be submitted now
+
+        The base implementation submits in order, up to `slots` jobs.
+        Plugins that schedule by resources override this.
+        """
+        if slots is None:
+            return list(jobids)
+        return jobids[:slots]
+
+    def _submit_queued(self, jobids, slots, updatehash=False):
+        """ Submits the jobs chosen by `_select_jobs` among `jobids`
+
+        Returns the number of slots left.
+        """
+        if not jobids or slots == 0:
+            return slots
+        submitted = set()
+        for jobid, tid in self._submit_jobs(self._select_jobs(jobids, slots),
+                                            updatehash=updatehash):
+            if tid is None:
+                # retried on the next pass
+                continue
+            submitted.add(jobid)
+            self.pending_tasks.insert(0, (tid, jobid))
+            if slots is not None:
+                slots -= 1
+        if submitted:
+            self.tosubmit = [jobid for jobid in self.tosubmit
+                             if jobid not in submitted]
+        return slots
+
+    def _submit_jobs(self, jobids, updatehash=False):
+        """ Submits the jobs and returns a list of (jobid, taskid) pairs
+
+        The taskid is None for jobs that could not be submitted.
+        """
+        return [(jobid, self._submit_job(deepcopy(self.procs[jobid]),
+                                         updatehash=updatehash))
+                for jobid in jobids]
 
     def _task_finished_cb(self, jobid):
         """ Extract outputs and assign to inputs of dependent tasks
@@ -401,31 +533,44 @@ class DistributedPluginBase(PluginBase):
         # Update job and worker queues
         self.proc_pending[jobid] = False
         # update the job dependency structure
-        rowview = self.depidx.getrowview(jobid)
-        rowview[rowview.nonzero()] = 0
+        dependents = self.depidx[jobid]
+        self.depidx[jobid] = []
+        for depid in dependents:
+            self.depcount[depid] -= 1
+            if self.depcount[depid] == 0 and not self.proc_done[depid]:
+                self.readytorun.append(depid)
         if jobid not in self.mapnodesubids:
-            self.refidx[self.refidx[:, jobid].nonzero()[0], jobid] = 0
+            providers = self.refidx[jobid]
+            self.refidx[jobid] = []
+            for refid in providers:
+                self.refcount[refid] -= 1
+                if self.refcount[refid] == 0:
+                    self._removable.append(refid)
+            if self.refcount[jobid] == 0:
+                self._removable.append(jobid)
 
     def _generate_dependency_list(self, graph):
         """ Generates a dependency list for a list of graphs.
         """
         self.procs, _ = topological_sort(graph)
-        try:
-            self.depidx = nx.to_scipy_sparse_matrix(graph,
-                                                    nodelist=self.procs,
-                                                    format='lil')
-        except:
-            self.depidx = nx.to_scipy_sparse_matrix(graph,
-                                                    nodelist=self.procs)
-        self.refidx = deepcopy(self.depidx)
-        self.refidx.astype = np.int
-        self.proc_done = np.zeros(len(self.procs), dtype=bool)
-        self.proc_pending = np.zeros(len(self.procs), dtype=bool)
+        self.procidx = dict([(node, idx) for idx, node in
+                             enumerate(self.procs)])
+        self.depidx = [[self.procidx[succ] for succ in graph.successors(node)]
+                       for node in self.procs]
+        self.depcount = [graph.in_degree(node) for node in self.procs]
+        self.refidx = [[self.procidx[pred] for pred in graph.predecessors(node)]
+                       for node in self.procs]
+        self.refcount = [len(dependents) for dependents in self.depidx]
+        self.readytorun = deque([idx for idx, count in
+                                 enumerate(self.depcount) if count == 0])
+        self._removable = []
+        self.proc_done = [False] * len(self.procs)
+        self.proc_pending = [False] * len(self.procs)
 
     def _remove_node_deps(self, jobid, crashfile, graph):
         subnodes = [s for s in dfs_preorder(graph, self.procs[jobid])]
         for node in subnodes:
-            idx = self.procs.index(node)
+            idx = self.procidx[node]
             self.proc_done[idx] = True
             self.proc_pending[idx] = False
         return dict(node=self.procs[jobid],
@@ -435,13 +580,12 @@ class DistributedPluginBase(PluginBase):
     def _remove_node_dirs(self):
         """Removes directories whose outputs have already been used up
         """
+        removable = self._removable
+        self._removable = []
         if str2bool(self._config['execution']['remove_node_directories']):
-            for idx in np.nonzero((self.refidx.sum(axis=1) == 0).__array__())[0]:
-                if idx in self.mapnodesubids:
-                    continue
+            for idx in removable:
                 if self.proc_done[idx] and (not self.proc_pending[idx]):
-                    self.refidx[idx, idx] = -1
-                    outdir = self.procs[idx]._output_directory()
+                    outdir = self.procs[idx].output_dir()
                     logger.info(('[node dependencies finished] '
                                  'removing node: %s from directory %s') %
                                 (self.procs[idx]._id, outdir))
@@ -450,12 +594,38 @@ class DistributedPluginBase(PluginBase):
 
 class SGELikeBatchManagerBase(DistributedPluginBase):
     """Execute workflow with SGE/OGE/PBS like batch system
+
+    The state of the submitted jobs is retrieved with a single query of the
+    batch system (`_query_jobs`), at most once every
+    `status_refresh_interval` seconds (plugin argument, defaults to
+    `poll_sleep_duration`).
+
+    Short nodes can be bundled into a single batch job with the `bundle_size`
+    (maximum number of nodes per job) and `bundle_runtime` (target runtime in
+    seconds, estimated from the `estimated_runtime` entry of the node
+    plugin_args) plugin arguments. The nodes of a bundle run one after the
+    other, or `bundle_procs` at a time, and each writes its own results.
+
+    With the `workers` plugin argument, up to that many long running batch
+    jobs are started instead, which run the queued nodes one after the other
+    (see `nipype.pipeline.plugins.worker`). A worker exits once it has been
+    idle for `worker_timeout` seconds (default: 60) and is started again
+    when new nodes are queued.
     """
 
+    # job states reported by `_query_jobs` that mean the job has finished
+    _finished_states = frozenset()
+
     def __init__(self, template, plugin_args=None):
         super(SGELikeBatchManagerBase, self).__init__(plugin_args=plugin_args)
         self._template = template
         self._qsub_args = None
+        self._bundle_size = 1
+        self._bundle_runtime = None
+        self._bundle_procs = 1
+        self._n_workers = 0
+        self._worker_timeout = 60.
+        self._status_refresh_interval = self._poll_sleep_duration
         if plugin_args:
             if 'template' in plugin_args:
                 self._template = plugin_args['template']
@@ -463,12 +633,171 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
                     self._template = open(self._template).read()
             if 'qsub_args' in plugin_args:
                 self._qsub_args = plugin_args['qsub_args']
+            if 'status_refresh_interval' in plugin_args:
+                self._status_refresh_interval = \
+                    float(plugin_args['status_refresh_interval'])
+            if 'bundle_size' in plugin_args:
+                self._bundle_size = int(plugin_args['bundle_size'])
+            if 'bundle_runtime' in plugin_args:
+                self._bundle_runtime = float(plugin_args['bundle_runtime'])
+            if 'bundle_procs' in plugin_args:
+                self._bundle_procs = int(plugin_args['bundle_procs'])
+            if 'workers' in plugin_args:
+                self._n_workers = int(plugin_args['workers'])
+            if 'worker_timeout' in plugin_args:
+                self._worker_timeout = float(plugin_args['worker_timeout'])
+        if not self._n_workers and (self._bundle_size > 1 or
+                                    self._bundle_runtime):
+            # collect all ready jobs before packing them into bundles
+            self._eager_submission = False
         self._pending = {}
+        self._bundles = {}
+        self._bundled = {}
+        self._queue_dir = None
+        self._queued = set()
+        self._num_queued = 0
+        self._workers = {}
+        self._worker_node = None
+        self._submit_times = {}
+        self._job_states = None
+        self._status_time = None
+        self._query_time = None
+
+    def run(self, graph, config, updatehash=False):
+        self._queue_dir = None
+        try:
+            super(SGELikeBatchManagerBase, self).run(graph, config,
+                                                     updatehash=updatehash)
+        finally:
+            if self._queue_dir is not None:
+                # tell the workers to exit
+                open(os.path.join(self._queue_dir, 'stop'), 'wt').close()
+
+    def _query_jobs(self):
+        """Query the state of all jobs in the batch system
+
+        Returns a dictionary mapping job ids (as strings) to the state
+        reported by the batch system, or None if the query failed.
+        """
+        raise NotImplementedError
+
+    def _run_status_command(self, cmd, no_jobs_msg=None):
+        """Run a batch system status command
+
+        Returns the standard output or None if the command failed. Commands
+        that exit with an error when no job is listed can pass the message
+        they print in that case as `no_jobs_msg`.
+        """
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        except OSError, e:
+            logger.debug('Could not run %s: %s' % (cmd[0], e))
+            return None
+        o, e = proc.communicate()
+        if no_jobs_msg and no_jobs_msg in e:
+            return ''
+        if proc.returncode:
+            logger.debug('%s failed with exit code %d: %s' %
+                         (cmd[0], proc.returncode, e))
+            return None
+        return o
+
+    def _refresh_job_states(self):
+        query_time = time()
+        self._query_time = query_time
+        job_states = self._query_jobs()
+        if job_states is None:
+            logger.debug('Could not query the batch system, keeping the '
+                          'previous job states')
+        else:
+            self._job_states = job_states
+            self._status_time = query_time
 
     def _is_pending(self, taskid):
         """Check if a task is pending in the batch system
+
+        Answered from the cached job states, which are refreshed when older
+        than the refresh interval or than the submission of the task.
         """
-        raise NotImplementedError
+        if taskid in self._queued:
+            return self._is_queued(taskid)
+        return self._is_batch_job_pending(self._bundled.get(taskid, taskid))
+
+    def _is_batch_job_pending(self, batchid):
+        submit_time = self._submit_times.get(batchid, 0)
+        if (self._query_time is None or
+                self._query_time < submit_time or
+                time() - self._query_time >= self._status_refresh_interval):
+            self._refresh_job_states()
+        if self._job_states is None:
+            return True
+        if self._status_time is not None and submit_time > self._status_time:
+            # submitted after the last successful query, the job cannot be
+            # listed in the job states yet
+            return True
+        state = self._job_states.get(str(batchid))
+        return state is not None and state not in self._finished_states
+
+    def _is_queued(self, taskid):
+        """Check if a task queued for the workers has not finished yet
+        """
+        donefile = os.path.join(self._queue_dir, 'done', taskid)
+        if os.path.exists(donefile):
+            return False
+        claimed = glob(os.path.join(self._queue_dir, 'claimed',
+                                    '%s.*.pklz' % taskid))
+        if not claimed:
+            self._start_workers()
+            return True
+        worker = claimed[0].split('.')[-2]
+        if self._is_batch_job_pending(self._workers[worker]):
+            return True
+        # the worker is gone, either it just finished the task or it was
+        # killed while running it
+        return False
+
+    def _start_workers(self):
+        """Submit workers until there are enough for the queued tasks
+        """
+        active = [name for name, batchid in self._workers.items()
+                  if self._is_batch_job_pending(batchid)]
+        for _ in range(min(self._n_workers, len(self._queued)) -
+                       len(active)):
+            name = 'worker%d' % len(self._workers)
+            workerscript = os.path.join(self._queue_dir,
+                                        'workerscript_%s.py' % name)
+            fp = open(workerscript, 'wt')
+            fp.writelines(worker_script % (
+                self._config['execution']['matplotlib_backend'],
+                self._queue_dir, name, self._worker_timeout))
+            fp.close()
+            batchid = self._submit_script(workerscript, self._worker_node)
+            del self._pending[batchid]
+            self._workers[name] = batchid
+            logger.debug('submitted worker %s: %s' % (name, str(batchid)))
+
+    def _queue_job(self, node, updatehash=False):
+        """queue job for the workers and return taskid
+        """
+        if self._queue_dir is None:
+            self._queue_dir = os.path.join(
+                get_batch_dir(node),
+                'workers_%s' % strftime('%Y%m%d_%H%M%S'))
+            create_queue(self._queue_dir)
+        self._num_queued += 1
+        taskid = 'task%06d' % self._num_queued
+        # write next to the queue and move in place so that workers never
+        # see a partial file
+        taskfile = os.path.join(self._queue_dir, '%s.pklz' % taskid)
+        savepkl(taskfile, dict(spec=node_spec(node), updatehash=updatehash))
+        os.rename(taskfile, os.path.join(self._queue_dir, 'todo',
+                                         '%s.pklz' % taskid))
+        self._pending[taskid] = node.output_dir()
+        self._queued.add(taskid)
+        self._worker_node = node
+        self._start_workers()
+        return taskid
 
     def _submit_batchtask(self, scriptfile, node):
         """Submit a task to the batch system
@@ -477,7 +806,7 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
 
     def _get_result(self, taskid):
         if taskid not in self._pending:
-            raise Exception('Task %d not found' % taskid)
+            raise Exception('Task %s not found' % str(taskid))
         if self._is_pending(taskid):
             return None
         node_dir = self._pending[taskid]
@@ -526,10 +855,10 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
             result_out['result'] = result_data
         return result_out
 
-    def _submit_job(self, node, updatehash=False):
-        """submit job and return taskid
+    def _submit_script(self, pyscript, node):
+        """write the batch script running pyscript, submit it and return
+        the taskid
         """
-        pyscript = create_pyscript(node, updatehash=updatehash)
         batch_dir, name = os.path.split(pyscript)
         name = '.'.join(name.split('.')[:-1])
         batchscript = '\n'.join((self._template,
@@ -538,7 +867,78 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
         fp = open(batchscriptfile, 'wt')
         fp.writelines(batchscript)
         fp.close()
-        return self._submit_batchtask(batchscriptfile, node)
+        submit_time = time()
+        taskid = self._submit_batchtask(batchscriptfile, node)
+        self._submit_times[taskid] = submit_time
+        return taskid
+
+    def _submit_job(self, node, updatehash=False):
+        """submit job and return taskid
+        """
+        if self._n_workers:
+            return self._queue_job(node, updatehash=updatehash)
+        pyscript = create_pyscript(node, updatehash=updatehash)
+        return self._submit_script(pyscript, node)
+
+    def _submit_bundle(self, nodes, updatehash=False):
+        """submit nodes as a single batch job and return a taskid per node
+        """
+        pyscripts = [create_pyscript(node, updatehash=updatehash)
+                     for node in nodes]
+        batch_dir, name = os.path.split(pyscripts[0])
+        bundlescript = os.path.join(batch_dir,
+                                    name.replace('pyscript_',
+                                                 'pyscript_bundle_'))
+        fp = open(bundlescript, 'wt')
+        fp.writelines(bundle_script % (pyscripts, self._bundle_procs))
+        fp.close()
+        batchid = self._submit_script(bundlescript, nodes[0])
+        del self._pending[batchid]
+        taskids = []
+        for idx, node in enumerate(nodes):
+            taskid = (batchid, idx)
+            self._pending[taskid] = node.output_dir()
+            self._bundled[taskid] = batchid
+            taskids.append(taskid)
+        self._bundles[batchid] = set(taskids)
+        logger.debug('submitted bundle %s with %d nodes' % (str(batchid),
+                                                            len(nodes)))
+        return taskids
+
+    def _make_bundles(self, jobids):
+        """Group jobs with the same plugin_args into bundles
+        """
+        bundles = []
+        open_bundles = {}
+        for jobid in jobids:
+            plugin_args = dict(self.procs[jobid].plugin_args)
+            runtime = float(plugin_args.pop('estimated_runtime', 0))
+            key = repr(sorted(plugin_args.items()))
+            if key not in open_bundles:
+                open_bundles[key] = ([], [0.])
+                bundles.append(open_bundles[key][0])
+            bundle, bundle_runtime = open_bundles[key]
+            bundle.append(jobid)
+            bundle_runtime[0] += runtime
+            if (len(bundle) >= self._bundle_size > 1 or
+                (self._bundle_runtime and
+                 bundle_runtime[0] >= self._bundle_runtime)):
+                del open_bundles[key]
+        return bundles
+
+    def _submit_jobs(self, jobids, updatehash=False):
+        if self._eager_submission:
+            return super(SGELikeBatchManagerBase,
+                         self)._submit_jobs(jobids, updatehash=updatehash)
+        submitted = []
+        for bundle in self._make_bundles(jobids):
+            nodes = [deepcopy(self.procs[jobid]) for jobid in bundle]
+            if len(nodes) == 1:
+                taskids = [self._submit_job(nodes[0], updatehash=updatehash)]
+            else:
+                taskids = self._submit_bundle(nodes, updatehash=updatehash)
+            submitted.extend(zip(bundle, taskids))
+        return submitted
 
     def _report_crash(self, node, result=None):
         if result and result['traceback']:
@@ -551,6 +951,19 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
 
     def _clear_task(self, taskid):
         del self._pending[taskid]
+        if taskid in self._queued:
+            self._queued.remove(taskid)
+            donefile = os.path.join(self._queue_dir, 'done', taskid)
+            if os.path.exists(donefile):
+                os.remove(donefile)
+            return
+        batchid = self._bundled.pop(taskid, taskid)
+        if batchid in self._bundles:
+            self._bundles[batchid].discard(taskid)
+            if self._bundles[batchid]:
+                return
+            del self._bundles[batchid]
+        self._submit_times.pop(batchid, None)
 
 
 class GraphPluginBase(PluginBase):
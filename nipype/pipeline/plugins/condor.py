@@ -28,8 +28,13 @@ class CondorPlugin(SGELikeBatchManagerBase):
                  by condor_qsub
     - qsub_args : arguments to be prepended to the job execution script in the
                   qsub call
+    - status_refresh_interval : minimum number of seconds between two
+                  `condor_q` queries of the job states
     """
 
+    # JobStatus of removed and completed jobs
+    _finished_states = frozenset(['3', '4'])
+
     def __init__(self, **kwargs):
         template = """
 #$ -V
@@ -44,18 +49,14 @@ class CondorPlugin(SGELikeBatchManagerBase):
                 self._max_tries = kwargs['plugin_args']['max_tries']
         super(CondorPlugin, self).__init__(template, **kwargs)
 
-    def _is_pending(self, taskid):
-        cmd = CommandLine('condor_q',
-                          terminal_output='allatonce')
-        cmd.inputs.args = '%d' % taskid
-        # check condor cluster
-        oldlevel = iflogger.level
-        iflogger.setLevel(logging.getLevelName('CRITICAL'))
-        result = cmd.run(ignore_exception=True)
-        iflogger.setLevel(oldlevel)
-        if result.runtime.stdout.count('\n%d' % taskid):
-            return True
-        return False
+    def _query_jobs(self):
+        o = self._run_status_command(['condor_q', '-format', '%d ',
+                                      'ClusterId', '-format', '%d\n',
+                                      'JobStatus'])
+        if o is None:
+            return None
+        return dict([line.split() for line in o.split('\n')
+                     if len(line.split()) == 2])
 
     def _submit_batchtask(self, scriptfile, node):
         cmd = CommandLine('condor_qsub', environ=os.environ.data,
@@ -21,9 +21,13 @@ class LSFPlugin(SGELikeBatchManagerBase):
     - template : template to use for batch job submission
     - bsub_args : arguments to be prepended to the job execution script in the
                   bsub call
+    - status_refresh_interval : minimum number of seconds between two
+                  `bjobs` queries of the job states
 
     """
 
+    _finished_states = frozenset(['DONE', 'EXIT'])
+
     def __init__(self, **kwargs):
         template = """
 #$ -S /bin/sh
@@ -38,24 +42,22 @@ class LSFPlugin(SGELikeBatchManagerBase):
                 self._max_tries = kwargs['plugin_args']['max_tries']
         super(LSFPlugin, self).__init__(template, **kwargs)
 
-    def _is_pending(self, taskid):
-        """LSF lists a status of 'PEND' when a job has been submitted but is waiting to be picked up,
-        and 'RUN' when it is actively being processed. But _is_pending should return True until a job has
-        finished and is ready to be checked for completeness. So return True if status is either 'PEND'
-        or 'RUN'"""
-        cmd = CommandLine('bjobs',
-                          terminal_output='allatonce')
-        cmd.inputs.args = '%d' % taskid
-        # check lsf task
-        oldlevel = iflogger.level
-        iflogger.setLevel(logging.getLevelName('CRITICAL'))
-        result = cmd.run(ignore_exception=True)
-        iflogger.setLevel(oldlevel)
-        # logger.debug(result.runtime.stdout)
-        if 'DONE' in result.runtime.stdout or 'EXIT' in result.runtime.stdout:
-            return False
-        else:
-            return True
+    def _query_jobs(self):
+        """LSF lists a status of 'PEND' when a job has been submitted but is
+        waiting to be picked up, and 'RUN' when it is actively being processed.
+        Finished jobs are listed as 'DONE' or 'EXIT' until they are cleaned
+        up."""
+        o = self._run_status_command(['bjobs', '-a', '-w'],
+                                     no_jobs_msg='No job found')
+        if o is None:
+            return None
+        job_states = {}
+        for line in o.split('\n'):
+            fields = line.split()
+            # JOBID  USER  STAT  QUEUE ...
+            if len(fields) > 2 and fields[0].isdigit():
+                job_states[fields[0]] = fields[2]
+        return job_states
 
     def _submit_batchtask(self, scriptfile, node):
         cmd = CommandLine('bsub', environ=os.environ.data,
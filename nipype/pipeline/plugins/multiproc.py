@@ -6,20 +6,123 @@ Support for child processes running as non-daemons based on
 http://stackoverflow.com/a/8963618/1183453
 """
 
+from copy import deepcopy
 from multiprocessing import Process, Pool, cpu_count, pool
-from traceback import format_exception
+import os
+import resource
 import sys
+import threading
+from time import time
+from traceback import format_exception
+
+import numpy as np
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from ...utils.filemanip import save_json
+from ..utils import get_peak_memory
+from .base import (DistributedPluginBase, logger, report_crash)
+from .worker import node_spec, node_from_spec
+
+
+def _system_memory_gb():
+    """Total physical memory in GB"""
+    try:
+        return (os.sysconf('SC_PAGE_SIZE') *
+                os.sysconf('SC_PHYS_PAGES')) / 1024. ** 3
+    except (AttributeError, ValueError, OSError):
+        return np.inf
+
+
+class ResourceMonitor(object):
+    """Measures CPU time and peak memory of the current process
+
+    CPU time includes the children that have been waited for (i.e.
+    command line tools). If psutil is available the resident set size of
+    the process and all its children is sampled every `interval` seconds.
+    Otherwise the peak is taken from getrusage, which reports the maximum
+    over the lifetime of the process and is only an upper bound for a
+    worker that has run other nodes before.
+    """
+
+    def __init__(self, interval=0.2):
+        self._interval = interval
+        self._start_time = time()
+        self._start_cpu = self._cpu_time()
+        self._peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = None
+        if psutil is not None:
+            self._process = psutil.Process(os.getpid())
+            self._thread = threading.Thread(target=self._sample)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _cpu_time(self):
+        cpu_time = 0.
+        for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+            usage = resource.getrusage(who)
+            cpu_time += usage.ru_utime + usage.ru_stime
+        return cpu_time
+
+    def _rss(self):
+        rss = 0
+        try:
+            procs = [self._process] + self._process.children(recursive=True)
+        except psutil.Error:
+            return rss
+        for proc in procs:
+            try:
+                rss += proc.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+
+    def _sample(self):
+        while True:
+            self._peak_rss = max(self._peak_rss, self._rss())
+            if self._stop.wait(self._interval):
+                break
+
+    def stop(self):
+        """Stop monitoring and return the measurements"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            peak_rss_gb = self._peak_rss / 1024. ** 3
+        else:
+            peak_rss_gb = max(get_peak_memory(resource.RUSAGE_SELF),
+                              get_peak_memory(resource.RUSAGE_CHILDREN))
+        return dict(cpu_time=self._cpu_time() - self._start_cpu,
+                    wall_time=time() - self._start_time,
+                    peak_rss_gb=peak_rss_gb)
 
-from .base import (DistributedPluginBase, report_crash)
 
 def run_node(node, updatehash):
     result = dict(result=None, traceback=None)
+    monitor = ResourceMonitor()
+    if isinstance(node, dict):
+        node = node_from_spec(node)
     try:
         result['result'] = node.run(updatehash=updatehash)
     except:
         etype, eval, etr = sys.exc_info()
         result['traceback'] = format_exception(etype,eval,etr)
         result['result'] = node.result
+    resources = monitor.stop()
+    resources['estimated_memory_gb'] = getattr(node, 'estimated_memory_gb',
+                                               None)
+    resources['num_threads'] = getattr(node, 'num_threads', None)
+    result['resources'] = resources
+    try:
+        outdir = node.output_dir()
+        if os.path.exists(outdir):
+            save_json(os.path.join(outdir, '_resources.json'), resources)
+    except Exception:
+        pass
     return result
 
 class NonDaemonProcess(Process):
@@ -44,22 +147,43 @@ class MultiProcPlugin(DistributedPluginBase):
     The plugin_args input to run can be used to control the multiprocessing
     execution. Currently supported options are:
 
-    - n_procs : number of processes to use
+    - n_procs : number of processes (cores) to use
+    - memory_gb : amount of memory (in GB) the running nodes may use
+      together (default: all physical memory)
     - non_daemon : boolean flag to execute as non-daemon processes
 
+    Ready nodes are packed greedily, largest first, so that the sum of
+    their `estimated_memory_gb` and `num_threads` hints stays within the
+    `memory_gb` and `n_procs` budgets. A node that asks for more than the
+    budget runs on its own. The CPU time and peak memory measured in the
+    worker are stored in `_resources.json` in the node directory.
+
+    The worker processes live as long as the plugin and receive compact
+    node specifications (see `nipype.pipeline.plugins.worker.node_spec`).
+
     """
 
     def __init__(self, plugin_args=None):
         super(MultiProcPlugin, self).__init__(plugin_args=plugin_args)
         self._taskresult = {}
         self._taskid = 0
+        self._task_resources = {}
         non_daemon = True
         n_procs = cpu_count()
+        memory_gb = _system_memory_gb()
         if plugin_args:
             if 'n_procs' in plugin_args:
                 n_procs = plugin_args['n_procs']
+            if 'memory_gb' in plugin_args:
+                memory_gb = float(plugin_args['memory_gb'])
             if 'non_daemon' in plugin_args:
                 non_daemon = plugin_args['non_daemon']
+        self.processors = n_procs
+        self.memory_gb = memory_gb
+        self._used_processors = 0
+        self._used_memory_gb = 0.
+        # collect all ready jobs so that they are packed largest first
+        self._eager_submission = False
         if non_daemon:
             # run the execution using the non-daemon pool subclass
             self.pool = NonDaemonPool(processes=n_procs)
@@ -71,20 +195,76 @@ class MultiProcPlugin(DistributedPluginBase):
             raise RuntimeError('Multiproc task %d not found'%taskid)
         if not self._taskresult[taskid].ready():
             return None
-        return self._taskresult[taskid].get()
+        result = self._taskresult[taskid].get()
+        if result.get('resources'):
+            nodeid, memory_gb, num_threads = self._task_resources[taskid]
+            usage = result['resources']
+            logger.debug(('[Resources] %s: reserved %.2f GB, %d thread(s); '
+                          'used %.2f GB peak, %.1f s CPU, %.1f s wall') %
+                         (nodeid, memory_gb, num_threads,
+                          usage['peak_rss_gb'], usage['cpu_time'],
+                          usage['wall_time']))
+        return result
+
+    def _job_resources(self, node):
+        """Memory and processors reserved for a node, clipped to the budget
+        """
+        memory_gb = getattr(node, 'estimated_memory_gb', 0.) or 0.
+        num_threads = getattr(node, 'num_threads', 1) or 1
+        return min(memory_gb, self.memory_gb), min(num_threads,
+                                                   self.processors)
+
+    def _select_jobs(self, jobids, slots):
+        """Packs the queued jobs into the free resources, largest first
+        """
+        free_memory_gb = self.memory_gb - self._used_memory_gb
+        free_processors = self.processors - self._used_processors
+        if free_processors <= 0:
+            return []
+        resources = dict([(jobid, self._job_resources(self.procs[jobid]))
+                          for jobid in jobids])
+        selected = []
+        for jobid in sorted(jobids, key=resources.get, reverse=True):
+            if slots is not None and len(selected) >= slots:
+                break
+            memory_gb, num_threads = resources[jobid]
+            if memory_gb <= free_memory_gb and num_threads <= free_processors:
+                selected.append(jobid)
+                free_memory_gb -= memory_gb
+                free_processors -= num_threads
+        return selected
 
     def _submit_job(self, node, updatehash=False):
         self._taskid += 1
-        try:
-            if node.inputs.terminal_output == 'stream':
-                node.inputs.terminal_output = 'allatonce'
-        except:
-            pass
-        self._taskresult[self._taskid] = self.pool.apply_async(run_node,
-                                                               (node,
-                                                                updatehash,))
+        # the terminal output is changed in the spec, not in the node of
+        # the workflow
+        spec = node_spec(node)
+        if isinstance(spec['interface'], basestring):
+            if spec['inputs'].get('terminal_output') == 'stream':
+                spec['inputs']['terminal_output'] = 'allatonce'
+        else:
+            try:
+                if node.inputs.terminal_output == 'stream':
+                    spec['interface'] = deepcopy(spec['interface'])
+                    spec['interface'].inputs.terminal_output = 'allatonce'
+            except:
+                pass
+        memory_gb, num_threads = self._job_resources(node)
+        self._task_resources[self._taskid] = (node._id, memory_gb,
+                                              num_threads)
+        self._used_memory_gb += memory_gb
+        self._used_processors += num_threads
+        self._taskresult[self._taskid] = self.pool.apply_async(
+            run_node, (spec, updatehash,),
+            callback=self._notify_task_completed)
         return self._taskid
 
+    def _submit_jobs(self, jobids, updatehash=False):
+        # the jobs are submitted as specs, no need to deepcopy the nodes
+        return [(jobid, self._submit_job(self.procs[jobid],
+                                         updatehash=updatehash))
+                for jobid in jobids]
+
     def _report_crash(self, node, result=None):
         if result and result['traceback']:
             node._result = result['result']
@@ -95,4 +275,7 @@ class MultiProcPlugin(DistributedPluginBase):
             return report_crash(node)
 
     def _clear_task(self, taskid):
+        _, memory_gb, num_threads = self._task_resources.pop(taskid)
+        self._used_memory_gb -= memory_gb
+        self._used_processors -= num_threads
         del self._taskresult[taskid]
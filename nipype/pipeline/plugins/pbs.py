@@ -3,7 +3,6 @@
 
 import os
 from time import sleep
-import subprocess
 
 from .base import (SGELikeBatchManagerBase, logger, iflogger, logging)
 
@@ -20,11 +19,15 @@ class PBSPlugin(SGELikeBatchManagerBase):
     - qsub_args : arguments to be prepended to the job execution script in the
                   qsub call
     - max_jobname_len: maximum length of the job name.  Default 15.
+    - status_refresh_interval : minimum number of seconds between two
+                  `qstat` queries of the job states
 
     """
 
     # Addtional class variables
     _max_jobname_len = 15
+    # completed (Torque) and finished (PBS Pro)
+    _finished_states = frozenset(['C', 'F'])
 
     def __init__(self, **kwargs):
         template = """
@@ -42,14 +45,17 @@ class PBSPlugin(SGELikeBatchManagerBase):
                 self._max_jobname_len = kwargs['plugin_args']['max_jobname_len']
         super(PBSPlugin, self).__init__(template, **kwargs)
 
-    def _is_pending(self, taskid):
-        #  subprocess.Popen requires taskid to be a string
-        proc = subprocess.Popen(["qstat", str(taskid)],
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        _, e = proc.communicate()
-        errmsg = 'Unknown Job Id' # %s' % taskid
-        return  errmsg not in e
+    def _query_jobs(self):
+        o = self._run_status_command(['qstat'])
+        if o is None:
+            return None
+        job_states = {}
+        for line in o.split('\n'):
+            fields = line.split()
+            # Job id  Name  User  Time Use  S  Queue
+            if len(fields) == 6 and fields[0][0].isdigit():
+                job_states[fields[0].split('.')[0]] = fields[4]
+        return job_states
 
     def _submit_batchtask(self, scriptfile, node):
         cmd = CommandLine('qsub', environ=os.environ.data,
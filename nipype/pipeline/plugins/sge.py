@@ -3,8 +3,8 @@
 
 import os
 import re
-import subprocess
 from time import sleep
+from xml.etree import ElementTree
 
 from .base import (SGELikeBatchManagerBase, logger, iflogger, logging)
 
@@ -34,6 +34,8 @@ class SGEPlugin(SGELikeBatchManagerBase):
     - template : template to use for batch job submission
     - qsub_args : arguments to be prepended to the job execution script in the
                   qsub call
+    - status_refresh_interval : minimum number of seconds between two
+                  `qstat` queries of the job states
 
     """
 
@@ -51,13 +53,18 @@ class SGEPlugin(SGELikeBatchManagerBase):
                 self._max_tries = kwargs['plugin_args']['max_tries']
         super(SGEPlugin, self).__init__(template, **kwargs)
 
-    def _is_pending(self, taskid):
-        #  subprocess.Popen requires taskid to be a string
-        proc = subprocess.Popen(["qstat", '-j', str(taskid)],
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        o, _ = proc.communicate()
-        return o.startswith('=')
+    def _query_jobs(self):
+        o = self._run_status_command(['qstat', '-xml'])
+        if o is None:
+            return None
+        try:
+            tree = ElementTree.fromstring(o)
+        except Exception, e:
+            logger.debug('Could not parse qstat output: %s' % e)
+            return None
+        # finished jobs are not listed
+        return dict([(job.findtext('JB_job_number'), job.findtext('state'))
+                     for job in tree.getiterator('job_list')])
 
     def _submit_batchtask(self, scriptfile, node):
         cmd = CommandLine('qsub', environ=os.environ.data,
@@ -6,9 +6,9 @@ Created on Aug 2, 2013
 Parallel workflow execution with SLURM
 '''
 
+import getpass
 import os
 import re
-import subprocess
 from time import sleep
 
 from .base import (SGELikeBatchManagerBase, logger, iflogger, logging)
@@ -28,10 +28,15 @@ class SLURMPlugin(SGELikeBatchManagerBase):
     - template : template to use for batch job submission
 
     - sbatch_args: arguments to pass prepend to the sbatch call
+    - status_refresh_interval : minimum number of seconds between two
+                  `squeue` queries of the job states
 
 
     '''
 
+    # compact job state codes of squeue for jobs that are no longer active
+    _finished_states = frozenset(['BF', 'CA', 'CD', 'DL', 'F', 'NF', 'OOM',
+                                  'TO'])
 
     def __init__(self, **kwargs):
 
@@ -56,14 +61,13 @@ class SLURMPlugin(SGELikeBatchManagerBase):
         self._pending = {}
         super(SLURMPlugin, self).__init__(template, **kwargs)
 
-    def _is_pending(self, taskid):
-        #  subprocess.Popen requires taskid to be a string
-        proc = subprocess.Popen(["showq", '-u'],
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        o, _ = proc.communicate()
-
-        return o.find(str(taskid)) > -1
+    def _query_jobs(self):
+        o = self._run_status_command(['squeue', '-h', '-o', '%i %t',
+                                      '-u', getpass.getuser()])
+        if o is None:
+            return None
+        return dict([line.split() for line in o.split('\n')
+                     if len(line.split()) == 2])
 
     def _submit_batchtask(self, scriptfile, node):
         """
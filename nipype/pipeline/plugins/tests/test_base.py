@@ -2,12 +2,16 @@
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 """Tests for the engine module
 """
+from threading import Timer
+from time import time
+
 import numpy as np
 import scipy.sparse as ssp
 
 from nipype.testing import (assert_raises, assert_equal, assert_true,
                             assert_false, skipif)
 import nipype.pipeline.plugins.base as pb
+from nipype.pipeline.utils import nx
 
 def test_scipy_sparse():
     foo = ssp.lil_matrix(np.eye(3, k=1))
@@ -15,6 +19,91 @@ def test_scipy_sparse():
     goo[goo.nonzero()] = 0
     yield assert_equal, foo[0,1], 0
 
+def test_wait_wakes_on_completion():
+    plugin = pb.DistributedPluginBase(plugin_args={'poll_sleep_duration': 30})
+    plugin._poll_interval = 30
+    Timer(0.1, plugin._notify_task_completed).start()
+    t0 = time()
+    plugin._wait()
+    yield assert_true, time() - t0 < 10
+
+def test_wait_backoff():
+    plugin = pb.DistributedPluginBase(plugin_args={'poll_sleep_duration': 0.2})
+    intervals = []
+    for _ in range(4):
+        intervals.append(plugin._poll_interval)
+        plugin._wait()
+    yield assert_equal, intervals, [0.05, 0.1, 0.2, 0.2]
+    plugin._wait(num_finished=1)
+    yield assert_equal, plugin._poll_interval, 0.1
+
+class DummyNode(object):
+    def __init__(self, name):
+        self._id = name
+        self.config = {'execution': {'local_hash_check': 'false',
+                                     'stop_on_first_crash': 'false',
+                                     'remove_node_directories': 'false'}}
+        self.run_without_submitting = False
+
+def _diamond_graph():
+    nodes = [DummyNode(name) for name in 'abcd']
+    graph = nx.DiGraph()
+    graph.add_edges_from([(nodes[0], nodes[1]), (nodes[0], nodes[2]),
+                          (nodes[1], nodes[3]), (nodes[2], nodes[3])])
+    return graph, nodes
+
+def test_ready_queue():
+    graph, nodes = _diamond_graph()
+    plugin = pb.DistributedPluginBase()
+    plugin.mapnodesubids = {}
+    plugin._generate_dependency_list(graph)
+    ids = [plugin.procidx[node] for node in nodes]
+    yield assert_equal, list(plugin.readytorun), [ids[0]]
+    yield assert_equal, plugin.depcount[ids[3]], 2
+    plugin.readytorun.popleft()
+    plugin.proc_done[ids[0]] = True
+    plugin._task_finished_cb(ids[0])
+    yield assert_equal, sorted(plugin.readytorun), sorted(ids[1:3])
+    yield assert_equal, plugin.refcount[ids[0]], 2
+    plugin.readytorun.clear()
+    plugin._task_finished_cb(ids[1])
+    yield assert_equal, list(plugin.readytorun), []
+    plugin._task_finished_cb(ids[2])
+    yield assert_equal, list(plugin.readytorun), [ids[3]]
+    yield assert_equal, plugin.refcount[ids[0]], 0
+
+class SlowPlugin(pb.DistributedPluginBase):
+    """Jobs finish on the second status check"""
+    def __init__(self, plugin_args=None):
+        super(SlowPlugin, self).__init__(plugin_args=plugin_args)
+        self.checks = {}
+        self.max_pending = 0
+
+    def _submit_job(self, node, updatehash=False):
+        taskid = len(self.checks) + 1
+        self.checks[taskid] = 0
+        self.max_pending = max(self.max_pending, len(self.pending_tasks) + 1)
+        return taskid
+
+    def _get_result(self, taskid):
+        self.checks[taskid] += 1
+        if self.checks[taskid] > 1:
+            return dict(result=None, traceback=None)
+        return None
+
+    def _clear_task(self, taskid):
+        pass
+
+def test_max_jobs():
+    graph, nodes = _diamond_graph()
+    config = nodes[0].config
+    plugin = SlowPlugin(plugin_args={'max_jobs': 1,
+                                     'poll_sleep_duration': 0.01})
+    plugin.run(graph, config)
+    yield assert_equal, plugin.max_pending, 1
+    yield assert_true, all(plugin.proc_done)
+    yield assert_false, any(plugin.proc_pending)
+
 '''
 Can use the following code to test that a mapnode crash continues successfully
 Need to put this into a nose-test with a timeout
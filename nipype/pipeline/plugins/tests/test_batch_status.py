@@ -0,0 +1,310 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import nipype
+import nipype.interfaces.base as nib
+from nipype.testing import assert_equal, assert_true, assert_false, skipif
+import nipype.pipeline.engine as pe
+from nipype.pipeline.plugins.sge import SGEPlugin
+from nipype.pipeline.plugins.pbs import PBSPlugin
+from nipype.pipeline.plugins.lsf import LSFPlugin
+from nipype.pipeline.plugins.slurm import SLURMPlugin
+from nipype.pipeline.plugins.condor import CondorPlugin
+
+# the scripts run by the batch jobs set the matplotlib backend
+try:
+    import matplotlib
+    have_matplotlib = True
+except ImportError:
+    have_matplotlib = False
+
+qstat_xml = """<?xml version='1.0'?>
+<job_info  xmlns:xsd="http://gridengine.sunsource.net/source/browse/*checkout*/gridengine/source/dist/util/resources/schemas/qstat/qstat.xsd?revision=1.11">
+  <queue_info>
+    <job_list state="running">
+      <JB_job_number>101</JB_job_number>
+      <JAT_prio>0.55500</JAT_prio>
+      <JB_name>mod1.pipe.user</JB_name>
+      <state>r</state>
+    </job_list>
+  </queue_info>
+  <job_info>
+    <job_list state="pending">
+      <JB_job_number>102</JB_job_number>
+      <JAT_prio>0.00000</JAT_prio>
+      <JB_name>mod2.pipe.user</JB_name>
+      <state>qw</state>
+    </job_list>
+  </job_info>
+</job_info>
+"""
+
+pbs_qstat = """Job id                    Name             User            Time Use S Queue
+------------------------- ---------------- --------------- -------- - -----
+101.headnode               pipe.mod1        user            00:00:01 R batch
+102.headnode               pipe.mod2        user                   0 Q batch
+103.headnode               pipe.mod3        user            00:00:02 C batch
+"""
+
+bjobs = """JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME   SUBMIT_TIME
+101     user    RUN   normal     headnode    node1       mod1.pipe  Jan  1 10:00
+102     user    PEND  normal     headnode                mod2.pipe  Jan  1 10:00
+103     user    DONE  normal     headnode    node2       mod3.pipe  Jan  1 10:00
+"""
+
+squeue = """101 R
+102 PD
+103 CD
+"""
+
+condor_q = """101 2
+102 1
+103 4
+"""
+
+
+class StubCommand(object):
+    """Puts a script on the PATH that prints `output` and counts its calls
+
+    If given, `body` is run instead of printing `output`.
+    """
+
+    def __init__(self, name, output='', returncode=0, body=None):
+        self.dir = mkdtemp(prefix='test_batch_status_')
+        self.log = os.path.join(self.dir, 'calls.log')
+        output_file = os.path.join(self.dir, 'output.txt')
+        open(output_file, 'wt').write(output)
+        if body is None:
+            body = 'cat %s\nexit %d\n' % (output_file, returncode)
+        script = os.path.join(self.dir, name)
+        open(script, 'wt').write('#!/bin/sh\necho call >> %s\n%s' %
+                                 (self.log, body))
+        os.chmod(script, 0755)
+        self._path = os.environ['PATH']
+        os.environ['PATH'] = os.pathsep.join((self.dir, self._path))
+
+    @property
+    def calls(self):
+        if not os.path.exists(self.log):
+            return 0
+        return len(open(self.log).readlines())
+
+    def remove(self):
+        os.environ['PATH'] = self._path
+        rmtree(self.dir)
+
+
+def check_status(plugin_class, command, output, taskids):
+    stub = StubCommand(command, output)
+    plugin = plugin_class(plugin_args={'status_refresh_interval': 3600})
+    running, queued, finished = taskids
+    yield assert_true, plugin._is_pending(running)
+    yield assert_true, plugin._is_pending(queued)
+    yield assert_false, plugin._is_pending(finished)
+    # jobs that are not listed have finished
+    yield assert_false, plugin._is_pending(999)
+    # a single query answers all of the above
+    yield assert_equal, stub.calls, 1
+    # a job submitted after the last query forces a refresh
+    plugin._submit_times[queued] = plugin._status_time + 1
+    yield assert_true, plugin._is_pending(queued)
+    yield assert_equal, stub.calls, 2
+    plugin._status_refresh_interval = 0
+    plugin._is_pending(running)
+    yield assert_equal, stub.calls, 3
+    stub.remove()
+
+
+def test_sge_status():
+    for test in check_status(SGEPlugin, 'qstat', qstat_xml,
+                             (101, 102, 103)):
+        yield test
+
+
+def test_pbs_status():
+    for test in check_status(PBSPlugin, 'qstat', pbs_qstat,
+                             ('101', '102', '103')):
+        yield test
+
+
+def test_lsf_status():
+    for test in check_status(LSFPlugin, 'bjobs', bjobs, (101, 102, 103)):
+        yield test
+
+
+def test_slurm_status():
+    for test in check_status(SLURMPlugin, 'squeue', squeue, (101, 102, 103)):
+        yield test
+
+
+def test_condor_status():
+    for test in check_status(CondorPlugin, 'condor_q', condor_q,
+                             (101, 102, 103)):
+        yield test
+
+
+def test_failed_status_query():
+    stub = StubCommand('squeue', 'squeue: error: slurm_load_jobs error',
+                       returncode=1)
+    plugin = SLURMPlugin(plugin_args={'status_refresh_interval': 0})
+    # jobs are considered pending until the batch system answers
+    yield assert_true, plugin._is_pending(101)
+    plugin._job_states = {'101': 'CD'}
+    yield assert_false, plugin._is_pending(101)
+    stub.remove()
+
+
+def test_failed_status_query_after_submission():
+    stub = StubCommand('squeue', squeue)
+    plugin = SLURMPlugin(plugin_args={'status_refresh_interval': 0})
+    yield assert_false, plugin._is_pending(103)
+    status_time = plugin._status_time
+    stub.remove()
+    # the batch system stops answering once job 104 has been submitted
+    stub = StubCommand('squeue', returncode=1)
+    plugin._submit_times[104] = status_time + 1
+    yield assert_true, plugin._is_pending(104)
+    yield assert_equal, stub.calls, 1
+    yield assert_equal, plugin._status_time, status_time
+    # jobs submitted before the last successful query are still answered
+    yield assert_false, plugin._is_pending(103)
+    stub.remove()
+
+
+class InputSpec(nib.TraitedSpec):
+    input1 = nib.traits.Int(desc='a random int')
+    input2 = nib.traits.Int(desc='a random int')
+
+
+class OutputSpec(nib.TraitedSpec):
+    output1 = nib.traits.List(nib.traits.Int, desc='outputs')
+
+
+class TestInterface(nib.BaseInterface):
+    input_spec = InputSpec
+    output_spec = OutputSpec
+
+    def _run_interface(self, runtime):
+        runtime.returncode = 0
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output1'] = [1, self.inputs.input1]
+        return outputs
+
+
+# runs the submitted script right away and reports a new job id
+qsub_body = """count=`cat %s | wc -l`
+for script; do :; done
+sh $script > /dev/null 2>&1
+echo "Your job $count (\\"job\\") has been submitted"
+"""
+
+
+class StubNode(object):
+    def __init__(self, plugin_args):
+        self.plugin_args = plugin_args
+
+
+def test_make_bundles():
+    plugin = SGEPlugin(plugin_args={'bundle_size': 3})
+    plugin.procs = [StubNode({}) for _ in range(7)]
+    plugin.procs[2].plugin_args['qsub_args'] = '-q long'
+    plugin.procs[5].plugin_args['qsub_args'] = '-q long'
+    yield assert_false, plugin._eager_submission
+    yield assert_equal, plugin._make_bundles(range(7)), [[0, 1, 3], [2, 5],
+                                                         [4, 6]]
+    plugin = SGEPlugin(plugin_args={'bundle_runtime': 60})
+    plugin.procs = [StubNode({'estimated_runtime': runtime})
+                    for runtime in [10, 50, 70, 20, 10]]
+    yield assert_equal, plugin._make_bundles(range(5)), [[0, 1], [2], [3, 4]]
+
+
+@skipif(not have_matplotlib)
+def test_run_sge_bundles():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+    environ = os.environ.copy()
+    os.environ['LOGNAME'] = 'user'
+    # the batch jobs run nipype in a new interpreter
+    os.environ['PYTHONPATH'] = os.pathsep.join(
+        (os.path.dirname(os.path.dirname(nipype.__file__)),
+         os.environ.get('PYTHONPATH', '')))
+    qstat = StubCommand('qstat', '<job_info></job_info>')
+    qsub = StubCommand('qsub', body=qsub_body % qstat.log)
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.Node(interface=TestInterface(), name='mod1')
+    mod2 = pe.MapNode(interface=TestInterface(),
+                      iterfield=['input1'],
+                      name='mod2')
+    mod1.inputs.input1 = 1
+    mod1.inputs.input2 = 2
+    mod2.inputs.input2 = 3
+    pipe.connect([(mod1, mod2, [('output1', 'input1')])])
+    pipe.base_dir = os.getcwd()
+    execgraph = pipe.run(plugin='SGE',
+                         plugin_args={'bundle_size': 2,
+                                      'status_refresh_interval': 0})
+    names = ['.'.join((node._hierarchy, node.name))
+             for node in execgraph.nodes()]
+    node = execgraph.nodes()[names.index('pipe.mod2')]
+    yield assert_equal, node.get_output('output1'), [[1, 1], [1, 1]]
+    # mod1, both mod2 subnodes in one job, then the mod2 MapNode itself
+    yield assert_equal, qsub.calls, 3
+    qsub.remove()
+    qstat.remove()
+    os.environ.clear()
+    os.environ.update(environ)
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+
+@skipif(not have_matplotlib)
+def test_run_sge_workers():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+    environ = os.environ.copy()
+    os.environ['LOGNAME'] = 'user'
+    os.environ['PYTHONPATH'] = os.pathsep.join(
+        (os.path.dirname(os.path.dirname(nipype.__file__)),
+         os.environ.get('PYTHONPATH', '')))
+    qstat = StubCommand('qstat', '<job_info></job_info>')
+    qsub = StubCommand('qsub', body=qsub_body % qstat.log)
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.Node(interface=TestInterface(), name='mod1')
+    mod2 = pe.MapNode(interface=TestInterface(),
+                      iterfield=['input1'],
+                      name='mod2')
+    mod1.inputs.input1 = 1
+    mod1.inputs.input2 = 2
+    mod2.inputs.input2 = 3
+    pipe.connect([(mod1, mod2, [('output1', 'input1')])])
+    pipe.base_dir = os.getcwd()
+    # the stub qsub runs each worker to completion
+    execgraph = pipe.run(plugin='SGE',
+                         plugin_args={'workers': 2, 'worker_timeout': 0.1,
+                                      'status_refresh_interval': 0})
+    names = ['.'.join((node._hierarchy, node.name))
+             for node in execgraph.nodes()]
+    node = execgraph.nodes()[names.index('pipe.mod2')]
+    yield assert_equal, node.get_output('output1'), [[1, 1], [1, 1]]
+    batch_dir = os.path.join(temp_dir, 'pipe', 'batch')
+    queue_dir = [name for name in os.listdir(batch_dir)
+                 if name.startswith('workers_')]
+    yield assert_equal, len(queue_dir), 1
+    queue_dir = os.path.join(batch_dir, queue_dir[0])
+    yield assert_true, os.path.exists(os.path.join(queue_dir, 'stop'))
+    yield assert_equal, os.listdir(os.path.join(queue_dir, 'todo')), []
+    yield assert_equal, os.listdir(os.path.join(queue_dir, 'done')), []
+    qsub.remove()
+    qstat.remove()
+    os.environ.clear()
+    os.environ.update(environ)
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
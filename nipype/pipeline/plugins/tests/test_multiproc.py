@@ -3,8 +3,10 @@ import nipype.interfaces.base as nib
 from tempfile import mkdtemp
 from shutil import rmtree
 
-from nipype.testing import assert_equal
+from nipype.testing import assert_equal, assert_true
+from nipype.utils.filemanip import load_json, loadpkl
 import nipype.pipeline.engine as pe
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin
 
 class InputSpec(nib.TraitedSpec):
     input1 = nib.traits.Int(desc='a random int')
@@ -45,4 +47,126 @@ def test_run_multiproc():
     result = node.get_output('output1')
     yield assert_equal, result, [1, 1]
     os.chdir(cur_dir)
-    rmtree(temp_dir)
\ No newline at end of file
+    rmtree(temp_dir)
+
+class ResourceNode(object):
+    def __init__(self, memory_gb, num_threads):
+        self.estimated_memory_gb = memory_gb
+        self.num_threads = num_threads
+
+
+def test_multiproc_select_jobs():
+    from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+    plugin = MultiProcPlugin(plugin_args={'n_procs': 4, 'memory_gb': 4,
+                                          'non_daemon': False})
+    plugin.procs = [ResourceNode(1, 1), ResourceNode(3, 1),
+                    ResourceNode(2, 2), ResourceNode(0.5, 1),
+                    ResourceNode(10, 8)]
+    # largest first, skipping what does not fit
+    yield assert_equal, plugin._select_jobs([0, 1, 2, 3], None), [1, 0]
+    yield assert_equal, plugin._select_jobs([0, 2, 3], None), [2, 0, 3]
+    yield assert_equal, plugin._select_jobs([0, 2, 3], 1), [2]
+    # oversized jobs are clipped to the budget and run on their own
+    yield assert_equal, plugin._job_resources(plugin.procs[4]), (4, 4)
+    yield assert_equal, plugin._select_jobs([4, 3], None), [4]
+    plugin._used_memory_gb = 3.5
+    plugin._used_processors = 1
+    yield assert_equal, plugin._select_jobs([0, 2, 3, 4], None), [3]
+    plugin.pool.terminate()
+
+
+def test_run_multiproc_resources():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    mod1 = pe.Node(interface=TestInterface(), name='mod1',
+                   estimated_memory_gb=1, num_threads=2)
+    mod2 = pe.MapNode(interface=TestInterface(),
+                      iterfield=['input1'],
+                      name='mod2', estimated_memory_gb=1)
+    pipe.connect([(mod1, mod2, [('output1', 'input1')])])
+    pipe.base_dir = os.getcwd()
+    mod1.inputs.input1 = 1
+    pipe.run(plugin="MultiProc", plugin_args={'n_procs': 2, 'memory_gb': 1})
+    resources = load_json(os.path.join(temp_dir, 'pipe', 'mod1',
+                                       '_resources.json'))
+    yield assert_equal, resources['estimated_memory_gb'], 1
+    yield assert_equal, resources['num_threads'], 2
+    yield assert_true, resources['cpu_time'] >= 0
+    yield assert_true, resources['peak_rss_gb'] > 0
+    yield assert_true, os.path.exists(os.path.join(
+        temp_dir, 'pipe', 'mod2', 'mapflow', '_mod20', '_resources.json'))
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+class OrderedMultiProcPlugin(MultiProcPlugin):
+    """Records the nodes in the order they are submitted"""
+
+    def __init__(self, plugin_args=None):
+        super(OrderedMultiProcPlugin, self).__init__(plugin_args=plugin_args)
+        self.submitted = []
+
+    def _submit_job(self, node, updatehash=False):
+        self.submitted.append(node.name)
+        return super(OrderedMultiProcPlugin, self)._submit_job(
+            node, updatehash=updatehash)
+
+
+def test_run_multiproc_largest_first():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    small = pe.Node(interface=TestInterface(), name='small',
+                    estimated_memory_gb=1)
+    large = pe.Node(interface=TestInterface(), name='large',
+                    estimated_memory_gb=2)
+    small.inputs.input1 = 1
+    large.inputs.input1 = 2
+    pipe.add_nodes([small, large])
+    pipe.base_dir = os.getcwd()
+    # both nodes are ready at once and only one fits in the budget
+    plugin = OrderedMultiProcPlugin(plugin_args={'n_procs': 2,
+                                                 'memory_gb': 2})
+    pipe.run(plugin=plugin)
+    yield assert_equal, plugin.submitted, ['large', 'small']
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+def test_run_multiproc_commandline():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    echo = pe.Node(nib.CommandLine('echo', args='hi'), name='echo')
+    pipe.add_nodes([echo])
+    pipe.base_dir = os.getcwd()
+    pipe.run(plugin='MultiProc', plugin_args={'n_procs': 2})
+    result = loadpkl(os.path.join(temp_dir, 'pipe', 'echo',
+                                  'result_echo.pklz'))
+    yield assert_equal, result.runtime.stdout.strip(), 'hi'
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+def test_multiproc_submit_job():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    plugin = MultiProcPlugin(plugin_args={'n_procs': 1})
+    node = pe.Node(nib.CommandLine('echo', args='hi'), name='echo',
+                   base_dir=temp_dir)
+    taskid = plugin._submit_job(node)
+    result = plugin._taskresult[taskid].get()
+    # the command is run with all its output at once, the node is unchanged
+    yield assert_equal, result['result'].inputs['terminal_output'], \
+        'allatonce'
+    yield assert_equal, node.inputs.terminal_output, 'stream'
+    plugin.pool.close()
+    plugin.pool.join()
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
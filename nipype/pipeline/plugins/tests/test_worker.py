@@ -0,0 +1,101 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from nipype.testing import assert_equal, assert_true, assert_false
+import nipype.pipeline.engine as pe
+from nipype.interfaces.base import CommandLine
+from nipype.interfaces.utility import IdentityInterface, Select
+from nipype.utils.filemanip import loadpkl, savepkl
+from nipype.pipeline.plugins.worker import (node_spec, node_from_spec,
+                                            create_queue, serve)
+
+
+def test_node_spec():
+    node = pe.Node(Select(), name='select')
+    node.inputs.inlist = [1, 2, 3]
+    node.inputs.index = [2]
+    spec = node_spec(node)
+    # static interfaces are sent as their class and inputs
+    yield assert_equal, spec['interface'], 'nipype.interfaces.utility.Select'
+    yield assert_equal, spec['inputs'], node.inputs.get_traitsfree()
+    copy = node_from_spec(spec)
+    yield assert_equal, copy.name, 'select'
+    yield assert_equal, copy.inputs.get_traitsfree(), \
+        node.inputs.get_traitsfree()
+    yield assert_true, copy._interface is not node._interface
+    node = pe.Node(IdentityInterface(fields=['a']), name='ident')
+    node.inputs.a = 1
+    spec = node_spec(node)
+    # interfaces with dynamic inputs are sent as is
+    yield assert_true, spec['interface'] is node._interface
+    yield assert_equal, node_from_spec(spec).inputs.a, 1
+
+
+class Echo(CommandLine):
+    _cmd = 'echo'
+
+
+def test_node_spec_commandline():
+    # CommandLine cannot be instantiated without its command
+    node = pe.Node(CommandLine('echo', args='hi'), name='echo')
+    spec = node_spec(node)
+    yield assert_true, spec['interface'] is node._interface
+    copy = node_from_spec(spec)
+    yield assert_equal, copy._interface.cmdline, 'echo hi'
+    node = pe.Node(Echo(args='hi'), name='echo')
+    node.plugin_args = {'qsub_args': '-l nodes=1'}
+    spec = node_spec(node)
+    yield assert_equal, spec['interface'], \
+        'nipype.pipeline.plugins.tests.test_worker.Echo'
+    copy = node_from_spec(spec)
+    yield assert_equal, copy._interface.cmdline, 'echo hi'
+    # rebuilt nodes do not share the state of the node
+    yield assert_false, copy.plugin_args is node.plugin_args
+    yield assert_equal, copy.plugin_args, node.plugin_args
+
+
+def test_serve():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_worker_')
+    queue_dir = os.path.join(temp_dir, 'queue')
+    create_queue(queue_dir)
+    for idx in range(2):
+        node = pe.Node(Select(), name='select%d' % idx,
+                       base_dir=temp_dir)
+        node.inputs.inlist = [1, 2, 3]
+        node.inputs.index = [idx]
+        savepkl(os.path.join(queue_dir, 'todo', 'task%d.pklz' % idx),
+                dict(spec=node_spec(node), updatehash=False))
+    serve(queue_dir, 'worker0', idle_timeout=0, poll_interval=0)
+    yield assert_equal, sorted(os.listdir(os.path.join(queue_dir, 'done'))), \
+        ['task0', 'task1']
+    yield assert_equal, os.listdir(os.path.join(queue_dir, 'todo')), []
+    yield assert_equal, os.listdir(os.path.join(queue_dir, 'claimed')), []
+    yield assert_true, os.path.exists(os.path.join(temp_dir, 'select1',
+                                                   'result_select1.pklz'))
+    yield assert_equal, os.getcwd(), cur_dir
+    # a stop file ends the worker before it takes any task
+    savepkl(os.path.join(queue_dir, 'todo', 'task2.pklz'), {})
+    open(os.path.join(queue_dir, 'stop'), 'wt').close()
+    serve(queue_dir, 'worker0', idle_timeout=10)
+    yield assert_equal, os.listdir(os.path.join(queue_dir, 'todo')), \
+        ['task2.pklz']
+    rmtree(temp_dir)
+
+
+def test_serve_commandline():
+    temp_dir = mkdtemp(prefix='test_worker_')
+    queue_dir = os.path.join(temp_dir, 'queue')
+    create_queue(queue_dir)
+    for idx, interface in enumerate([CommandLine('echo', args='hi'),
+                                     Echo(args='hi')]):
+        node = pe.Node(interface, name='echo%d' % idx, base_dir=temp_dir)
+        savepkl(os.path.join(queue_dir, 'todo', 'task%d.pklz' % idx),
+                dict(spec=node_spec(node), updatehash=False))
+    serve(queue_dir, 'worker0', idle_timeout=0, poll_interval=0)
+    for idx in range(2):
+        result = loadpkl(os.path.join(temp_dir, 'echo%d' % idx,
+                                      'result_echo%d.pklz' % idx))
+        yield assert_equal, result.runtime.stdout.strip(), 'hi'
+    rmtree(temp_dir)
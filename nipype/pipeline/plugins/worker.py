@@ -0,0 +1,197 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Persistent workers that run nodes from a shared queue directory
+
+A worker is a long running process (e.g., a batch job) that keeps nipype
+and its dependencies imported and runs the nodes queued by a plugin one
+after the other. Nodes are queued as compact specifications (see
+`node_spec`) in the ``todo`` sub-directory of the queue (``<task>.pklz``). A
+worker claims a task by moving it to ``claimed/<task>.<worker>.pklz`` and
+creates ``done/<task>`` once the results have been written to the node
+directory. Workers exit after
+`idle_timeout` seconds without work or when a ``stop`` file is created.
+
+The worker of a queue is started with::
+
+    python -m nipype.pipeline.plugins.worker queue_dir worker_name
+"""
+
+from copy import deepcopy
+import inspect
+import os
+import sys
+from socket import gethostname
+from time import sleep, time
+from traceback import format_exception
+
+import numpy as np
+try:
+    import nibabel
+except ImportError:
+    pass
+
+from ... import config, logging
+from ...utils.filemanip import loadpkl, savepkl
+
+logger = logging.getLogger('workflow')
+
+queue_subdirs = ['todo', 'claimed', 'done']
+
+
+def _import_class(path):
+    module, name = path.rsplit('.', 1)
+    __import__(module)
+    return getattr(sys.modules[module], name)
+
+
+_instantiable = {}
+
+
+def _instantiates(cls):
+    """True if `cls` can be instantiated without arguments
+
+    e.g., CommandLine cannot (the command is missing) while its subclasses
+    with a command can. The result is kept for each class.
+    """
+    if cls not in _instantiable:
+        try:
+            cls()
+        except Exception:
+            _instantiable[cls] = False
+        else:
+            _instantiable[cls] = True
+    return _instantiable[cls]
+
+
+def _is_compact(interface):
+    """True if the interface can be rebuilt from its class and inputs
+
+    i.e., its class can be instantiated without arguments and all its
+    inputs are declared by its input specification.
+    """
+    try:
+        args, _, _, defaults = inspect.getargspec(interface.__init__)
+        class_traits = set(interface.input_spec.class_trait_names())
+    except (AttributeError, TypeError):
+        return False
+    if len(args) - 1 > len(defaults or []):
+        return False
+    if not set(interface.inputs.trait_names()) <= class_traits:
+        return False
+    return _instantiates(interface.__class__)
+
+
+def node_spec(node):
+    """Compact specification of a node
+
+    The interface is described by its class path, its inputs and the state
+    set on the instance (e.g., the terminal output). Other interfaces (e.g.,
+    IdentityInterface or Function, whose inputs are created at runtime) are
+    kept as is.
+    """
+    state = dict(node.__dict__)
+    interface = state.pop('_interface')
+    state['_result'] = None
+    spec = dict(cls=node.__class__, node=state)
+    if _is_compact(interface):
+        cls = interface.__class__
+        attributes = dict(interface.__dict__)
+        attributes.pop('inputs', None)
+        spec['interface'] = '%s.%s' % (cls.__module__, cls.__name__)
+        spec['inputs'] = interface.inputs.get_traitsfree()
+        spec['attributes'] = attributes
+    else:
+        spec['interface'] = interface
+    return spec
+
+
+def node_from_spec(spec):
+    """Rebuild the node described by `node_spec`
+
+    The state of the spec is copied, rebuilt nodes do not share it.
+    """
+    interface = spec['interface']
+    if isinstance(interface, basestring):
+        interface = _import_class(interface)()
+        interface.inputs.set(**deepcopy(spec['inputs']))
+        interface.__dict__.update(deepcopy(spec['attributes']))
+    node = spec['cls'].__new__(spec['cls'])
+    node.__dict__.update(deepcopy(spec['node']))
+    node._interface = interface
+    return node
+
+
+def run_task(taskfile, queue_dir):
+    """Run the node of a task and save its results like `create_pyscript`
+    """
+    info = None
+    node = None
+    cwd = os.getcwd()
+    try:
+        info = loadpkl(taskfile)
+        node = node_from_spec(info['spec'])
+        if node.config:
+            config.update_config(node.config)
+            logging.update_logging(config)
+        node.run(updatehash=info['updatehash'])
+    except Exception:
+        etype, eval, etr = sys.exc_info()
+        traceback = format_exception(etype, eval, etr)
+        if node is None or not os.path.exists(node.output_dir()):
+            result = None
+            resultsfile = os.path.join(queue_dir, 'crashdump_%s' %
+                                       os.path.basename(taskfile))
+        else:
+            result = node.result
+            resultsfile = os.path.join(node.output_dir(),
+                                       'result_%s.pklz' % node.name)
+        savepkl(resultsfile, dict(result=result, hostname=gethostname(),
+                                  traceback=traceback))
+    os.chdir(cwd)
+
+
+def serve(queue_dir, name, idle_timeout=60., poll_interval=0.5):
+    """Run the tasks of a queue until it is stopped or stays empty
+    """
+    todo, claimed, done = [os.path.join(queue_dir, subdir)
+                           for subdir in queue_subdirs]
+    stopfile = os.path.join(queue_dir, 'stop')
+    idle_since = time()
+    while not os.path.exists(stopfile):
+        for taskfile in sorted(os.listdir(todo)):
+            task = taskfile.split('.')[0]
+            claimfile = os.path.join(claimed, '%s.%s.pklz' % (task, name))
+            try:
+                os.rename(os.path.join(todo, taskfile), claimfile)
+            except OSError:
+                # claimed by another worker
+                continue
+            run_task(claimfile, queue_dir)
+            open(os.path.join(done, task), 'wt').close()
+            os.remove(claimfile)
+            idle_since = time()
+            break
+        else:
+            if time() - idle_since > idle_timeout:
+                break
+            sleep(poll_interval)
+
+
+def create_queue(queue_dir):
+    for subdir in queue_subdirs:
+        path = os.path.join(queue_dir, subdir)
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+
+if __name__ == '__main__':
+    try:
+        import matplotlib
+        matplotlib.use(config.get('execution', 'matplotlib_backend'))
+    except ImportError:
+        pass
+    queue_dir, name = sys.argv[1:3]
+    idle_timeout = 60.
+    if len(sys.argv) > 3:
+        idle_timeout = float(sys.argv[3])
+    serve(queue_dir, name, idle_timeout=idle_timeout)
@@ -0,0 +1,188 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Output records of the nodes
+
+The result file of a node (``result_<name>.pklz``) is a gzipped pickle of
+the whole InterfaceResult: the interface class, its inputs, the runtime
+with the environment of the process and the traited outputs. Downstream
+nodes only need a few output fields, so nodes also write their outputs to
+a record (``result_<name>.rec``) from which single fields are read without
+decompressing or unpickling anything else.
+
+A record is made of:
+
+- the magic string ``NIPYREC1``
+- the length of the index, as a 4 bytes little endian unsigned integer
+- the index, a pickled {field: (offset, length)} dictionary
+- the values of the fields, pickled one after the other; offsets are
+  relative to the end of the index
+
+The result file remains the reference: records are only used when they
+exist, and nodes fall back to the result file otherwise (e.g., results of
+an earlier version of nipype).
+
+The outputs read by a process are kept in a bounded LRU cache
+(``result_cache_size`` execution option), so that nodes fed many times by
+the same upstream node, such as join nodes, read each result once. Entries
+are invalidated when the size, modification time, status change time or
+inode of the file change. Files modified in the last few seconds are not
+cached, as they could be rewritten in place without changing any of these
+on filesystems with coarse timestamps.
+"""
+
+import cPickle
+import os
+import struct
+from time import time
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+from .. import config, logging
+from ..utils.filemanip import loadpkl
+logger = logging.getLogger('workflow')
+
+_magic = 'NIPYREC1'
+_header = struct.Struct('<I')
+
+
+def record_file(resultfile):
+    """Return the record file of the result file `resultfile`
+
+    >>> record_file('/tmp/node/result_node.pklz')
+    '/tmp/node/result_node.rec'
+    """
+    return os.path.splitext(resultfile)[0] + '.rec'
+
+
+def save_record(filename, outputs):
+    """Write the {field: value} dictionary `outputs` to a record
+    """
+    index = {}
+    values = []
+    offset = 0
+    for field, value in outputs.items():
+        pickled = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        index[field] = (offset, len(pickled))
+        values.append(pickled)
+        offset += len(pickled)
+    index = cPickle.dumps(index, cPickle.HIGHEST_PROTOCOL)
+    fp = open(filename + '.tmp', 'wb')
+    fp.write(_magic)
+    fp.write(_header.pack(len(index)))
+    fp.write(index)
+    for pickled in values:
+        fp.write(pickled)
+    fp.close()
+    os.rename(filename + '.tmp', filename)
+
+
+def load_record(filename, fields=None):
+    """Read `fields` (default: all) from a record
+
+    Returns a {field: value} dictionary. A KeyError is raised for fields
+    that are not in the record and an IOError if the file is not a record.
+    """
+    fp = open(filename, 'rb')
+    try:
+        if fp.read(len(_magic)) != _magic:
+            raise IOError('%s is not an output record' % filename)
+        size, = _header.unpack(fp.read(_header.size))
+        index = cPickle.loads(fp.read(size))
+        start = fp.tell()
+        if fields is None:
+            fields = index.keys()
+        outputs = {}
+        for field in sorted(fields, key=lambda field: index[field][0]):
+            offset, length = index[field]
+            fp.seek(start + offset)
+            outputs[field] = cPickle.loads(fp.read(length))
+    finally:
+        fp.close()
+    return outputs
+
+
+def _result_outputs(resultfile):
+    """Return the {field: value} outputs of a (pickled) result file"""
+    result = loadpkl(resultfile)
+    try:
+        return result.outputs.get()
+    except TypeError:
+        return result.outputs.dictcopy()  # outputs is a Bunch
+
+
+class ResultCache(object):
+    """LRU cache of the outputs of the result files read by a process
+
+    `size` is the maximum number of result files kept, by default the
+    ``result_cache_size`` execution option. A size of 0 disables the cache.
+    Files modified less than `racy_time` seconds ago are read every time.
+    """
+
+    racy_time = 3.
+
+    def __init__(self, size=None):
+        self._size = size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def size(self):
+        if self._size is None:
+            return int(config.get('execution', 'result_cache_size'))
+        return self._size
+
+    def clear(self):
+        self._entries.clear()
+
+    def _load(self, filename, reader):
+        stat_time = time()
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            # let the reader raise the usual error
+            return reader(filename)
+        signature = (stat.st_size, stat.st_mtime, stat.st_ctime, stat.st_ino)
+        entry = self._entries.pop(filename, None)
+        if entry is not None and entry[0] == signature:
+            self.hits += 1
+        else:
+            entry = (signature, reader(filename))
+            self.misses += 1
+            if stat_time - stat.st_mtime < self.racy_time:
+                # the file could be rewritten with the same signature
+                return entry[1]
+        self._entries[filename] = entry
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return entry[1]
+
+    def load(self, resultfile):
+        """Return the {field: value} outputs of the result file `resultfile`
+        """
+        try:
+            return self._load(record_file(resultfile), load_record)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            # no record: results of an earlier version or records disabled
+            logger.debug('no output record for %s' % resultfile)
+        return self._load(resultfile, _result_outputs)
+
+
+_result_cache = ResultCache()
+
+
+def load_output(resultfile, field):
+    """Return the output `field` of the result file `resultfile`
+
+    The output is read from the record of the result file if it has one.
+    With the cache disabled, only this field is read from the record.
+    """
+    if _result_cache.size > 0:
+        return _result_cache.load(resultfile)[field]
+    try:
+        return load_record(record_file(resultfile), [field])[field]
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        pass
+    return _result_outputs(resultfile)[field]
@@ -15,6 +15,7 @@ from nipype.testing import (assert_raises, assert_equal, assert_true,
 import nipype.interfaces.base as nib
 import nipype.pipeline.engine as pe
 from nipype import logging
+from nipype.utils.filemanip import loadpkl
 
 class InputSpec(nib.TraitedSpec):
     input1 = nib.traits.Int(desc='a random int')
@@ -606,3 +607,57 @@ def test_mapnode_json():
     yield assert_false, error_raised
     os.chdir(cwd)
     rmtree(wd)
+
+
+def test_mapnode_n_procs():
+    cwd = os.getcwd()
+    wd = mkdtemp()
+    os.chdir(wd)
+    from nipype import MapNode, Function, Workflow
+    def func1(in1, in2):
+        return in1 + in2
+    n1 = MapNode(Function(input_names=['in1', 'in2'],
+                          output_names=['out'],
+                          function=func1),
+                 iterfield=['in1'],
+                 name='n1', n_procs=2)
+    n1.inputs.in1 = [1, 2, 3, 4, 5]
+    n1.inputs.in2 = 10
+    w1 = Workflow(name='test')
+    w1.base_dir = wd
+    w1.add_nodes([n1])
+    eg = w1.run(plugin='Linear')
+    node = eg.nodes()[0]
+    yield assert_equal, node.result.outputs.out, [11, 12, 13, 14, 15]
+    yield assert_equal, len(glob(os.path.join(node.output_dir(), 'mapflow',
+                                              '_n1*'))), 5
+    os.chdir(cwd)
+    rmtree(wd)
+
+
+def test_mapnode_commandline():
+    cwd = os.getcwd()
+    wd = mkdtemp()
+    os.chdir(wd)
+    # CommandLine cannot be rebuilt from its class without its command
+    n1 = pe.MapNode(nib.CommandLine('echo'), iterfield=['args'], name='n1')
+    n1.inputs.args = ['a', 'b']
+    w1 = pe.Workflow(name='test')
+    w1.base_dir = wd
+    w1.add_nodes([n1])
+    w1.run(plugin='Linear')
+    for i, arg in enumerate(['a', 'b']):
+        result = loadpkl(os.path.join(wd, 'test', 'n1', 'mapflow',
+                                      '_n1%d' % i, 'result__n1%d.pklz' % i))
+        yield assert_equal, result.runtime.stdout.strip(), arg
+    # the subnodes do not share their state
+    n2 = pe.MapNode(nib.CommandLine('echo'), iterfield=['args'], name='n2',
+                    base_dir=wd)
+    n2.inputs.args = ['a', 'b']
+    n2.plugin_args = {'qsub_args': '-l nodes=1'}
+    subnodes = [node for _, node in n2._make_nodes()]
+    yield assert_false, subnodes[0].plugin_args is subnodes[1].plugin_args
+    yield assert_equal, subnodes[0].plugin_args, n2.plugin_args
+    yield assert_equal, subnodes[1]._interface.cmdline, 'echo b'
+    os.chdir(cwd)
+    rmtree(wd)
@@ -0,0 +1,79 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Tests for the node hash index
+"""
+import os
+from glob import glob
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from mock import patch
+
+from ...testing import assert_equal, assert_false
+import nipype.pipeline.engine as pe
+import nipype.interfaces.utility as niu
+from ..hashindex import HashIndex, get_hash_index
+
+
+def test_hash_index():
+    root = mkdtemp(prefix='test_hashindex_')
+    outdir = os.path.join(root, 'sub', 'node')
+    index = HashIndex(root)
+    yield assert_equal, index.lookup(outdir), None
+    index.record(outdir, 'abc', 'running')
+    index.record(outdir, 'abc', 'done', os.path.join(outdir, 'result.pklz'))
+    shards = glob(os.path.join(root, '_hashindex', '*.log'))
+    yield assert_equal, len(shards), 1
+    # a line written by a killed process is ignored
+    open(shards[0], 'at').write('[1.0, "sub/no')
+    entry = HashIndex(root).lookup(outdir)
+    yield assert_equal, entry, ('abc', 'done',
+                                os.path.join(outdir, 'result.pklz'))
+    # shards of other processes are merged once there are too many
+    for idx in range(3):
+        open(os.path.join(root, '_hashindex', 'host_%d.log' % idx),
+             'wt').write('[0.0, "sub/node%d", "h%d", "done", null]\n' %
+                         (idx, idx))
+    index = HashIndex(root)
+    index.max_shards = 2
+    yield assert_equal, index.lookup(os.path.join(root, 'sub', 'node1')), \
+        ('h1', 'done', None)
+    shards = glob(os.path.join(root, '_hashindex', '*.log'))
+    yield assert_equal, len(shards), 1
+    yield assert_equal, HashIndex(root).lookup(outdir)[:2], ('abc', 'done')
+    rmtree(root)
+
+
+def test_cached_run_uses_index():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_hashindex_')
+    os.chdir(temp_dir)
+    wf = pe.Workflow(name='pipe', base_dir=temp_dir)
+    select = pe.Node(niu.Select(inlist=[1, 2, 3], index=[1]), name='select')
+    mapnode = pe.MapNode(niu.Select(inlist=[1, 2, 3]), iterfield=['index'],
+                         name='mapnode')
+    wf.connect(select, 'out', mapnode, 'index')
+    wf.run()
+    index = get_hash_index(os.path.join(temp_dir, 'pipe'))
+    outdir = os.path.join(temp_dir, 'pipe', 'select')
+    yield assert_equal, index.lookup(outdir)[1:], \
+        ('done', os.path.join(outdir, 'result_select.pklz'))
+    # the subnodes of the map node share the index of the workflow
+    subdir = os.path.join(temp_dir, 'pipe', 'mapnode', 'mapflow',
+                          '_mapnode0')
+    yield assert_equal, index.lookup(subdir)[1], 'done'
+    yield assert_false, os.path.exists(os.path.join(temp_dir, 'pipe',
+                                                    'mapnode', 'mapflow',
+                                                    '_hashindex'))
+    # a fully cached rerun never globs the node directories
+    with patch('nipype.pipeline.engine.glob') as engine_glob:
+        wf.run()
+    yield assert_false, engine_glob.called
+    # the hash files remain authoritative
+    hashfiles = glob(os.path.join(outdir, '_0x*.json'))
+    for hashfile in hashfiles:
+        os.remove(hashfile)
+    wf.run()
+    yield assert_equal, glob(os.path.join(outdir, '_0x*.json')), hashfiles
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
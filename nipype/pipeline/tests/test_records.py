@@ -0,0 +1,113 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Tests for the output records of the nodes
+"""
+import os
+from glob import glob
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from ...testing import assert_equal, assert_raises, assert_true
+import nipype.pipeline.engine as pe
+import nipype.interfaces.utility as niu
+from ...interfaces.base import Bunch, InterfaceResult
+from ...utils.filemanip import savepkl
+from ..records import save_record, load_record, ResultCache
+
+
+def _save_old_record(filename, outputs):
+    """Write a record last modified 10 seconds ago"""
+    save_record(filename, outputs)
+    mtime = time() - 10
+    os.utime(filename, (mtime, mtime))
+
+
+def test_record():
+    root = mkdtemp(prefix='test_records_')
+    recordfile = os.path.join(root, 'result_node.rec')
+    outputs = {'out_file': 'a.nii', 'files': ['b.nii', 'c.nii'],
+               'stats': {'mean': 1.5}}
+    save_record(recordfile, outputs)
+    yield assert_equal, load_record(recordfile), outputs
+    yield assert_equal, load_record(recordfile, ['files', 'stats']), \
+        {'files': ['b.nii', 'c.nii'], 'stats': {'mean': 1.5}}
+    yield assert_raises, KeyError, load_record, recordfile, ['missing']
+    open(recordfile, 'wb').write('not a record')
+    yield assert_raises, IOError, load_record, recordfile
+    rmtree(root)
+
+
+def test_result_cache():
+    root = mkdtemp(prefix='test_records_')
+    resultfiles = [os.path.join(root, 'result_node%d.pklz' % idx)
+                   for idx in range(3)]
+    for idx, resultfile in enumerate(resultfiles):
+        _save_old_record(resultfile[:-5] + '.rec', {'out': idx})
+    cache = ResultCache(size=2)
+    for _ in range(3):
+        yield assert_equal, cache.load(resultfiles[0]), {'out': 0}
+    yield assert_equal, (cache.hits, cache.misses), (2, 1)
+    # a new record is read again
+    _save_old_record(resultfiles[0][:-5] + '.rec', {'out': 'new value'})
+    yield assert_equal, cache.load(resultfiles[0]), {'out': 'new value'}
+    yield assert_equal, cache.misses, 2
+    # the least recently used results are dropped
+    cache.load(resultfiles[1])
+    cache.load(resultfiles[2])
+    cache.load(resultfiles[0])
+    yield assert_equal, cache.misses, 5
+    yield assert_raises, IOError, cache.load, os.path.join(root, 'none.pklz')
+    rmtree(root)
+
+
+def test_result_cache_rewrite():
+    root = mkdtemp(prefix='test_records_')
+    resultfile = os.path.join(root, 'result_node.pklz')
+    savepkl(resultfile, InterfaceResult(None, None,
+                                        outputs=Bunch(out='old')))
+    # timestamps of a filesystem with a granularity of one second
+    mtime = int(time())
+    os.utime(resultfile, (mtime, mtime))
+    size = os.stat(resultfile).st_size
+    cache = ResultCache(size=2)
+    yield assert_equal, cache.load(resultfile), {'out': 'old'}
+    # rewritten in place within the same second, with the same size
+    savepkl(resultfile, InterfaceResult(None, None,
+                                        outputs=Bunch(out='new')))
+    os.utime(resultfile, (mtime, mtime))
+    yield assert_equal, os.stat(resultfile).st_size, size
+    yield assert_equal, cache.load(resultfile), {'out': 'new'}
+    yield assert_equal, (cache.hits, cache.misses), (0, 2)
+    rmtree(root)
+
+
+def double(a):
+    return 2 * a
+
+
+def test_inputs_from_records():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_records_')
+    os.chdir(temp_dir)
+    wf = pe.Workflow(name='records', base_dir=temp_dir)
+    wf.config['execution'] = {'create_report': 'false'}
+    first = pe.Node(niu.Function(input_names=['a'], output_names=['out'],
+                                 function=double), name='first')
+    first.inputs.a = 2
+    second = pe.Node(niu.Function(input_names=['a'], output_names=['out'],
+                                  function=double), name='second')
+    wf.connect(first, 'out', second, 'a')
+    execgraph = wf.run(plugin='Linear')
+    records = glob(os.path.join(temp_dir, 'records', '*', 'result_*.rec'))
+    yield assert_equal, len(records), 2
+    node = [node for node in execgraph.nodes() if node.name == 'second'][0]
+    yield assert_equal, node.result.outputs.out, 8
+    # results without a record are read from the result file
+    for recordfile in records:
+        os.remove(recordfile)
+    node.inputs.a = 0
+    node._get_inputs()
+    yield assert_equal, node.inputs.a, 4
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
@@ -319,3 +319,51 @@ def test_multi_disconnected_iterable():
     eg = metawf.run(plugin='Linear')
     yield assert_equal, len(eg.nodes()), 60
     rmtree(out_dir)
+
+def test_expansion_with_prefix_names():
+    # proc is the join source and a prefix of the name of proc2
+    wf = pe.Workflow(name='prefix')
+    subj = pe.Node(niu.IdentityInterface(fields=['x']), name='subj')
+    subj.iterables = ('x', [1, 2, 3])
+    proc = pe.Node(niu.Function(input_names=['fwhm'], output_names=['fwhm'],
+                                function=fwhm), name='proc')
+    proc2 = pe.Node(niu.Function(input_names=['fwhm'], output_names=['fwhm'],
+                                 function=fwhm), name='proc2')
+    join = pe.JoinNode(niu.IdentityInterface(fields=['fwhm']),
+                       joinsource='subj', joinfield='fwhm', name='join')
+    wf.connect([(subj, proc, [('x', 'fwhm')]),
+                (subj, proc2, [('x', 'fwhm')]),
+                (proc, join, [('fwhm', 'fwhm')])])
+    from ..utils import generate_expanded_graph
+    eg = generate_expanded_graph(deepcopy(wf._create_flat_graph()))
+    joins = [node for node in eg.nodes() if node.name == 'join']
+    yield assert_equal, len(joins), 1
+    yield assert_equal, sorted([src.name for src in
+                                eg.predecessors(joins[0])]), ['proc'] * 3
+    params = sorted([node.parameterization for node in eg.nodes()
+                     if node.name == 'proc2'])
+    yield assert_equal, params, [['_x_1'], ['_x_2'], ['_x_3']]
+
+def first(a, b, c):
+    return a
+
+def test_shared_readonly_inputs():
+    import numpy as np
+    from ..utils import generate_expanded_graph
+    shared = np.arange(10)
+    shared.setflags(write=False)
+    private = np.arange(10)
+    wf = pe.Workflow(name='shared')
+    node = pe.Node(niu.Function(input_names=['a', 'b', 'c'],
+                                output_names=['out'], function=first),
+                   name='node')
+    node.inputs.a = shared
+    node.inputs.b = private
+    node.iterables = ('c', [1, 2])
+    wf.add_nodes([node])
+    eg = generate_expanded_graph(wf._create_flat_graph())
+    yield assert_equal, len(eg.nodes()), 2
+    for copy in eg.nodes():
+        yield assert_true, copy.inputs.a is shared
+        yield assert_false, copy.inputs.b is private
+        yield assert_equal, list(copy.inputs.b), range(10)
@@ -3,12 +3,15 @@
 """Utility routines for workflow graphs
 """
 
+from bisect import bisect_left
 from copy import deepcopy
 from glob import glob
 from collections import defaultdict
 import os
 import pwd
 import re
+import resource
+import sys
 from uuid import uuid1
 
 import numpy as np
@@ -351,6 +354,58 @@ def get_levels(G):
     return levels
 
 
+def _readonly_arrays(value, arrays):
+    """Collect the read-only numpy arrays found in (nested) containers"""
+    if isinstance(value, np.ndarray):
+        if not value.flags.writeable:
+            arrays[id(value)] = value
+    elif isinstance(value, dict):
+        for item in value.values():
+            _readonly_arrays(item, arrays)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _readonly_arrays(item, arrays)
+
+
+def shared_memo(nodes):
+    """Return a deepcopy memo that shares the immutable inputs of `nodes`
+
+    Strings, numbers and tuples of them are never duplicated by deepcopy.
+    Read-only numpy arrays (see ``ndarray.setflags(write=False)``) cannot be
+    modified either, so the nodes copied with this memo share them instead
+    of duplicating them. Use a new copy of the memo for every deepcopy.
+    """
+    arrays = {}
+    for node in nodes:
+        for inputs in set([node.inputs, node._interface.inputs]):
+            _readonly_arrays(inputs.get(), arrays)
+    return arrays
+
+
+def copy_config(config):
+    """Copy the dictionaries of a config, sharing its (immutable) values
+
+    >>> config = {'execution': {'plugin': 'Linear'}}
+    >>> copy = copy_config(config)
+    >>> copy == config, copy['execution'] is config['execution']
+    (True, False)
+    """
+    if isinstance(config, dict):
+        return dict([(key, copy_config(value))
+                     for key, value in config.items()])
+    return config
+
+
+def get_peak_memory(who=resource.RUSAGE_SELF):
+    """Peak resident set size in GB of the process (or of its children that
+    have been waited for, with `who` set to resource.RUSAGE_CHILDREN)"""
+    maxrss = float(resource.getrusage(who).ru_maxrss)
+    if sys.platform == 'darwin':
+        # bytes instead of kilobytes
+        maxrss /= 1024
+    return maxrss / 1024 ** 2
+
+
 def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
                   prefix, synchronize=False):
     """Merges two graphs that share a subset of nodes.
@@ -382,24 +437,34 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
     """
     # Retrieve edge information connecting nodes of the subgraph to other
     # nodes of the supergraph.
-    supernodes = supergraph.nodes()
-    ids = [n._hierarchy + n._id for n in supernodes]
-    if len(np.unique(ids)) != len(ids):
+    supernodes = dict([(n._hierarchy + n._id, n)
+                       for n in supergraph.nodes_iter()])
+    if len(supernodes) != supergraph.number_of_nodes():
         # This should trap the problem of miswiring when multiple iterables are
         # used at the same level. The use of the template below for naming
         # updates to nodes is the general solution.
         raise Exception(("Execution graph does not have a unique set of node "
                          "names. Please rerun the workflow"))
-    edgeinfo = {}
-    for n in subgraph.nodes():
-        nidx = ids.index(n._hierarchy + n._id)
-        for edge in supergraph.in_edges_iter(supernodes[nidx]):
-                #make sure edge is not part of subgraph
-            if edge[0] not in subgraph.nodes():
-                if n._hierarchy + n._id not in edgeinfo.keys():
-                    edgeinfo[n._hierarchy + n._id] = []
-                edgeinfo[n._hierarchy + n._id].append((edge[0],
-                                               supergraph.get_edge_data(*edge)))
+    # The subgraph is copied as a template: its nodes and the data of its
+    # edges are deep copied together (so that objects they share stay shared
+    # as with a deepcopy of the graph) and the copies are wired by index.
+    subnodes = subgraph.nodes()
+    subindex = dict([(n, idx) for idx, n in enumerate(subnodes)])
+    subedges = [(subindex[u], subindex[v], d)
+                for u, v, d in subgraph.edges_iter(data=True)]
+    edgeinfo = defaultdict(list)
+    for idx, n in enumerate(subnodes):
+        node = supernodes[n._hierarchy + n._id]
+        for edge in supergraph.in_edges_iter(node):
+            # make sure edge is not part of subgraph
+            if edge[0] not in subindex:
+                edgeinfo[idx].append((edge[0],
+                                      supergraph.get_edge_data(*edge)))
+    rootidx = [idx for idx, n in enumerate(subnodes)
+               if n._hierarchy + n._id == nodeid][0]
+    levels = get_levels(subgraph)
+    levels = [levels[n] for n in subnodes]
+    memo = shared_memo(subnodes)
     supergraph.remove_nodes_from(nodes)
     # Add copies of the subgraph depending on the number of iterables
     iterable_params = expand_iterables(iterables, synchronize)
@@ -411,17 +476,15 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
     template = '.%s%%0%dd' % (prefix, np.ceil(np.log10(count)))
     # Copy the iterable subgraphs
     for i, params in enumerate(iterable_params):
-        Gc = deepcopy(subgraph)
-        ids = [n._hierarchy + n._id for n in Gc.nodes()]
-        nodeidx = ids.index(nodeid)
-        rootnode = Gc.nodes()[nodeidx]
+        copies, edgedata = deepcopy((subnodes, [d for _, _, d in subedges]),
+                                    dict(memo))
+        rootnode = copies[rootidx]
         paramstr = ''
         for key, val in sorted(params.items()):
             paramstr = '_'.join((paramstr, _get_valid_pathstr(key),
                                  _get_valid_pathstr(str(val))))
             rootnode.set_input(key, val)
-        levels = get_levels(Gc)
-        for n in Gc.nodes():
+        for idx, n in enumerate(copies):
             """
             update parameterization of the node to reflect the location of
             the output directory.  For example, if the iterables along a
@@ -430,7 +493,7 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
             with iterable 'b' will be placed in a directory
             _a_aval/_b_bval/.
             """
-            path_length = levels[n]
+            path_length = levels[idx]
             # enter as negative numbers so that earlier iterables with longer
             # path lengths get precedence in a sort
             paramlist = [(-path_length, paramstr)]
@@ -438,12 +501,12 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
                 n.parameterization = paramlist + n.parameterization
             else:
                 n.parameterization = paramlist
-        supergraph.add_nodes_from(Gc.nodes())
-        supergraph.add_edges_from(Gc.edges(data=True))
-        for node in Gc.nodes():
-            if node._hierarchy + node._id in edgeinfo.keys():
-                for info in edgeinfo[node._hierarchy + node._id]:
-                    supergraph.add_edges_from([(info[0], node, info[1])])
+        supergraph.add_nodes_from(copies)
+        supergraph.add_edges_from([(copies[u], copies[v], d) for (u, v, _), d
+                                   in zip(subedges, edgedata)])
+        for idx, node in enumerate(copies):
+            for info in edgeinfo.get(idx, []):
+                supergraph.add_edges_from([(info[0], node, info[1])])
             node._id += template % i
     return supergraph
 
@@ -669,17 +732,25 @@ def generate_expanded_graph(graph_in):
                                  subgraph, inode._hierarchy + inode._id,
                                  iterables, iterable_prefix, inode.synchronize)
 
-        # reconnect the join nodes
+        # reconnect the join nodes, looking up the replicates of their
+        # sources in the sorted node ids
+        if jnodes:
+            graph_nodes = sorted(graph_in.nodes(), key=lambda node: node._id)
+            node_ids = [node._id for node in graph_nodes]
         for jnode in jnodes:
             # the {node id: edge data} dictionary for edges connecting
             # to the join node in the unexpanded graph
             old_edge_dict = jedge_dict[jnode]
-            # the edge source node replicates
+            # the edge source node replicates, i.e. the source node itself
+            # or the nodes whose id extends the source id with a suffix
             expansions = defaultdict(list)
-            for node in graph_in.nodes_iter():
-                for src_id, edge_data in old_edge_dict.iteritems():
-                    if node._id.startswith(src_id):
-                        expansions[src_id].append(node)
+            for src_id in old_edge_dict:
+                idx = bisect_left(node_ids, src_id)
+                while (idx < len(node_ids) and
+                       node_ids[idx].startswith(src_id)):
+                    if node_ids[idx][len(src_id):len(src_id) + 1] in ('', '.'):
+                        expansions[src_id].append(graph_nodes[idx])
+                    idx += 1
             for in_id, in_nodes in expansions.iteritems():
                 logger.debug("The join node %s input %s was expanded"
                          " to %d nodes." %(jnode, in_id, len(in_nodes)))
@@ -997,7 +1068,8 @@ def clean_working_directory(outputs, cwd, inputs, needed_outputs, config,
         input_files.extend(walk_outputs(inputdict))
         needed_files += [path for path, type in input_files if type == 'f']
     for extra in ['_0x*.json', 'provenance.*', 'pyscript*.m',
-                  'command.txt', 'result*.pklz', '_inputs.pklz', '_node.pklz']:
+                  'command.txt', 'result*.pklz', 'result*.rec', '_inputs.pklz',
+                  '_node.pklz']:
         needed_files.extend(glob(os.path.join(cwd, extra)))
     if files2keep:
         needed_files.extend(filename_to_list(files2keep))
@@ -1145,17 +1217,13 @@ def topological_sort(graph, depth_first=True):
     nodes=[]
     groups=[]
     group=0
+    order = dict([(node, idx) for idx, node in enumerate(nodesort)])
     G = nx.Graph()
     G.add_nodes_from(graph.nodes())
     G.add_edges_from(graph.edges())
     components = nx.connected_components(G)
     for desc in components:
         group += 1
-        indices = []
-        for node in desc:
-            indices.append(nodesort.index(node))
-        nodes.extend(np.array(nodesort)[np.array(indices)[np.argsort(indices)]].tolist())
-        for node in desc:
-            nodesort.remove(node)
+        nodes.extend(sorted(desc, key=order.get))
         groups.extend([group] * len(desc))
     return nodes, groups
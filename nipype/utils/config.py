@@ -30,22 +30,32 @@ log_size = 16384000
 log_rotate = 4
 
 [execution]
+content_hash_algorithm = md5
+content_hash_cache = false
 create_report = true
 crashdump_dir = %s
 display_variable = :1
 hash_method = timestamp
+hash_threads = 4
 job_finished_timeout = 5
 keep_inputs = false
 local_hash_check = true
+mapnode_n_procs = 1
 matplotlib_backend = Agg
 plugin = Linear
 remove_node_directories = false
 remove_unnecessary_outputs = true
+result_cache_size = 1000
 single_thread_matlab = true
 stop_on_first_crash = false
 stop_on_first_rerun = false
+use_hash_index = true
+use_output_records = true
 use_relative_paths = false
 stop_on_unknown_version = false
+terminal_log_rotate = 4
+terminal_log_size = 16384000
+terminal_tail_lines = 100
 write_provenance = false
 parameterize_dirs = true
 
@@ -13,11 +13,18 @@ import json
 import os
 import re
 import shutil
+import threading
+from socket import gethostname
+from time import time
 
 import numpy as np
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 from ..interfaces.traits_extension import isdefined
-from .misc import is_container
+from .misc import is_container, str2bool
 
 from .. import logging, config
 fmlogger = logging.getLogger("filemanip")
@@ -145,10 +152,206 @@ def check_forhash(filename):
         return False, None
 
 
-def hash_infile(afile, chunk_len=8192, crypto=hashlib.md5):
-    """ Computes hash of a file using 'crypto' module"""
+def get_hash_algorithm(name):
+    """Return the constructor of the hash algorithm `name`
+
+    `name` is an algorithm of hashlib (e.g., md5, sha1) or, if the xxhash
+    package is installed, xxh32 or xxh64.
+    """
+    if name.startswith('xxh'):
+        if xxhash is None:
+            raise ImportError('The xxhash package is required to hash files '
+                              'with %s' % name)
+        return getattr(xxhash, name)
+    try:
+        return getattr(hashlib, name)
+    except AttributeError:
+        raise ValueError('Unknown hash algorithm: %s' % name)
+
+
+class ContentHashCache(object):
+    """Persistent memo of the content hashes of large files
+
+    Hashes are keyed by the real path of the file and the hash algorithm,
+    and are only valid as long as the size, modification time, status
+    change time and inode of the file are unchanged. Files modified less
+    than `racy_time` seconds before they were hashed are not memoized: a
+    rewrite within the timestamp granularity of the filesystem (up to 2 s)
+    would keep the same signature. The memo is shared between processes
+    through append-only logs in `cache_dir`, one per process, that are
+    merged when there are too many of them. Only the logs that have been
+    idle for `idle_time` seconds are removed by a merge. Files smaller
+    than `min_size` are cheaper to hash than to look up and are not
+    memoized.
+    """
+
+    min_size = 1024 * 1024
+    max_shards = 100
+    racy_time = 3.
+    idle_time = 60.
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._hashes = {}
+        self._offsets = {}
+        self._shard = None
+        self._shard_pid = None
+        self._lock = threading.Lock()
+
+    def _update(self):
+        """Read the hashes appended by all processes since the last update
+        """
+        shards = glob(os.path.join(self.cache_dir, '*.log'))
+        for shard in shards:
+            offset = self._offsets.get(shard, 0)
+            try:
+                fp = open(shard, 'rt')
+                fp.seek(offset)
+                data = fp.read()
+                fp.close()
+            except IOError:
+                continue
+            # the last line may still be written
+            end = data.rfind('\n') + 1
+            self._offsets[shard] = offset + end
+            for line in data[:end].splitlines():
+                try:
+                    path, algorithm, size, mtime, ctime, inode, hexdigest = \
+                        json.loads(line)
+                except ValueError:
+                    continue
+                self._hashes[(path, algorithm)] = (size, mtime, ctime, inode,
+                                                   hexdigest)
+        if len(shards) > self.max_shards:
+            self._merge(shards)
+
+    def _merge(self, shards):
+        """Merge the logs into one, dropping the hashes of the files that
+        were removed or modified since"""
+        merge_time = time()
+        merged = os.path.join(self.cache_dir, 'merged_%s_%d.log' %
+                              (gethostname(), os.getpid()))
+        for key, entry in self._hashes.items():
+            try:
+                stat = os.stat(key[0])
+            except OSError:
+                stat = None
+            if stat is None or not self._matches(entry, stat):
+                del self._hashes[key]
+        try:
+            fp = open(merged + '.tmp', 'wt')
+            for key, entry in self._hashes.items():
+                fp.write(json.dumps(list(key) + list(entry)) + '\n')
+            fp.close()
+            os.rename(merged + '.tmp', merged)
+        except (IOError, OSError), e:
+            fmlogger.debug('Could not merge the content hashes: %s' % e)
+            return
+        offsets = {merged: os.path.getsize(merged)}
+        for shard in shards:
+            if shard == merged:
+                continue
+            try:
+                stat = os.stat(shard)
+            except OSError:
+                continue
+            # the logs other processes may still append to are kept
+            if (shard == self._shard or
+                    stat.st_size != self._offsets.get(shard) or
+                    stat.st_mtime > merge_time - self.idle_time):
+                offsets[shard] = self._offsets.get(shard, 0)
+                continue
+            try:
+                os.remove(shard)
+            except OSError:
+                pass
+        self._offsets = offsets
+
+    def _matches(self, entry, stat):
+        return (entry is not None and
+                tuple(entry[:4]) == (stat.st_size, stat.st_mtime,
+                                     stat.st_ctime, stat.st_ino))
+
+    def lookup(self, afile, stat, algorithm):
+        """Return the memoized hash of `afile` or None
+
+        `stat` is the result of os.stat(afile).
+        """
+        key = (os.path.realpath(afile), algorithm)
+        with self._lock:
+            entry = self._hashes.get(key)
+            if not self._matches(entry, stat):
+                # the file may have been hashed by another process
+                self._update()
+                entry = self._hashes.get(key)
+        if self._matches(entry, stat):
+            return str(entry[4])
+        return None
+
+    def record(self, afile, stat, algorithm, hexdigest, stat_time):
+        """Memoize the hash of `afile` whose os.stat() was `stat`
+
+        `stat_time` is the time at which `stat` was taken, before the file
+        was read.
+        """
+        if stat_time - stat.st_mtime < self.racy_time:
+            # the file could be rewritten without changing its signature
+            return
+        key = (os.path.realpath(afile), algorithm)
+        entry = (stat.st_size, stat.st_mtime, stat.st_ctime, stat.st_ino,
+                 hexdigest)
+        with self._lock:
+            self._hashes[key] = entry
+            try:
+                if self._shard_pid != os.getpid():
+                    if not os.path.exists(self.cache_dir):
+                        os.makedirs(self.cache_dir)
+                    self._shard = os.path.join(self.cache_dir, '%s_%d.log' %
+                                               (gethostname(), os.getpid()))
+                    self._shard_pid = os.getpid()
+                fp = open(self._shard, 'at')
+                fp.write(json.dumps(list(key) + list(entry)) + '\n')
+                fp.close()
+            except (IOError, OSError), e:
+                fmlogger.debug('Could not save the content hash: %s' % e)
+
+
+_content_hash_cache = None
+
+
+def get_content_hash_cache():
+    """Return the content hash memo of the user (in ~/.nipype/hashcache)
+    """
+    global _content_hash_cache
+    if _content_hash_cache is None:
+        _content_hash_cache = ContentHashCache(
+            os.path.expanduser(os.path.join('~', '.nipype', 'hashcache')))
+    return _content_hash_cache
+
+
+def hash_infile(afile, chunk_len=1024 * 1024, crypto=None):
+    """ Computes hash of a file using 'crypto' module
+
+    By default, the algorithm is set by the ``content_hash_algorithm``
+    execution option. The hashes of large files are memoized if the
+    ``content_hash_cache`` option is set (see `ContentHashCache`).
+    """
     hex = None
     if os.path.isfile(afile):
+        if crypto is None:
+            algorithm = config.get('execution', 'content_hash_algorithm')
+            crypto = get_hash_algorithm(algorithm)
+        else:
+            algorithm = crypto().name
+        stat_time = time()
+        stat = os.stat(afile)
+        cache = None
+        if (stat.st_size >= ContentHashCache.min_size and
+                str2bool(config.get('execution', 'content_hash_cache'))):
+            cache = get_content_hash_cache()
+            hex = cache.lookup(afile, stat, algorithm)
+            if hex is not None:
+                return hex
         crypto_obj = crypto()
         fp = file(afile, 'rb')
         while True:
@@ -158,6 +361,8 @@ def hash_infile(afile, chunk_len=8192, crypto=hashlib.md5):
             crypto_obj.update(data)
         fp.close()
         hex = crypto_obj.hexdigest()
+        if cache is not None:
+            cache.record(afile, stat, algorithm, hex, stat_time)
     return hex
 
 
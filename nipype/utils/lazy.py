@@ -0,0 +1,44 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Modules that are only imported when they are used
+"""
+from importlib import import_module
+from types import ModuleType
+
+
+class LazyModule(ModuleType):
+    """Stand-in for a module that imports it on first attribute access
+
+    Once imported, the attributes of the module are copied to the
+    stand-in, so that later accesses do not go through it.
+
+    >>> from nipype.utils.lazy import LazyModule
+    >>> json = LazyModule('json')
+    >>> json
+    <lazy module 'json'>
+    >>> json.dumps([1])
+    '[1]'
+    """
+
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+
+    def _load(self):
+        module = import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        return '<lazy module %r>' % self.__name__
+
+
+def lazy_modules(package, names):
+    """Return stand-ins for the `names` submodules of `package`
+    """
+    return [LazyModule('%s.%s' % (package, name)) for name in names]
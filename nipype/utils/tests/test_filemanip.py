@@ -1,7 +1,11 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
+from hashlib import md5, sha1
+import json
 import os
+from shutil import rmtree
 from tempfile import mkstemp, mkdtemp
+from time import time
 
 from nipype.testing import assert_equal, assert_true, assert_false
 from nipype.utils.filemanip import (save_json, load_json, loadflat,
@@ -9,7 +13,10 @@ from nipype.utils.filemanip import (save_json, load_json, loadflat,
                                     hash_rename, check_forhash,
                                     copyfile, copyfiles,
                                     filename_to_list, list_to_filename,
-                                    split_filename, get_related_files)
+                                    split_filename, get_related_files,
+                                    hash_infile, ContentHashCache)
+import nipype.utils.filemanip as filemanip
+from nipype import config
 
 import numpy as np
 
@@ -187,3 +194,92 @@ def test_related_files():
     yield assert_true, '/path/test.HEAD' in afni_files1
     yield assert_true, '/path/test.BRIK' in afni_files2
     yield assert_true, '/path/test.HEAD' in afni_files2
+
+def _write_old(afile, data, mtime=None):
+    """Write a file that was last modified at `mtime` (default: 10 s ago)"""
+    open(afile, 'wb').write(data)
+    if mtime is None:
+        mtime = time() - 10
+    os.utime(afile, (mtime, mtime))
+
+def test_hash_infile_cache():
+    tmpdir = mkdtemp()
+    orig_cache = filemanip._content_hash_cache
+    orig_option = config.get('execution', 'content_hash_cache')
+    config.set('execution', 'content_hash_cache', 'true')
+    filemanip._content_hash_cache = ContentHashCache(os.path.join(tmpdir,
+                                                                  'cache'))
+    afile = os.path.join(tmpdir, 'data.bin')
+    data = 'x' * (ContentHashCache.min_size + 1)
+    _write_old(afile, data)
+    yield assert_equal, hash_infile(afile), md5(data).hexdigest()
+    yield assert_equal, hash_infile(afile, crypto=sha1), sha1(data).hexdigest()
+    # another process finds the hash in the shared memo
+    cache = ContentHashCache(os.path.join(tmpdir, 'cache'))
+    yield assert_equal, cache.lookup(afile, os.stat(afile), 'md5'), \
+        md5(data).hexdigest()
+    cache.record(afile, os.stat(afile), 'md5', 'memoized', time())
+    filemanip._content_hash_cache = ContentHashCache(os.path.join(tmpdir,
+                                                                  'cache'))
+    yield assert_equal, hash_infile(afile), 'memoized'
+    # a modified file is hashed again
+    _write_old(afile, data + 'y')
+    yield assert_equal, hash_infile(afile), md5(data + 'y').hexdigest()
+    # a file rewritten in place with the same size and modification time
+    # does not match the memo either, its status change time differs
+    stat = os.stat(afile)
+    cache.record(afile, stat, 'md5', 'memoized', time())
+    _write_old(afile, data + 'z', stat.st_mtime)
+    yield assert_equal, os.stat(afile).st_mtime, stat.st_mtime
+    yield assert_equal, hash_infile(afile), md5(data + 'z').hexdigest()
+    # files modified just before they are hashed are not memoized
+    cache = ContentHashCache(os.path.join(tmpdir, 'racy'))
+    filemanip._content_hash_cache = cache
+    open(afile, 'wb').write(data)
+    yield assert_equal, hash_infile(afile), md5(data).hexdigest()
+    yield assert_equal, cache.lookup(afile, os.stat(afile), 'md5'), None
+    yield assert_false, os.path.exists(os.path.join(tmpdir, 'racy'))
+    # the memo is off by default
+    config.set('execution', 'content_hash_cache', 'false')
+    _write_old(afile, data)
+    hash_infile(afile)
+    yield assert_false, os.path.exists(os.path.join(tmpdir, 'racy'))
+    config.set('execution', 'content_hash_cache', orig_option)
+    filemanip._content_hash_cache = orig_cache
+    rmtree(tmpdir)
+
+def test_hash_cache_merge():
+    tmpdir = mkdtemp()
+    cache_dir = os.path.join(tmpdir, 'cache')
+    files = [os.path.join(tmpdir, name)
+             for name in ['kept.bin', 'removed.bin', 'modified.bin']]
+    cache = ContentHashCache(cache_dir)
+    for afile in files:
+        _write_old(afile, 'x')
+        cache.record(afile, os.stat(afile), 'md5', 'hash', time())
+    os.remove(files[1])
+    open(files[2], 'ab').write('y')
+    # a log another process is still appending to
+    live = os.path.join(cache_dir, 'otherhost_1.log')
+    open(live, 'wt').write(open(cache._shard).read())
+    old = time() - 2 * ContentHashCache.idle_time
+    os.utime(cache._shard, (old, old))
+    # merge the logs on the next update
+    cache = ContentHashCache(cache_dir)
+    cache.max_shards = 0
+    cache._update()
+    logs = sorted(os.listdir(cache_dir))
+    yield assert_equal, len(logs), 2
+    yield assert_true, logs[0].startswith('merged_')
+    yield assert_equal, logs[1], 'otherhost_1.log'
+    entries = open(os.path.join(cache_dir, logs[0])).read().splitlines()
+    yield assert_equal, len(entries), 1
+    yield assert_true, os.path.realpath(files[0]) in entries[0]
+    # the entries appended to the live log are still read
+    open(live, 'at').write(json.dumps([os.path.realpath(files[2]), 'md5'] +
+                                      [0, 0, 0, 0, 'new']) + '\n')
+    cache.max_shards = ContentHashCache.max_shards
+    cache._update()
+    yield assert_equal, cache._hashes[(os.path.realpath(files[2]), 'md5')], \
+        [0, 0, 0, 0, 'new']
+    rmtree(tmpdir)
@@ -0,0 +1,24 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import sys
+
+from nipype.testing import assert_equal, assert_true, assert_false
+from nipype.utils.lazy import LazyModule
+
+
+def test_lazy_module():
+    sys.modules.pop('wave', None)
+    wave = LazyModule('wave')
+    yield assert_false, 'wave' in sys.modules
+    yield assert_true, 'open' in dir(wave)
+    yield assert_true, 'wave' in sys.modules
+    yield assert_equal, wave.open, sys.modules['wave'].open
+    yield assert_true, 'open' in wave.__dict__
+
+
+def test_lazy_interfaces():
+    import nipype.interfaces as interfaces
+    from nipype.interfaces.fsl import BET
+    yield assert_true, interfaces.fsl.BET is BET
+    import nipype
+    yield assert_true, nipype.fsl.BET is BET
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Measure how long CreateMatrix takes on a random tractogram
+
+Random walks are written as a TrackVis file over a volume of 64 ROIs and
+the connectivity matrices are created from their endpoints and, with -i,
+from all the ROIs they cross. The peak memory of the process is reported
+with the time: it depends on the chunk size (-c), not on the number of
+fibers.
+
+Example::
+
+    python tools/benchmarks/bench_cmat.py -n 200000 -i
+"""
+
+from optparse import OptionParser
+import os
+import resource
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+import nibabel as nb
+import networkx as nx
+import numpy as np
+
+from nipype import config, logging
+from nipype.interfaces.cmtk.cmtk import CreateMatrix
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--fibers', dest='fibers', type='int',
+                      default=100000, help='number of fibers')
+    parser.add_option('-c', '--chunk-size', dest='chunk_size', type='int',
+                      default=100000, help='fibers processed at once')
+    parser.add_option('-i', '--intersections', dest='intersections',
+                      action='store_true', default=False,
+                      help='count all the region intersections')
+    opts, _ = parser.parse_args()
+    for level in ['workflow_level', 'interface_level']:
+        config.set('logging', level, 'WARNING')
+    logging.update_logging(config)
+
+    tempdir = mkdtemp()
+    os.chdir(tempdir)
+    np.random.seed(0)
+    roi = np.zeros((64, 64, 64), dtype=np.int16)
+    network = nx.Graph()
+    for label, (i, j, k) in enumerate(np.ndindex(4, 4, 4)):
+        roi[4 + 16 * i:12 + 16 * i, 4 + 16 * j:12 + 16 * j,
+            4 + 16 * k:12 + 16 * k] = label + 1
+        network.add_node(label + 1, dn_correspondence_id=label + 1)
+    nb.Nifti1Image(roi, np.eye(4)).to_filename('roi.nii')
+    nx.write_gpickle(network, 'network.pck')
+
+    def fibers():
+        for _ in xrange(opts.fibers):
+            steps = np.random.randn(np.random.randint(10, 100), 3)
+            points = np.random.rand(3) * 64 + np.cumsum(steps, axis=0)
+            yield np.clip(points, 0, 63.9).astype(np.float32), None, None
+    nb.trackvis.write('fibers.trk', fibers(),
+                      {'voxel_size': (1, 1, 1), 'dim': (64, 64, 64)})
+
+    t0 = time()
+    CreateMatrix(roi_file='roi.nii', tract_file='fibers.trk',
+                 resolution_network_file='network.pck',
+                 count_region_intersections=opts.intersections,
+                 chunk_size=opts.chunk_size).run()
+    print '%d fibers: %.2f s, peak memory %d MB' % (
+        opts.fibers, time() - t0,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+    rmtree(tempdir)
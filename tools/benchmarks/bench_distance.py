@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Measure how long the Distance interface takes with each algorithm
+
+Two overlapping spheres are written to a volume of the given size and
+their Hausdorff distance (eucl_max) is computed with each algorithm. Leave
+the brute force algorithm out of large volumes, its memory is quadratic.
+
+Example::
+
+    python tools/benchmarks/bench_distance.py -s 128 -a edt,kdtree
+"""
+
+from optparse import OptionParser
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+import nibabel as nb
+import numpy as np
+
+from nipype import config, logging
+from nipype.algorithms.misc import Distance
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--size', dest='size', type='int',
+                      default=64, help='size of the volumes')
+    parser.add_option('-a', '--algorithms', dest='algorithms',
+                      default='edt,kdtree,brute',
+                      help='comma separated algorithms')
+    opts, _ = parser.parse_args()
+    for level in ['workflow_level', 'interface_level']:
+        config.set('logging', level, 'WARNING')
+    logging.update_logging(config)
+
+    tempdir = mkdtemp()
+    grid = np.indices((opts.size,) * 3) - opts.size / 2
+    radius = opts.size / 3
+    volumes = []
+    for shift in [0, opts.size / 8]:
+        data = ((grid[0] - shift) ** 2 + grid[1] ** 2 +
+                grid[2] ** 2) < radius ** 2
+        volumes.append(os.path.join(tempdir, 'sphere%d.nii' % shift))
+        nb.Nifti1Image(data.astype(np.uint8), np.eye(4)).to_filename(
+            volumes[-1])
+    for algorithm in opts.algorithms.split(','):
+        t0 = time()
+        res = Distance(volume1=volumes[0], volume2=volumes[1],
+                       method='eucl_max', algorithm=algorithm).run()
+        print '%s: %.2f s (distance %.2f)' % (algorithm, time() - t0,
+                                              res.outputs.distance)
+    rmtree(tempdir)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Measure how the expansion of iterables scales with their number of values
+
+The workflow is a subject -> session -> parameter sweep of iterable
+IdentityInterface nodes followed by a chain of processing nodes, whose
+results are joined over the parameters and over the sessions. For every
+number of subjects the time of `generate_expanded_graph` is reported with
+the size of the expanded graph.
+
+Example::
+
+    python tools/benchmarks/bench_expansion.py -s 10,50,100,500 -e 4 -p 3
+"""
+
+from copy import deepcopy
+from optparse import OptionParser
+from time import time
+
+from nipype import config, logging
+import nipype.pipeline.engine as pe
+from nipype.interfaces.utility import IdentityInterface, Function
+from nipype.pipeline.utils import generate_expanded_graph
+
+
+def process(subject, session, param):
+    return '%s_%s_%s' % (subject, session, param)
+
+
+def make_workflow(nsubjects, nsessions, nparams, depth):
+    wf = pe.Workflow(name='expansion')
+    subjects = pe.Node(IdentityInterface(fields=['subject']),
+                       name='subjects')
+    subjects.iterables = ('subject', ['sub%03d' % idx
+                                      for idx in range(nsubjects)])
+    sessions = pe.Node(IdentityInterface(fields=['session']),
+                       name='sessions')
+    sessions.iterables = ('session', range(nsessions))
+    params = pe.Node(IdentityInterface(fields=['param']), name='params')
+    params.iterables = ('param', range(nparams))
+    previous = None
+    for idx in range(depth):
+        node = pe.Node(Function(input_names=['subject', 'session', 'param'],
+                                output_names=['out'], function=process),
+                       name='process%d' % idx)
+        wf.connect([(subjects, node, [('subject', 'subject')]),
+                    (params, node, [('param', 'param')])])
+        if previous is None:
+            wf.connect(sessions, 'session', node, 'session')
+        else:
+            wf.connect(previous, 'out', node, 'session')
+        previous = node
+    join_params = pe.JoinNode(IdentityInterface(fields=['out']),
+                              joinsource='params', joinfield='out',
+                              name='join_params')
+    join_sessions = pe.JoinNode(IdentityInterface(fields=['out']),
+                                joinsource='sessions', joinfield='out',
+                                name='join_sessions')
+    wf.connect([(previous, join_params, [('out', 'out')]),
+                (join_params, join_sessions, [('out', 'out')])])
+    return wf
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--subjects', dest='subjects', default='10,50,100',
+                      help='comma separated numbers of subjects')
+    parser.add_option('-e', '--sessions', dest='sessions', type='int',
+                      default=4, help='number of sessions')
+    parser.add_option('-p', '--params', dest='params', type='int',
+                      default=3, help='number of parameter values')
+    parser.add_option('-d', '--depth', dest='depth', type='int',
+                      default=2, help='processing nodes per combination')
+    opts, _ = parser.parse_args()
+    for level in ['workflow_level', 'interface_level']:
+        config.set('logging', level, 'WARNING')
+    logging.update_logging(config)
+    print 'subjects  iterations  expanded nodes  expansion s'
+    for nsubjects in [int(val) for val in opts.subjects.split(',')]:
+        wf = make_workflow(nsubjects, opts.sessions, opts.params, opts.depth)
+        flatgraph = wf._create_flat_graph()
+        graph = deepcopy(flatgraph)
+        t0 = time()
+        graph = generate_expanded_graph(graph)
+        duration = time() - t0
+        print '%8d  %10d  %14d  %11.2f' % (
+            nsubjects, nsubjects * opts.sessions * opts.params,
+            graph.number_of_nodes(), duration)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Measure the cost of hashing the content of large input files
+
+The file is hashed with the former 8 KB reads, with 1 MB reads, with the
+other available algorithms and finally looked up in the content hash memo
+as a new process would (i.e., after reading the memo from disk).
+
+The file is read once before the measurements so that it is in the page
+cache, which measures the cost of hashing rather than of the disks.
+
+Example::
+
+    python tools/benchmarks/bench_hashing.py -s 1024
+"""
+
+import hashlib
+from optparse import OptionParser
+import os
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
+from time import time
+
+from nipype import config, logging
+from nipype.utils import filemanip
+from nipype.utils.filemanip import (hash_infile, get_hash_algorithm,
+                                    ContentHashCache)
+
+
+def timeit(func, *args, **kwargs):
+    t0 = time()
+    func(*args, **kwargs)
+    return time() - t0
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--size', dest='size', type='int', default=512,
+                      help='size of the file in MB')
+    opts, _ = parser.parse_args()
+    for level in ['workflow_level', 'interface_level', 'filemanip_level']:
+        config.set('logging', level, 'WARNING')
+    logging.update_logging(config)
+
+    tmpdir = mkdtemp(prefix='bench_hashing_')
+    afile = os.path.join(tmpdir, 'data.bin')
+    fp = open(afile, 'wb')
+    for _ in range(opts.size):
+        fp.write(os.urandom(1024 * 1024))
+    fp.close()
+    open(afile, 'rb').read()
+    config.set('execution', 'content_hash_cache', 'false')
+
+    size = float(opts.size)
+    duration = timeit(hash_infile, afile, chunk_len=8192,
+                      crypto=hashlib.md5)
+    print 'md5, 8 KB reads: %.2f s (%.0f MB/s)' % (duration, size / duration)
+    for name in ['md5', 'sha1', 'xxh64']:
+        try:
+            crypto = get_hash_algorithm(name)
+        except ImportError:
+            print '%s: xxhash is not installed' % name
+            continue
+        duration = timeit(hash_infile, afile, crypto=crypto)
+        print '%s, 1 MB reads: %.2f s (%.0f MB/s)' % (name, duration,
+                                                     size / duration)
+
+    config.set('execution', 'content_hash_cache', 'true')
+    cache_dir = os.path.join(tmpdir, 'cache')
+    filemanip._content_hash_cache = ContentHashCache(cache_dir)
+    first = timeit(hash_infile, afile)
+    filemanip._content_hash_cache = ContentHashCache(cache_dir)
+    memo = timeit(hash_infile, afile)
+    print 'md5, memo miss: %.2f s, memo hit: %.3f ms' % (first, 1e3 * memo)
+    rmtree(tmpdir)
+    sys.exit(0)
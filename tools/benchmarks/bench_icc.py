@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Measure how long the ICC of many voxels takes to compute
+
+Random subjects x sessions tables are processed voxel by voxel with
+ICC_rep_anova (on a sample of the voxels, extrapolated) and all at once,
+in chunks, with ICC_rep_anova_chunked.
+
+Example::
+
+    python tools/benchmarks/bench_icc.py -v 200000 -s 40 -c 10000 -t 4
+"""
+
+from optparse import OptionParser
+from time import time
+
+import numpy as np
+
+from nipype.algorithms.icc import ICC_rep_anova, ICC_rep_anova_chunked
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-v', '--voxels', dest='voxels', type='int',
+                      default=100000, help='number of voxels')
+    parser.add_option('-s', '--subjects', dest='subjects', type='int',
+                      default=40, help='number of subjects')
+    parser.add_option('-k', '--sessions', dest='sessions', type='int',
+                      default=2, help='number of sessions')
+    parser.add_option('-c', '--chunk-size', dest='chunk_size', type='int',
+                      default=10000, help='voxels processed at once')
+    parser.add_option('-t', '--threads', dest='threads', type='int',
+                      default=1, help='threads processing the chunks')
+    parser.add_option('-n', '--sample', dest='sample', type='int',
+                      default=1000, help='voxels timed with ICC_rep_anova')
+    opts, _ = parser.parse_args()
+
+    Y = np.random.randn(opts.voxels, opts.subjects, opts.sessions)
+    sample = min(opts.sample, opts.voxels)
+    t0 = time()
+    for x in range(sample):
+        ICC_rep_anova(Y[x])
+    looped = (time() - t0) * opts.voxels / sample
+    t0 = time()
+    ICC_rep_anova_chunked(Y, opts.chunk_size, opts.threads)
+    chunked = time() - t0
+    print '%d voxels, %d subjects, %d sessions' % Y.shape
+    print 'per voxel (estimated): %.2f s' % looped
+    print 'chunked: %.2f s (%.0fx)' % (chunked, looped / chunked)
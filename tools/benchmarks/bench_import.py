@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Measure the time it takes a new interpreter to import nipype
+
+Each statement is timed in fresh interpreters, which is what the batch
+plugins pay for every pyscript and persistent worker they start. The
+number of modules imported is reported as well, so that results can be
+compared across releases and machines.
+
+- ``nipype``: ``import nipype``
+- ``eager``: ``import nipype`` and loading all the interface packages it
+  exposes, as nipype used to do
+- ``pyscript``: the imports of a script written by create_pyscript
+- ``worker``: the imports of a persistent worker
+
+Example::
+
+    python tools/benchmarks/bench_import.py -r 10
+"""
+
+from optparse import OptionParser
+import subprocess
+import sys
+
+statements = [
+    ('nipype', 'import nipype'),
+    ('eager', 'import nipype\n'
+              'for name in ["fsl", "spm", "freesurfer", "afni", "ants", '
+              '"slicer", "dipy", "nipy", "mrtrix", "camino"]:\n'
+              '    getattr(nipype, name).__file__'),
+    ('pyscript', 'from nipype import config, logging\n'
+                 'from nipype.utils.filemanip import loadpkl, savepkl'),
+    ('worker', 'from nipype.pipeline.plugins.worker import serve'),
+]
+
+template = """import sys
+from time import time
+t0 = time()
+%s
+print time() - t0, len(sys.modules)
+"""
+
+
+def bench_statement(statement, repeat):
+    durations = []
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c',
+                                       template % statement])
+        duration, nmodules = out.split()[-2:]
+        durations.append(float(duration))
+    # in milliseconds
+    return (1000 * min(durations), 1000 * sum(durations) / repeat,
+            int(nmodules))
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int',
+                      default=5, help='interpreters started per statement')
+    opts, _ = parser.parse_args()
+    for name, statement in statements:
+        print ('%-9s best %6.1f ms  mean %6.1f ms  %4d modules' %
+               ((name,) + bench_statement(statement, opts.repeat)))
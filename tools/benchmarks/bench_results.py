@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Measure how long nodes take to resolve their inputs from upstream results
+
+A chain of Function nodes is run once with the Linear plugin. The inputs
+of every node of the executed graph are then resolved again, first from
+the output records of the upstream nodes and then, after removing the
+records, from the gzipped result files only.
+
+Example::
+
+    python tools/benchmarks/bench_results.py -d 200 -f 1000
+"""
+
+from glob import glob
+from optparse import OptionParser
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from nipype import config, logging
+import nipype.pipeline.engine as pe
+from nipype.interfaces.utility import Function
+
+
+def passthrough(files, extra=None):
+    return files, len(files)
+
+
+def bench_inputs(execgraph, repeat):
+    t0 = time()
+    for _ in range(repeat):
+        for node in execgraph.nodes():
+            node._get_inputs()
+    return (time() - t0) / repeat
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-d', '--depth', dest='depth', type='int',
+                      default=100, help='number of nodes in the chain')
+    parser.add_option('-f', '--files', dest='files', type='int',
+                      default=100, help='number of paths passed along')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int',
+                      default=3, help='repetitions of the resolution')
+    opts, _ = parser.parse_args()
+    for level in ['workflow_level', 'interface_level']:
+        config.set('logging', level, 'WARNING')
+    logging.update_logging(config)
+
+    base_dir = mkdtemp(prefix='bench_results_')
+    wf = pe.Workflow(name='chain', base_dir=base_dir)
+    wf.config['execution'] = {'create_report': 'false',
+                              'use_output_records': 'true'}
+    previous = None
+    for idx in range(opts.depth):
+        node = pe.Node(Function(input_names=['files', 'extra'],
+                                output_names=['files', 'count'],
+                                function=passthrough),
+                       name='node%d' % idx)
+        if previous is None:
+            node.inputs.files = ['/data/sub%04d.nii' % num
+                                 for num in range(opts.files)]
+            wf.add_nodes([node])
+        else:
+            wf.connect([(previous, node, [('files', 'files'),
+                                          ('count', 'extra')])])
+        previous = node
+    t0 = time()
+    execgraph = wf.run(plugin='Linear')
+    print 'run: %d nodes in %.2f s' % (opts.depth, time() - t0)
+
+    nrecords = len(glob(os.path.join(base_dir, 'chain', '*', '*.rec')))
+    duration = bench_inputs(execgraph, opts.repeat)
+    print 'records (%d): %.2f ms per node' % (nrecords,
+                                             1e3 * duration / opts.depth)
+    for recordfile in glob(os.path.join(base_dir, 'chain', '*', '*.rec')):
+        os.remove(recordfile)
+    duration = bench_inputs(execgraph, opts.repeat)
+    print 'result files: %.2f ms per node' % (1e3 * duration / opts.depth)
+    rmtree(base_dir)
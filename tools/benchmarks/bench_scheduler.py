@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Measure the scheduling overhead of the distributed plugins
+
+Two modes are available:
+
+- ``scheduler`` (default) drives `DistributedPluginBase.run` with a synthetic
+  layered DAG of no-op nodes whose jobs complete as soon as they are
+  submitted. Everything measured is scheduler bookkeeping.
+- ``MultiProc`` runs a workflow of Function nodes through the
+  MultiProc plugin, i.e. scheduling plus the per-node execution cost.
+
+Example::
+
+    python tools/benchmarks/bench_scheduler.py -n 10000 -w 100
+    python tools/benchmarks/bench_scheduler.py --mode MultiProc -n 500
+"""
+
+from optparse import OptionParser
+import os
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
+from time import time
+
+import numpy as np
+
+from nipype import config, logging
+from nipype.pipeline.utils import nx
+from nipype.pipeline.plugins.base import DistributedPluginBase
+
+
+class NoopNode(object):
+    """Minimal stand-in for a Node as seen by the scheduler"""
+
+    def __init__(self, idx, config):
+        self._id = 'noop%d' % idx
+        self._hierarchy = 'bench'
+        self.config = config
+        self.run_without_submitting = False
+
+    def __repr__(self):
+        return self._id
+
+
+class InstantPlugin(DistributedPluginBase):
+    """A plugin whose jobs finish the moment they are submitted"""
+
+    def __init__(self, plugin_args=None):
+        super(InstantPlugin, self).__init__(plugin_args=plugin_args)
+        self._taskid = 0
+        self._results = {}
+
+    def _submit_job(self, node, updatehash=False):
+        self._taskid += 1
+        self._results[self._taskid] = dict(result=None, traceback=None)
+        self._notify_task_completed()
+        return self._taskid
+
+    def _get_result(self, taskid):
+        return self._results[taskid]
+
+    def _clear_task(self, taskid):
+        del self._results[taskid]
+
+    def _report_crash(self, node, result=None):
+        raise RuntimeError('no-op node %s crashed' % node)
+
+
+def layered_edges(nnodes, width, seed=0):
+    """Edges of a DAG with `width` nodes per layer
+
+    Every node depends on up to two random nodes of the previous layer.
+    """
+    rng = np.random.RandomState(seed)
+    edges = []
+    for idx in range(width, nnodes):
+        layer_start = (idx // width - 1) * width
+        parents = rng.randint(layer_start, layer_start + width, size=2)
+        for parent in set(parents):
+            edges.append((int(parent), idx))
+    return edges
+
+
+def bench_scheduler(nnodes, width, plugin_args):
+    config = {'execution': {'local_hash_check': 'false',
+                            'stop_on_first_crash': 'true',
+                            'remove_node_directories': 'false'}}
+    nodes = [NoopNode(idx, config) for idx in range(nnodes)]
+    graph = nx.DiGraph()
+    graph.add_nodes_from(nodes)
+    graph.add_edges_from([(nodes[u], nodes[v])
+                          for u, v in layered_edges(nnodes, width)])
+    plugin = InstantPlugin(plugin_args=plugin_args)
+    t0 = time()
+    plugin.run(graph, config)
+    return time() - t0
+
+
+def noop(a, b=None, c=None):
+    return a
+
+
+def bench_multiproc(nnodes, width, plugin_args):
+    import nipype.pipeline.engine as pe
+    from nipype.interfaces.utility import Function
+
+    base_dir = mkdtemp(prefix='bench_scheduler_')
+    wf = pe.Workflow(name='bench', base_dir=base_dir)
+    wf.config['execution'] = {'create_report': 'false'}
+    nodes = []
+    for idx in range(nnodes):
+        node = pe.Node(Function(input_names=['a', 'b', 'c'],
+                                output_names=['out'], function=noop),
+                       name='noop%d' % idx)
+        node.inputs.a = idx
+        nodes.append(node)
+    wf.add_nodes(nodes)
+    free_fields = dict([(idx, ['b', 'c']) for idx in range(nnodes)])
+    for u, v in layered_edges(nnodes, width):
+        wf.connect(nodes[u], 'out', nodes[v], free_fields[v].pop(0))
+    t0 = time()
+    wf.run(plugin='MultiProc', plugin_args=plugin_args)
+    duration = time() - t0
+    rmtree(base_dir)
+    return duration
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--nodes', dest='nodes', type='int',
+                      default=10000, help='number of nodes in the DAG')
+    parser.add_option('-w', '--width', dest='width', type='int',
+                      default=100, help='number of nodes per DAG layer')
+    parser.add_option('-m', '--mode', dest='mode', default='scheduler',
+                      help='scheduler or MultiProc')
+    parser.add_option('-p', '--poll', dest='poll', type='float',
+                      default=2., help='poll_sleep_duration plugin argument')
+    parser.add_option('-j', '--n_procs', dest='n_procs', type='int',
+                      default=None, help='n_procs for the MultiProc mode')
+    opts, _ = parser.parse_args()
+    # per-node log lines would dominate the measurement
+    for level in ['workflow_level', 'interface_level']:
+        config.set('logging', level, 'WARNING')
+    logging.update_logging(config)
+    plugin_args = {'poll_sleep_duration': opts.poll}
+    if opts.mode == 'scheduler':
+        duration = bench_scheduler(opts.nodes, opts.width, plugin_args)
+    elif opts.mode == 'MultiProc':
+        if opts.n_procs:
+            plugin_args['n_procs'] = opts.n_procs
+        duration = bench_multiproc(opts.nodes, opts.width, plugin_args)
+    else:
+        parser.error('unknown mode: %s' % opts.mode)
+    print 'mode: %s nodes: %d width: %d' % (opts.mode, opts.nodes,
+                                             opts.width)
+    print 'total: %.3f s overhead per node: %.3f ms' % (
+        duration, 1e3 * duration / opts.nodes)
+    sys.exit(0)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Measure the cost of starting nodes in fresh interpreters or in workers
+
+Three measurements are reported:
+
+- ``startup``: starting a Python interpreter and importing nipype, which the
+  batch plugins pay for every node they submit as a script.
+- ``serialize``: preparing a node for a worker on the master (deepcopy and
+  pickle of the whole node versus a compact node spec) and rebuilding it in
+  the worker, for a command line, a Python and a dynamic interface.
+- ``run``: running short nodes one interpreter per node (as the batch
+  scripts do) versus through a single persistent worker.
+
+Example::
+
+    python tools/benchmarks/bench_worker.py -n 20
+"""
+
+import cPickle
+from copy import deepcopy
+from optparse import OptionParser
+import os
+from shutil import rmtree
+import subprocess
+import sys
+from tempfile import mkdtemp
+from time import sleep, time
+
+from nipype import config, logging
+import nipype.pipeline.engine as pe
+from nipype.interfaces.fsl import BET
+from nipype.interfaces.utility import IdentityInterface, Select
+from nipype.utils.filemanip import savepkl
+from nipype.pipeline.plugins.base import create_pyscript
+from nipype.pipeline.plugins.worker import (node_spec, node_from_spec,
+                                            create_queue)
+
+
+def bench_startup(repeat):
+    t0 = time()
+    for _ in range(repeat):
+        subprocess.check_call([sys.executable, '-c',
+                               'import nipype.pipeline.engine'])
+    return (time() - t0) / repeat
+
+
+def bench_serialize(node, repeat):
+    t0 = time()
+    for _ in range(repeat):
+        pickled = cPickle.dumps(deepcopy(node), 2)
+    t_pickle = (time() - t0) / repeat
+    t0 = time()
+    for _ in range(repeat):
+        spec = cPickle.dumps(node_spec(node), 2)
+    t_spec = (time() - t0) / repeat
+    t0 = time()
+    for _ in range(repeat):
+        cPickle.loads(pickled)
+    t_unpickle = (time() - t0) / repeat
+    t0 = time()
+    for _ in range(repeat):
+        node_from_spec(cPickle.loads(spec))
+    t_rebuild = (time() - t0) / repeat
+    return (len(pickled), len(spec), 1e3 * t_pickle, 1e3 * t_spec,
+            1e3 * t_unpickle, 1e3 * t_rebuild)
+
+
+def make_nodes(nnodes, base_dir):
+    nodes = []
+    for idx in range(nnodes):
+        node = pe.Node(Select(), name='select%d' % idx, base_dir=base_dir)
+        node.inputs.inlist = range(nnodes)
+        node.inputs.index = [idx]
+        node.config = deepcopy(config._sections)
+        nodes.append(node)
+    return nodes
+
+
+def bench_scripts(nnodes):
+    base_dir = mkdtemp(prefix='bench_worker_')
+    t0 = time()
+    for node in make_nodes(nnodes, base_dir):
+        subprocess.check_call([sys.executable, create_pyscript(node)])
+    duration = time() - t0
+    rmtree(base_dir)
+    return duration
+
+
+def bench_persistent(nnodes):
+    base_dir = mkdtemp(prefix='bench_worker_')
+    queue_dir = os.path.join(base_dir, 'queue')
+    create_queue(queue_dir)
+    t0 = time()
+    worker = subprocess.Popen([sys.executable, '-m',
+                               'nipype.pipeline.plugins.worker',
+                               queue_dir, 'worker0'])
+    for idx, node in enumerate(make_nodes(nnodes, base_dir)):
+        savepkl(os.path.join(queue_dir, 'todo', 'task%06d.pklz' % idx),
+                dict(spec=node_spec(node), updatehash=False))
+    done = os.path.join(queue_dir, 'done')
+    while len(os.listdir(done)) < nnodes:
+        sleep(0.01)
+    duration = time() - t0
+    open(os.path.join(queue_dir, 'stop'), 'wt').close()
+    worker.wait()
+    rmtree(base_dir)
+    return duration
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--nodes', dest='nodes', type='int',
+                      default=20, help='number of nodes to run')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int',
+                      default=200, help='repetitions of the serialization')
+    opts, _ = parser.parse_args()
+    for level in ['workflow_level', 'interface_level']:
+        config.set('logging', level, 'WARNING')
+    logging.update_logging(config)
+
+    startup = bench_startup(5)
+    print 'startup: %.1f ms per interpreter' % (1e3 * startup)
+
+    bet = pe.Node(BET(), name='bet', base_dir='/tmp')
+    bet.inputs.in_file = os.path.abspath(__file__)
+    bet.inputs.frac = 0.3
+    select = make_nodes(1, '/tmp')[0]
+    ident = pe.Node(IdentityInterface(fields=['a', 'b']), name='ident')
+    print ('serialize: interface          pickle/spec bytes  '
+           'master pickle/spec ms  worker unpickle/rebuild ms')
+    for node in [bet, select, ident]:
+        print ('serialize: %-17s  %5d / %5d         %.3f / %.3f          '
+               '%.3f / %.3f' % ((node._interface.__class__.__name__,) +
+                               bench_serialize(node, opts.repeat)))
+
+    scripts = bench_scripts(opts.nodes)
+    persistent = bench_persistent(opts.nodes)
+    print 'run: %d nodes, one interpreter per node: %.2f s' % (opts.nodes,
+                                                               scripts)
+    print 'run: %d nodes, persistent worker: %.2f s' % (opts.nodes,
+                                                        persistent)
+    sys.exit(0)